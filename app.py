@@ -12,6 +12,7 @@ import google.generativeai as genai
 from PIL import Image, ImageEnhance
 import pandas as pd
 import json
+import logging
 import os
 import io
 import time
@@ -22,12 +23,15 @@ import sqlite3
 from datetime import datetime, timedelta
 import hashlib
 import shutil
+import threading
+from collections import deque
 import secrets as _secrets_module
 import re
 import smtplib
+import socket
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from openpyxl.styles import Alignment, Font
+from job_worker import pdf_convert_to_result, read_job_inputs, run_in_subprocess, run_pdf_convert
 
 # 隱私政策與服務條款內容（可點擊展開查看）；{{CONTACT_EMAIL}} 會於顯示時替換
 PRIVACY_POLICY = """
@@ -179,6 +183,7 @@ if "db_path_mode" not in st.session_state: st.session_state.db_path_mode = "💾
 if "use_memory_mode" not in st.session_state: st.session_state.use_memory_mode = False
 if "local_invoices" not in st.session_state: st.session_state.local_invoices = []
 if "local_batches" not in st.session_state: st.session_state.local_batches = []
+if "local_sellers" not in st.session_state: st.session_state.local_sellers = {}
 if "image_storage_dir" not in st.session_state: 
     base_dir = os.path.dirname(os.path.abspath(__file__))
     st.session_state.image_storage_dir = os.path.join(base_dir, "invoice_images")
@@ -256,6 +261,14 @@ def _safe_secrets_get(key, default=None):
     fallback = _load_secrets_from_app_dir()
     return fallback.get(key, default)
 
+
+def is_admin_user(user_email=None):
+    """是否為管理員：email 列於 Secrets / 環境變數 ADMIN_EMAILS（逗號分隔或陣列）。全站維護與監控功能僅管理員可見。"""
+    user_email = (user_email or st.session_state.get("user_email") or "").strip().lower()
+    raw = _safe_secrets_get("ADMIN_EMAILS") or os.getenv("ADMIN_EMAILS") or ""
+    admins = raw if isinstance(raw, (list, tuple)) else str(raw).split(",")
+    return bool(user_email) and user_email in {str(a).strip().lower() for a in admins if str(a).strip()}
+
 def _get_contact_email():
     """取得聯絡信箱，請於 .streamlit/secrets.toml 設定 CONTACT_EMAIL。"""
     return (_safe_secrets_get("CONTACT_EMAIL") or "").strip()
@@ -918,6 +931,43 @@ def get_db_path():
     
     return st.session_state.current_db_path
 
+INVOICE_FTS_COLUMNS = ("seller_name", "note", "invoice_number", "subject", "file_name")
+
+
+def _ensure_invoice_fts(cursor):
+    """建立 invoices_fts 與同步觸發器；新建時以 rebuild 補入既有發票。回傳使用的 tokenizer，失敗回傳 None。"""
+    cols = ", ".join(INVOICE_FTS_COLUMNS)
+    new_cols = ", ".join(f"new.{c}" for c in INVOICE_FTS_COLUMNS)
+    old_cols = ", ".join(f"old.{c}" for c in INVOICE_FTS_COLUMNS)
+    existed = cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'invoices_fts'").fetchone()
+    tokenizer = None
+    if existed:
+        tokenizer = "trigram" if "trigram" in (existed[0] or "") else "unicode61"
+    else:
+        for tok in ("trigram", "unicode61"):
+            try:
+                cursor.execute(f"CREATE VIRTUAL TABLE invoices_fts USING fts5({cols}, content='invoices', content_rowid='id', tokenize='{tok}')")
+                tokenizer = tok
+                break
+            except Exception:
+                continue
+        if tokenizer is None:
+            return None
+    try:
+        cursor.execute(f"""CREATE TRIGGER IF NOT EXISTS invoices_fts_ai AFTER INSERT ON invoices BEGIN
+            INSERT INTO invoices_fts(rowid, {cols}) VALUES (new.id, {new_cols}); END""")
+        cursor.execute(f"""CREATE TRIGGER IF NOT EXISTS invoices_fts_ad AFTER DELETE ON invoices BEGIN
+            INSERT INTO invoices_fts(invoices_fts, rowid, {cols}) VALUES ('delete', old.id, {old_cols}); END""")
+        cursor.execute(f"""CREATE TRIGGER IF NOT EXISTS invoices_fts_au AFTER UPDATE OF {cols} ON invoices BEGIN
+            INSERT INTO invoices_fts(invoices_fts, rowid, {cols}) VALUES ('delete', old.id, {old_cols});
+            INSERT INTO invoices_fts(rowid, {cols}) VALUES (new.id, {new_cols}); END""")
+        if not existed:
+            cursor.execute("INSERT INTO invoices_fts(invoices_fts) VALUES ('rebuild')")
+    except Exception:
+        return None
+    return tokenizer
+
+
 def init_db():
     """初始化資料表，確保所有必要欄位存在（多用戶版本：含 users 表）"""
     if st.session_state.use_memory_mode:
@@ -930,6 +980,8 @@ def init_db():
     try:
         conn = sqlite3.connect(path, timeout=30, uri=is_uri, check_same_thread=False)
         cursor = conn.cursor()
+        # 新建資料庫採 INCREMENTAL auto_vacuum（既有資料庫不受影響），刪除大量資料後可逐步釋放空間
+        cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
         
         # ① 創建 users 表（多用戶版本；含第三方登入 ID）
         cursor.execute('''CREATE TABLE IF NOT EXISTS users
@@ -1024,6 +1076,94 @@ def init_db():
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_invoices_batch ON invoices(batch_id)")
         except Exception:
             pass
+        # 導入去重：依用戶 + 發票號碼查詢
+        try:
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_invoices_user_number ON invoices(user_email, invoice_number)")
+        except Exception:
+            pass
+        # 列表篩選：日期（統一分隔符的表達式索引）、科目、類型、金額
+        for _idx_sql in (
+            "CREATE INDEX IF NOT EXISTS idx_invoices_user_date_norm ON invoices(user_email, replace(date, '-', '/'))",
+            "CREATE INDEX IF NOT EXISTS idx_invoices_user_subject ON invoices(user_email, subject)",
+            "CREATE INDEX IF NOT EXISTS idx_invoices_user_category ON invoices(user_email, category)",
+            "CREATE INDEX IF NOT EXISTS idx_invoices_user_total ON invoices(user_email, total)",
+        ):
+            try:
+                cursor.execute(_idx_sql)
+            except Exception:
+                pass
+        # 對獎：依用戶 + 日期範圍選取期別內發票
+        try:
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_invoices_user_date ON invoices(user_email, date)")
+        except Exception:
+            pass
+        # 賣方主檔：每位用戶依統編記住正式名稱與上次的科目/類型
+        cursor.execute('''CREATE TABLE IF NOT EXISTS sellers
+                        (user_email TEXT NOT NULL,
+                         seller_ubn TEXT NOT NULL,
+                         canonical_name TEXT,
+                         last_subject TEXT,
+                         last_category TEXT,
+                         ubn_valid INTEGER,
+                         use_count INTEGER DEFAULT 0,
+                         updated_at TIMESTAMP,
+                         PRIMARY KEY (user_email, seller_ubn))''')
+        # 發票影像：內容定址 blob 登記表，ref_count 由 invoices.image_sha256 觸發器維護
+        try:
+            cursor.execute("ALTER TABLE invoices ADD COLUMN image_sha256 TEXT")
+        except Exception:
+            pass
+        cursor.execute('''CREATE TABLE IF NOT EXISTS image_blobs
+                        (sha256 TEXT PRIMARY KEY,
+                         path TEXT NOT NULL,
+                         thumb_path TEXT,
+                         size INTEGER,
+                         ref_count INTEGER NOT NULL DEFAULT 0,
+                         touched_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+        for _trg_sql in (
+            """CREATE TRIGGER IF NOT EXISTS invoices_blob_ai AFTER INSERT ON invoices WHEN new.image_sha256 IS NOT NULL BEGIN
+                UPDATE image_blobs SET ref_count = ref_count + 1 WHERE sha256 = new.image_sha256; END""",
+            """CREATE TRIGGER IF NOT EXISTS invoices_blob_ad AFTER DELETE ON invoices WHEN old.image_sha256 IS NOT NULL BEGIN
+                UPDATE image_blobs SET ref_count = ref_count - 1 WHERE sha256 = old.image_sha256; END""",
+            """CREATE TRIGGER IF NOT EXISTS invoices_blob_au AFTER UPDATE OF image_sha256 ON invoices
+                WHEN old.image_sha256 IS NOT new.image_sha256 BEGIN
+                UPDATE image_blobs SET ref_count = ref_count - 1 WHERE sha256 = old.image_sha256;
+                UPDATE image_blobs SET ref_count = ref_count + 1 WHERE sha256 = new.image_sha256; END""",
+            "CREATE INDEX IF NOT EXISTS idx_image_blobs_unref ON image_blobs(ref_count, touched_at)",
+            # 尚未搬出的內嵌影像（部分索引，計數與分批搬移不需掃全表）
+            "CREATE INDEX IF NOT EXISTS idx_invoices_inline_image ON invoices(id) WHERE image_data IS NOT NULL",
+        ):
+            try:
+                cursor.execute(_trg_sql)
+            except Exception:
+                pass
+        # 背景工作佇列（OCR 批次、PDF 批次轉換）
+        cursor.execute('''CREATE TABLE IF NOT EXISTS jobs
+                        (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                         user_email TEXT NOT NULL,
+                         kind TEXT NOT NULL,
+                         status TEXT NOT NULL,
+                         progress REAL DEFAULT 0,
+                         params TEXT,
+                         result_path TEXT,
+                         error TEXT,
+                         worker TEXT,
+                         heartbeat REAL,
+                         acknowledged INTEGER DEFAULT 0,
+                         created_at TIMESTAMP,
+                         started_at TIMESTAMP,
+                         finished_at TIMESTAMP)''')
+        try:
+            cursor.execute("ALTER TABLE jobs ADD COLUMN heartbeat REAL")
+        except Exception:
+            pass
+        try:
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, id)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_jobs_user_kind ON jobs(user_email, kind, acknowledged)")
+        except Exception:
+            pass
+        # 全文搜尋：FTS5 外部內容表（trigram 支援中文子字串；不支援時退回 unicode61，皆不可用則走 LIKE）
+        _ensure_invoice_fts(cursor)
         
         conn.commit()
         conn.close()
@@ -1471,6 +1611,8 @@ def run_query(query, params=(), is_select=True):
             try:
                 cursor.execute(modified_query, tuple(modified_params))
                 conn.commit()
+                if "INVOICES" in modified_query.upper():
+                    bump_data_version(user_email)
                 # 验证是否真的执行成功
                 if "INSERT" in modified_query.upper():
                     # 对于INSERT，检查影响的行数
@@ -1498,6 +1640,333 @@ def run_query(query, params=(), is_select=True):
                 return run_query(query, params, is_select)
         return pd.DataFrame() if is_select else False
 
+# --- 發票資料快取：每位用戶一個資料版本號，任何寫入即遞增，純 UI rerun 直接取用快取 ---
+class _DataVersions:
+    """行程內各用戶的資料版本號（執行緒安全）。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._versions = {}
+
+    def get(self, user_email):
+        return self._versions.get(user_email, 0)
+
+    def bump(self, user_email):
+        with self._lock:
+            self._versions[user_email] = self._versions.get(user_email, 0) + 1
+            return self._versions[user_email]
+
+
+@st.cache_resource(show_spinner=False)
+def get_data_versions():
+    """取得行程共用的資料版本表（跨 rerun、跨 session 共用）。"""
+    return _DataVersions()
+
+
+def bump_data_version(user_email=None):
+    """標記該用戶發票資料已變更，使 load_user_invoices 快取失效。"""
+    user_email = user_email or st.session_state.get('user_email', 'default_user')
+    return get_data_versions().bump(user_email)
+
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def _load_user_invoices_cached(user_email, db_path, version):
+    """依 (用戶, 資料庫, 版本) 快取的發票資料；version 僅作快取鍵。
+    明列欄位並排除 image_data：舊資料的內嵌影像 BLOB 不進快取（影像改由 image_sha256 / image_path 讀取）。"""
+    is_uri = (db_path.startswith("file:") and "mode=memory" in db_path) or db_path.startswith("file:invoice_mem")
+    conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False, uri=is_uri)
+    try:
+        cols = ", ".join(f'"{r[1]}"' for r in conn.execute("PRAGMA table_info(invoices)") if r[1] != "image_data")
+        return pd.read_sql_query(f"SELECT {cols} FROM invoices WHERE user_email = ? ORDER BY id DESC", conn, params=(user_email,))
+    finally:
+        conn.close()
+
+
+def load_user_invoices(user_email):
+    """取得用戶全部發票（id 由新到舊）。資料庫模式走版本快取；內存模式或讀取失敗時走 run_query。"""
+    if st.session_state.use_memory_mode:
+        return run_query("SELECT * FROM invoices WHERE user_email = ? ORDER BY id DESC", (user_email,))
+    try:
+        return _load_user_invoices_cached(user_email, get_db_path(), get_data_versions().get(user_email))
+    except Exception:
+        # 資料表不存在等情況交給 run_query 處理（自動初始化或切換內存模式）
+        return run_query("SELECT * FROM invoices WHERE user_email = ? ORDER BY id DESC", (user_email,))
+
+
+# --- 列表篩選：將篩選條件編譯為參數化 SQL，只取出符合的發票 id ---
+INVOICE_STATUS_FILTER_PATTERNS = {
+    "正常": ["正常"],
+    "缺失": ["缺失", "缺漏", "❌"],
+}
+
+
+# 已補零的 YYYY/MM/DD 或 YYYY-MM-DD：可直接以 replace(date,'-','/') 字串比較；其餘（未補零、民國等）需經 normalize_date
+_PADDED_DATE_SQL = "(length(date) = 10 AND substr(date, 5, 1) IN ('/', '-') AND substr(date, 8, 1) = substr(date, 5, 1))"
+
+
+def _register_date_functions(conn):
+    """於連線註冊 normalize_date(text)（同 normalize_date_value），供日期篩選與圖表聚合處理非標準日期。"""
+    conn.create_function("normalize_date", 1, normalize_date_value, deterministic=True)
+
+
+def _like_escape(text):
+    """LIKE 參數跳脫（搭配 ESCAPE '\\'）。"""
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+@st.cache_resource(show_spinner=False)
+def _invoice_fts_tokenizer(db_path):
+    """該資料庫 invoices_fts 的 tokenizer（'trigram' / 'unicode61'）；表或同步觸發器不存在回傳 None。"""
+    is_uri = (db_path.startswith("file:") and "mode=memory" in db_path) or db_path.startswith("file:invoice_mem")
+    conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False, uri=is_uri)
+    try:
+        rows = dict(conn.execute("SELECT name, sql FROM sqlite_master WHERE name LIKE 'invoices_fts%'").fetchall())
+    finally:
+        conn.close()
+    if "invoices_fts" not in rows or not {"invoices_fts_ai", "invoices_fts_ad", "invoices_fts_au"} <= set(rows):
+        return None
+    return "trigram" if "trigram" in (rows["invoices_fts"] or "") else "unicode61"
+
+
+def invoice_fts_tokenizer():
+    """目前資料庫可用的全文索引 tokenizer；內存模式或不可用回傳 None（改走 LIKE）。"""
+    if st.session_state.use_memory_mode:
+        return None
+    try:
+        return _invoice_fts_tokenizer(get_db_path())
+    except Exception:
+        return None
+
+
+def _fts_match_query(search, tokenizer):
+    """搜尋字串 → FTS5 MATCH 語法；無法以索引查詢時回傳 None。
+    trigram：整串作為片語即子字串比對（與 LIKE 同語意，需至少 3 字）；unicode61：各詞前綴比對。"""
+    if tokenizer == "trigram":
+        return '"' + search.replace('"', '""') + '"' if len(search) >= 3 else None
+    if tokenizer == "unicode61":
+        terms = search.split()
+        return " ".join('"' + t.replace('"', '""') + '"*' for t in terms) or None
+    return None
+
+
+def compile_invoice_filters(user_email, filters):
+    """篩選條件 → (WHERE 子句, 參數)。filters 鍵：search, status, date_start, date_end, subjects, categories, amount_min, amount_max。
+    search 優先走 invoices_fts 全文索引，不可用或字數不足時退回 LIKE。
+    日期：已補零者以 replace(date,'-','/') 比較（走 idx_invoices_user_date_norm 表達式索引），其餘以 normalize_date 正規化後比較；
+    執行前連線須先經 _register_date_functions。"""
+    clauses = ["user_email = ?"]
+    params = [user_email]
+    search = (filters.get("search") or "").strip()
+    if search:
+        match = _fts_match_query(search, invoice_fts_tokenizer())
+        if match:
+            clauses.append("id IN (SELECT rowid FROM invoices_fts WHERE invoices_fts MATCH ?)")
+            params.append(match)
+        else:
+            pattern = f"%{_like_escape(search)}%"
+            clauses.append("(" + " OR ".join(f"{c} LIKE ? ESCAPE '\\'" for c in INVOICE_FTS_COLUMNS) + ")")
+            params += [pattern] * len(INVOICE_FTS_COLUMNS)
+    patterns = INVOICE_STATUS_FILTER_PATTERNS.get(filters.get("status") or "全部")
+    if patterns:
+        clauses.append("(" + " OR ".join(["status LIKE ?"] * len(patterns)) + ")")
+        params += [f"%{p}%" for p in patterns]
+    if filters.get("date_start") and filters.get("date_end"):
+        start, end = filters["date_start"].strftime("%Y/%m/%d"), (filters["date_end"] + timedelta(days=1)).strftime("%Y/%m/%d")
+        clauses.append(
+            "id IN (SELECT id FROM invoices WHERE user_email = ? AND replace(date, '-', '/') >= ? AND replace(date, '-', '/') < ? "
+            f"AND {_PADDED_DATE_SQL} UNION ALL SELECT id FROM invoices WHERE user_email = ? AND NOT {_PADDED_DATE_SQL} "
+            "AND normalize_date(date) >= ? AND normalize_date(date) < ?)")
+        params += [user_email, start, end, user_email, start, end]
+    for col, key in (("subject", "subjects"), ("category", "categories")):
+        values = list(filters.get(key) or [])
+        if values:
+            clauses.append(f"{col} IN ({','.join('?' * len(values))})")
+            params += values
+    if (filters.get("amount_min") or 0) > 0:
+        clauses.append("total >= ?")
+        params.append(filters["amount_min"])
+    if (filters.get("amount_max") or 0) > 0:
+        clauses.append("total <= ?")
+        params.append(filters["amount_max"])
+    return " AND ".join(clauses), params
+
+
+@st.cache_data(show_spinner=False, max_entries=128)
+def _query_filtered_invoice_ids(db_path, version, where, params):
+    """依 (資料庫, 資料版本, 篩選) 快取的符合 id 清單；version 僅作快取鍵。"""
+    is_uri = (db_path.startswith("file:") and "mode=memory" in db_path) or db_path.startswith("file:invoice_mem")
+    conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False, uri=is_uri)
+    try:
+        _register_date_functions(conn)
+        return [r[0] for r in conn.execute(f"SELECT id FROM invoices WHERE {where}", params)]
+    finally:
+        conn.close()
+
+
+def filter_invoice_ids(user_email, filters):
+    """以 SQL 取得符合篩選的發票 id（set）；內存模式或查詢失敗回傳 None，由呼叫端改用 filter_invoices_frame。"""
+    if st.session_state.use_memory_mode:
+        return None
+    where, params = compile_invoice_filters(user_email, filters)
+    try:
+        return set(_query_filtered_invoice_ids(get_db_path(), get_data_versions().get(user_email), where, tuple(params)))
+    except Exception:
+        return None
+
+
+def search_invoice_ids(user_email, query, limit=None):
+    """全文搜尋（賣方、備註、發票號碼、科目、檔名），回傳符合的 id 清單（由新到舊）；內存模式或失敗回傳 None。"""
+    ids = filter_invoice_ids(user_email, {"search": query})
+    if ids is None:
+        return None
+    ids = sorted(ids, reverse=True)
+    return ids[:limit] if limit else ids
+
+
+def filter_invoices_frame(df, filters):
+    """filter_invoice_ids 的 pandas 版本（中文欄名，內存模式用），條件語意相同。"""
+    mask = pd.Series(True, index=df.index)
+
+    def _col(name):
+        return df[name].fillna("").astype(str) if name in df.columns else pd.Series("", index=df.index)
+
+    search = (filters.get("search") or "").strip().lower()
+    if search:
+        hit = pd.Series(False, index=df.index)
+        for name in ("賣方名稱", "備註", "發票號碼", "會計科目", "檔案名稱"):
+            hit |= _col(name).str.lower().str.contains(search, regex=False)
+        mask &= hit
+    patterns = INVOICE_STATUS_FILTER_PATTERNS.get(filters.get("status") or "全部")
+    if patterns and "狀態" in df.columns:
+        mask &= _col("狀態").str.contains("|".join(map(re.escape, patterns)), regex=True)
+    if filters.get("date_start") and filters.get("date_end") and "日期" in df.columns:
+        d = normalize_date_series(_col("日期"))
+        mask &= (d >= filters["date_start"].strftime("%Y/%m/%d")) & (d < (filters["date_end"] + timedelta(days=1)).strftime("%Y/%m/%d"))
+    for name, key in (("會計科目", "subjects"), ("類型", "categories")):
+        values = list(filters.get(key) or [])
+        if values and name in df.columns:
+            mask &= _col(name).isin(values)
+    if "總計" in df.columns:
+        total_num = pd.to_numeric(_col("總計").str.replace(",", ""), errors="coerce").fillna(0)
+        if (filters.get("amount_min") or 0) > 0:
+            mask &= total_num >= filters["amount_min"]
+        if (filters.get("amount_max") or 0) > 0:
+            mask &= total_num <= filters["amount_max"]
+    return df[mask]
+
+
+INVOICE_PAGE_SIZES = [50, 100, 200, 500]
+GROUP_VIEW_BATCHES_PER_PAGE = 20
+GROUP_VIEW_ROWS_PER_BATCH = 100
+
+
+@st.cache_data(show_spinner=False, max_entries=128)
+def _query_filtered_invoice_summary(db_path, version, where, params):
+    """依 (資料庫, 資料版本, 篩選) 快取的 (筆數, 總計, 稅額)；version 僅作快取鍵。"""
+    is_uri = (db_path.startswith("file:") and "mode=memory" in db_path) or db_path.startswith("file:invoice_mem")
+    conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False, uri=is_uri)
+    try:
+        _register_date_functions(conn)
+        return conn.execute(f"SELECT COUNT(*), COALESCE(SUM(total), 0), COALESCE(SUM(tax), 0) FROM invoices WHERE {where}", params).fetchone()
+    finally:
+        conn.close()
+
+
+def summarize_filtered_invoices(user_email, filters, df=None):
+    """篩選結果的總筆數與金額合計（SQL 聚合整個篩選範圍，不受分頁影響）。內存模式或失敗時以 df（中文欄名）計算。
+    回傳 dict: count, total, tax。"""
+    if not st.session_state.use_memory_mode:
+        where, params = compile_invoice_filters(user_email, filters)
+        try:
+            n, total, tax = _query_filtered_invoice_summary(get_db_path(), get_data_versions().get(user_email), where, tuple(params))
+            return {"count": int(n), "total": float(total), "tax": float(tax)}
+        except Exception:
+            pass
+    if df is None or df.empty:
+        return {"count": 0, "total": 0.0, "tax": 0.0}
+    num = lambda c: pd.to_numeric(df[c].astype(str).str.replace(",", ""), errors="coerce").fillna(0).sum() if c in df.columns else 0.0
+    return {"count": len(df), "total": float(num("總計")), "tax": float(num("稅額"))}
+
+
+def keyset_page(df, cursor=None, page_size=100):
+    """依 id 由新到舊的 keyset 分頁：取 id < cursor 的前 page_size 筆。回傳 (page_df, next_cursor)；無下一頁時 next_cursor 為 None。"""
+    if df.empty or "id" not in df.columns:
+        return df.head(page_size), None
+    ids = pd.to_numeric(df["id"], errors="coerce")
+    if not ids.is_monotonic_decreasing:
+        order = ids.sort_values(ascending=False, kind="stable").index
+        df, ids = df.loc[order], ids.loc[order]
+    if cursor is not None:
+        keep = ids < cursor
+        df, ids = df[keep], ids[keep]
+    page = df.head(page_size)
+    next_cursor = int(ids.iloc[page_size - 1]) if len(df) > page_size else None
+    return page, next_cursor
+
+
+# --- 圖表資料：只把聚合後的小表交給 Altair，規格大小不隨發票數成長 ---
+CHART_TOP_CATEGORIES = 10
+
+
+def _chart_frames(subject_counts, daily_totals, category_counts):
+    """聚合結果 → 三張圖表用的小 DataFrame（會計科目/數量、日期/總計、類型/數量）。
+    daily_totals 的日期需已正規化為 YYYY/MM/DD；解析後同一天若仍有多筆，由 prepare_chart_data 合併。"""
+    from chart_improvements import prepare_chart_data
+    df_pie = pd.DataFrame(subject_counts, columns=["會計科目", "數量"])
+    df_line = pd.DataFrame(daily_totals, columns=["日期", "總計"])
+    df_line["日期"] = pd.to_datetime(df_line["日期"], errors="coerce", format="%Y/%m/%d")
+    df_line, _ = prepare_chart_data(df_line.dropna(subset=["日期"]), "日期", "總計")
+    df_line = df_line.sort_values("日期", ignore_index=True)
+    df_bar = pd.DataFrame(category_counts, columns=["類型", "數量"])
+    df_bar = df_bar.sort_values(["數量", "類型"], ascending=[False, True]).head(CHART_TOP_CATEGORIES)
+    return {"pie": df_pie, "line": df_line, "bar": df_bar}
+
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def _query_chart_aggregates(db_path, version, user_email):
+    """依 (資料庫, 資料版本, 用戶) 快取的圖表聚合；version 僅作快取鍵。"""
+    is_uri = (db_path.startswith("file:") and "mode=memory" in db_path) or db_path.startswith("file:invoice_mem")
+    conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False, uri=is_uri)
+    try:
+        _register_date_functions(conn)
+        grouped = lambda col: conn.execute(
+            f"SELECT {col}, COUNT(*) FROM invoices WHERE user_email = ? AND {col} IS NOT NULL AND {col} != 'No' GROUP BY {col}",
+            (user_email,)).fetchall()
+        # 先正規化日期再分組：已補零者直接替換分隔符，未補零、民國等交給 normalize_date
+        daily = conn.execute(
+            f"SELECT CASE WHEN {_PADDED_DATE_SQL} THEN replace(date, '-', '/') ELSE normalize_date(date) END AS d, "
+            "COALESCE(SUM(total), 0) FROM invoices WHERE user_email = ? AND date IS NOT NULL GROUP BY d", (user_email,)).fetchall()
+        return _chart_frames(grouped("subject"), daily, grouped("category"))
+    finally:
+        conn.close()
+
+
+def chart_aggregates_frame(df):
+    """_query_chart_aggregates 的 pandas 版本（中文欄名，內存模式用），聚合語意相同。"""
+    def _counts(name):
+        if name not in df.columns:
+            return []
+        s = df[name][df[name].notna() & (df[name] != "No")]
+        return list(s.astype(str).value_counts().items())
+
+    daily = []
+    if "日期" in df.columns and "總計" in df.columns:
+        total_num = pd.to_numeric(df["總計"].astype(str).str.replace(",", ""), errors="coerce").fillna(0)
+        day = normalize_date_series(df["日期"])
+        daily = list(total_num.groupby(day).sum().items())
+    return _chart_frames(_counts("會計科目"), daily, _counts("類型"))
+
+
+def get_chart_aggregates(user_email, df=None):
+    """圖表用聚合（會計科目/類型筆數、每日總計）。資料庫模式以 SQL GROUP BY 並依資料版本快取；內存模式或失敗時以 df 計算。"""
+    if not st.session_state.use_memory_mode:
+        try:
+            return _query_chart_aggregates(get_db_path(), get_data_versions().get(user_email), user_email)
+        except Exception:
+            pass
+    return chart_aggregates_frame(df if df is not None else pd.DataFrame())
+
+
 # 程式啟動立即初始化（如果使用數據庫模式）
 if not st.session_state.use_memory_mode:
     init_db()
@@ -1530,26 +1999,219 @@ def extract_json(text):
         
     return None
 
+# --- 發票影像：內容定址儲存（sha256 分層目錄），image_blobs.ref_count 由觸發器維護 ---
+IMAGE_THUMB_SIZE = (320, 320)
+IMAGE_BLOB_GC_GRACE_SEC = 24 * 3600  # 未被引用的影像保留時間（OCR 待確認期間不回收）
+_IMAGE_EXT = {"JPEG": "jpg", "PNG": "png", "WEBP": "webp", "GIF": "gif", "BMP": "bmp", "TIFF": "tif"}
+
+
+def _blob_base(sha256):
+    """影像檔路徑前綴：<image_storage_dir>/blobs/ab/cd/<sha256>。"""
+    return os.path.join(st.session_state.image_storage_dir, "blobs", sha256[:2], sha256[2:4], sha256)
+
+
+def blob_thumbnail_path(sha256):
+    """影像縮圖路徑（WebP；環境不支援時為 JPEG）；尚未產生回傳 None。"""
+    if not sha256:
+        return None
+    for ext in ("webp", "jpg"):
+        p = f"{_blob_base(sha256)}.thumb.{ext}"
+        if os.path.exists(p):
+            return p
+    return None
+
+
+def _file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _write_atomic(path, data):
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def _make_thumbnail(image_obj, base):
+    """產生縮圖（WebP 優先），回傳路徑。"""
+    thumb = image_obj.copy()
+    if thumb.mode not in ("RGB", "RGBA"):
+        thumb = thumb.convert("RGB")
+    thumb.thumbnail(IMAGE_THUMB_SIZE, Image.Resampling.LANCZOS)
+    for fmt, ext in (("WEBP", "webp"), ("JPEG", "jpg")):
+        try:
+            buf = io.BytesIO()
+            (thumb if fmt == "WEBP" else thumb.convert("RGB")).save(buf, format=fmt, quality=75)
+        except Exception:
+            continue
+        path = f"{base}.thumb.{ext}"
+        _write_atomic(path, buf.getvalue())
+        return path
+    return None
+
+
+def store_image_blob(data):
+    """寫入一份影像（bytes 或 PIL Image）：同內容只存一份，並預先產生縮圖；資料庫模式同時登記 image_blobs。
+    回傳 (sha256, path)。"""
+    if isinstance(data, Image.Image):
+        buf = io.BytesIO()
+        fmt = data.format if data.format in _IMAGE_EXT else "PNG"
+        data.save(buf, format=fmt)
+        data = buf.getvalue()
+    sha256 = hashlib.sha256(data).hexdigest()
+    try:
+        image_obj = Image.open(io.BytesIO(data))
+        ext = _IMAGE_EXT.get(image_obj.format, "img")
+    except Exception:
+        image_obj, ext = None, "bin"  # 無法辨識的舊資料照樣保存，只是沒有縮圖
+    base = _blob_base(sha256)
+    path = f"{base}.{ext}"
+    os.makedirs(os.path.dirname(base), exist_ok=True)
+    if not os.path.exists(path) or _file_sha256(path) != sha256:
+        _write_atomic(path, data)
+    thumb_path = blob_thumbnail_path(sha256)
+    if thumb_path is None and image_obj is not None:
+        try:
+            thumb_path = _make_thumbnail(image_obj, base)
+        except Exception:
+            thumb_path = None
+    if not st.session_state.use_memory_mode:
+        # 已存在則刷新 touched_at，避免剛被再次引用的影像被回收
+        db_path = get_db_path()
+        conn = sqlite3.connect(db_path, timeout=30, uri=db_path.startswith("file:") and "mode=memory" in db_path, check_same_thread=False)
+        try:
+            with conn:
+                conn.execute(
+                    """INSERT INTO image_blobs (sha256, path, thumb_path, size, touched_at) VALUES (?,?,?,?,CURRENT_TIMESTAMP)
+                       ON CONFLICT(sha256) DO UPDATE SET path = excluded.path, thumb_path = excluded.thumb_path, touched_at = CURRENT_TIMESTAMP""",
+                    (sha256, path, thumb_path, len(data)))
+        finally:
+            conn.close()
+    return sha256, path
+
+
+def gc_image_blobs(grace_sec=IMAGE_BLOB_GC_GRACE_SEC):
+    """刪除已無發票引用（ref_count = 0）且超過保留時間的影像與縮圖。回傳刪除數量。"""
+    if st.session_state.use_memory_mode:
+        return 0
+    removed = 0
+    try:
+        path = get_db_path()
+        is_uri = path.startswith("file:") and "mode=memory" in path
+        conn = sqlite3.connect(path, timeout=30, uri=is_uri, check_same_thread=False)
+        try:
+            rows = conn.execute(
+                "SELECT sha256, path, thumb_path FROM image_blobs WHERE ref_count <= 0 AND touched_at < datetime('now', ?)",
+                (f"-{int(grace_sec)} seconds",)).fetchall()
+            for sha256, blob_path, thumb_path in rows:
+                # 逐筆以條件刪除，期間若又被引用則略過
+                with conn:
+                    cur = conn.execute("DELETE FROM image_blobs WHERE sha256 = ? AND ref_count <= 0", (sha256,))
+                if cur.rowcount:
+                    for p in (blob_path, thumb_path):
+                        try:
+                            if p:
+                                os.remove(p)
+                        except OSError:
+                            pass
+                    removed += 1
+        finally:
+            conn.close()
+    except Exception:
+        pass
+    return removed
+
+
 def save_invoice_image(image_obj, file_name, user_email=None):
-    """保存發票圖片到文件系統，返回圖片路徑"""
+    """保存發票圖片（原始 bytes 或 PIL Image）至內容定址儲存，回傳 (sha256, 圖片路徑)；失敗回傳 (None, None)。"""
     try:
-        # 創建用戶專屬目錄
-        user_email = user_email or st.session_state.get('user_email', 'default_user')
-        user_dir = os.path.join(st.session_state.image_storage_dir, user_email)
-        os.makedirs(user_dir, exist_ok=True)
-        
-        # 生成唯一文件名（使用時間戳+文件名hash）
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        file_hash = hashlib.md5(file_name.encode()).hexdigest()[:8]
-        safe_filename = f"{timestamp}_{file_hash}_{file_name}"
-        safe_filename = "".join(c for c in safe_filename if c.isalnum() or c in "._-")
-        
-        image_path = os.path.join(user_dir, safe_filename)
-        image_obj.save(image_path)
-        return image_path
+        return store_image_blob(image_obj)
     except Exception as e:
         st.error(f"保存圖片失敗: {str(e)}")
-        return None
+        return None, None
+
+
+# --- 舊資料搬移：invoices.image_data 內嵌影像 → 內容定址儲存（可中斷、可續跑）---
+IMAGE_MIGRATION_BATCH = 50
+
+
+def count_inline_images():
+    """資料庫中仍內嵌於 image_data 的發票數（走 idx_invoices_inline_image 部分索引）。內存模式或失敗回傳 0。"""
+    if st.session_state.use_memory_mode:
+        return 0
+    try:
+        path = get_db_path()
+        conn = sqlite3.connect(path, timeout=30, uri=path.startswith("file:") and "mode=memory" in path, check_same_thread=False)
+        try:
+            return conn.execute("SELECT COUNT(*) FROM invoices WHERE image_data IS NOT NULL").fetchone()[0]
+        finally:
+            conn.close()
+    except Exception:
+        return 0
+
+
+def migrate_inline_images(batch_size=IMAGE_MIGRATION_BATCH, on_progress=None, compact=True):
+    """將 image_data 分批寫入影像儲存：寫檔 → 讀回比對 sha256 → 設定 image_sha256/image_path 並清空 image_data，
+    每批一個交易並釋放空頁（auto_vacuum=INCREMENTAL 時），並遞增受影響用戶的資料版本，讓快取改用新的影像欄位。
+    中斷後重跑會從尚未清空的列繼續。
+    compact=True 且資料庫尚非 INCREMENTAL 時，全部搬完後執行一次 VACUUM 並切換為 INCREMENTAL。
+    回傳 dict：migrated, failed, bytes, errors, vacuumed。"""
+    stats = {"migrated": 0, "failed": 0, "bytes": 0, "errors": [], "vacuumed": False}
+    if st.session_state.use_memory_mode:
+        stats["errors"].append("內存模式無需搬移")
+        return stats
+    path = get_db_path()
+    conn = sqlite3.connect(path, timeout=30, uri=path.startswith("file:") and "mode=memory" in path, check_same_thread=False)
+    try:
+        total = conn.execute("SELECT COUNT(*) FROM invoices WHERE image_data IS NOT NULL").fetchone()[0]
+        incremental = conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+        last_id = 0
+        while True:
+            rows = conn.execute(
+                "SELECT id, user_email, image_data FROM invoices WHERE image_data IS NOT NULL AND id > ? ORDER BY id LIMIT ?",
+                (last_id, batch_size)).fetchall()
+            if not rows:
+                break
+            updates = []
+            owners = set()
+            for inv_id, owner, blob in rows:
+                last_id = inv_id
+                data = bytes(blob)
+                try:
+                    sha256, blob_path = store_image_blob(data)
+                    if sha256 != hashlib.sha256(data).hexdigest() or _file_sha256(blob_path) != sha256:
+                        raise ValueError("寫入後雜湊不符")
+                except Exception as e:
+                    stats["failed"] += 1
+                    stats["errors"].append(f"ID {inv_id}: {e}")
+                    continue
+                updates.append((sha256, blob_path, inv_id))
+                owners.add(owner)
+                stats["bytes"] += len(data)
+            with conn:
+                conn.executemany(
+                    "UPDATE invoices SET image_sha256 = ?, image_path = ?, image_data = NULL WHERE id = ? AND image_data IS NOT NULL",
+                    updates)
+            for owner in owners:
+                bump_data_version(owner)
+            if incremental:
+                conn.executescript("PRAGMA incremental_vacuum;")  # executescript 才會跑完所有步驟（execute 每次只釋放一頁）
+            stats["migrated"] += len(updates)
+            if on_progress:
+                on_progress(stats["migrated"] + stats["failed"], total)
+        if compact and not incremental and stats["migrated"] and not stats["failed"]:
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("VACUUM")
+            stats["vacuumed"] = True
+    except Exception as e:
+        stats["errors"].append(str(e))
+    finally:
+        conn.close()
+    return stats
 
 def create_batch(user_email, source):
     """建立一筆上傳組（Batch），回傳 batch_id。source 為 'ocr' 或 'import'。"""
@@ -1628,14 +2290,59 @@ def get_batches_for_user(user_email=None):
         return []
 
 
-def get_invoices_by_batch(batch_id, user_email=None):
-    """取得指定 Batch 下的發票（說明書 § 三：按組顯示用）。回傳已重命名欄位的 DataFrame。"""
+def get_batch_summaries(user_email=None):
+    """各組張數、總計、稅額（單一聚合查詢，不載入明細）。只回傳有發票的組，依建立時間新到舊；
+    另回傳未分組摘要。回傳 (batches, ungrouped)，batches 為 list of dict: id, source, created_at, invoice_count, total_sum, tax_sum。"""
+    user_email = user_email or st.session_state.get('user_email', 'default_user')
+    if st.session_state.use_memory_mode:
+        invs = pd.DataFrame([inv for inv in st.session_state.local_invoices
+                             if inv.get('user_email', inv.get('user_id', '')) == user_email])
+        agg = {}
+        if not invs.empty:
+            bid = invs['batch_id'] if 'batch_id' in invs.columns else pd.Series(None, index=invs.index)
+            invs = invs.assign(_bid=bid.where(bid.notna() & (bid != ''), -1),
+                               _total=pd.to_numeric(invs.get('total', 0), errors='coerce').fillna(0),
+                               _tax=pd.to_numeric(invs.get('tax', 0), errors='coerce').fillna(0))
+            agg = invs.groupby('_bid').agg(n=('_total', 'size'), t=('_total', 'sum'), x=('_tax', 'sum')).to_dict('index')
+        batches = []
+        for b in sorted((b for b in st.session_state.local_batches if b.get('user_email') == user_email),
+                        key=lambda x: x.get('created_at', ''), reverse=True):
+            s = agg.get(b.get('id'))
+            if s:
+                batches.append({'id': b['id'], 'source': b.get('source'), 'created_at': b.get('created_at'),
+                                'invoice_count': int(s['n']), 'total_sum': float(s['t']), 'tax_sum': float(s['x'])})
+        s = agg.get(-1) or {'n': 0, 't': 0.0, 'x': 0.0}
+        return batches, {'invoice_count': int(s['n']), 'total_sum': float(s['t']), 'tax_sum': float(s['x'])}
+    try:
+        path = get_db_path()
+        is_uri = path.startswith("file:") and "mode=memory" in path
+        conn = sqlite3.connect(path, timeout=30, uri=is_uri, check_same_thread=False)
+        try:
+            rows = conn.execute("""
+                SELECT b.id, b.source, b.created_at, COUNT(i.id), COALESCE(SUM(i.total), 0), COALESCE(SUM(i.tax), 0)
+                FROM batches b JOIN invoices i ON i.batch_id = b.id AND i.user_email = b.user_email
+                WHERE b.user_email = ? GROUP BY b.id ORDER BY b.created_at DESC, b.id DESC
+            """, (user_email,)).fetchall()
+            ug = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(total), 0), COALESCE(SUM(tax), 0) FROM invoices "
+                "WHERE (batch_id IS NULL OR batch_id = '') AND user_email = ?", (user_email,)).fetchone()
+        finally:
+            conn.close()
+        batches = [{'id': r[0], 'source': r[1], 'created_at': r[2], 'invoice_count': r[3],
+                    'total_sum': float(r[4] or 0), 'tax_sum': float(r[5] or 0)} for r in rows]
+        return batches, {'invoice_count': ug[0], 'total_sum': float(ug[1] or 0), 'tax_sum': float(ug[2] or 0)}
+    except Exception:
+        return [], {'invoice_count': 0, 'total_sum': 0.0, 'tax_sum': 0.0}
+
+
+def get_invoices_by_batch(batch_id, user_email=None, limit=None):
+    """取得指定 Batch 下的發票（說明書 § 三：按組顯示用）。limit 為最多筆數（None 為全部）。回傳已重命名欄位的 DataFrame。"""
     user_email = user_email or st.session_state.get('user_email', 'default_user')
     mapping = {"file_name":"檔案名稱","date":"日期","invoice_number":"發票號碼","seller_name":"賣方名稱","seller_ubn":"賣方統編",
                "subtotal":"銷售額","tax":"稅額","total":"總計","category":"類型","subject":"會計科目","status":"狀態","note":"備註","created_at":"建立時間"}
     if st.session_state.use_memory_mode:
         rows = [inv for inv in st.session_state.local_invoices 
-                if inv.get('batch_id') == batch_id and inv.get('user_email', inv.get('user_id', '')) == user_email]
+                if inv.get('batch_id') == batch_id and inv.get('user_email', inv.get('user_id', '')) == user_email][:limit]
         if not rows:
             return pd.DataFrame()
         df = pd.DataFrame(rows)
@@ -1646,7 +2353,7 @@ def get_invoices_by_batch(batch_id, user_email=None):
         is_uri = path.startswith("file:") and "mode=memory" in path
         conn = sqlite3.connect(path, timeout=30, uri=is_uri, check_same_thread=False)
         cursor = conn.cursor()
-        cursor.execute("SELECT * FROM invoices WHERE batch_id = ? AND user_email = ? ORDER BY id", (batch_id, user_email))
+        cursor.execute("SELECT * FROM invoices WHERE batch_id = ? AND user_email = ? ORDER BY id LIMIT ?", (batch_id, user_email, -1 if limit is None else limit))
         cols = [d[0] for d in cursor.description]
         rows = cursor.fetchall()
         conn.close()
@@ -1681,19 +2388,22 @@ def delete_batch_cascade(batch_id, user_email=None):
         cursor.execute("DELETE FROM batches WHERE id = ? AND user_email = ?", (batch_id, user_email))
         conn.commit()
         conn.close()
+        if deleted:
+            bump_data_version(user_email)
+            gc_image_blobs()
         return True, deleted, None
     except Exception as e:
         return False, 0, str(e)
 
 
-def get_ungrouped_invoices(user_email=None):
-    """取得未分組發票（batch_id 為 NULL）。回傳已重命名欄位的 DataFrame。"""
+def get_ungrouped_invoices(user_email=None, limit=None):
+    """取得未分組發票（batch_id 為 NULL）。limit 為最多筆數（None 為全部）。回傳已重命名欄位的 DataFrame。"""
     user_email = user_email or st.session_state.get('user_email', 'default_user')
     mapping = {"file_name":"檔案名稱","date":"日期","invoice_number":"發票號碼","seller_name":"賣方名稱","seller_ubn":"賣方統編",
                "subtotal":"銷售額","tax":"稅額","total":"總計","category":"類型","subject":"會計科目","status":"狀態","note":"備註","created_at":"建立時間"}
     if st.session_state.use_memory_mode:
         rows = [inv for inv in st.session_state.local_invoices 
-                if (inv.get('batch_id') is None or inv.get('batch_id') == '') and inv.get('user_email', inv.get('user_id', '')) == user_email]
+                if (inv.get('batch_id') is None or inv.get('batch_id') == '') and inv.get('user_email', inv.get('user_id', '')) == user_email][:limit]
         if not rows:
             return pd.DataFrame()
         df = pd.DataFrame(rows)
@@ -1704,7 +2414,7 @@ def get_ungrouped_invoices(user_email=None):
         is_uri = path.startswith("file:") and "mode=memory" in path
         conn = sqlite3.connect(path, timeout=30, uri=is_uri, check_same_thread=False)
         cursor = conn.cursor()
-        cursor.execute("SELECT * FROM invoices WHERE (batch_id IS NULL OR batch_id = '') AND user_email = ? ORDER BY id", (user_email,))
+        cursor.execute("SELECT * FROM invoices WHERE (batch_id IS NULL OR batch_id = '') AND user_email = ? ORDER BY id LIMIT ?", (user_email, -1 if limit is None else limit))
         cols = [d[0] for d in cursor.description]
         rows = cursor.fetchall()
         conn.close()
@@ -1770,6 +2480,444 @@ def normalize_invoice_number(raw):
     return digits[-8:]
 
 
+# --- 賣方主檔：每位用戶依統編記住正式名稱、上次科目/類型與統編驗證結果 ---
+SELLER_UNSET = ("", "No", "N/A")
+
+
+def _seller_key(ubn):
+    """統編 → 主檔鍵（去空白）；無統編回傳 None。"""
+    s = "" if ubn is None or (isinstance(ubn, float) and pd.isna(ubn)) else str(ubn).strip()
+    return None if s in SELLER_UNSET else s
+
+
+def _seller_version_key(user_email):
+    return ("sellers", user_email)
+
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def _load_seller_map_cached(user_email, db_path, version):
+    """依 (用戶, 資料庫, 主檔版本) 快取的賣方主檔；version 僅作快取鍵。"""
+    is_uri = (db_path.startswith("file:") and "mode=memory" in db_path) or db_path.startswith("file:invoice_mem")
+    conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False, uri=is_uri)
+    try:
+        rows = conn.execute(
+            "SELECT seller_ubn, canonical_name, last_subject, last_category, ubn_valid FROM sellers WHERE user_email = ?",
+            (user_email,)).fetchall()
+    finally:
+        conn.close()
+    return {r[0]: {"name": r[1], "subject": r[2], "category": r[3], "ubn_valid": bool(r[4])} for r in rows}
+
+
+def get_seller_map(user_email):
+    """取得用戶賣方主檔 {統編: {name, subject, category, ubn_valid}}；資料庫模式走版本快取，失敗回傳空 dict。"""
+    if st.session_state.use_memory_mode:
+        return {ubn: dict(v) for (email, ubn), v in st.session_state.get("local_sellers", {}).items() if email == user_email}
+    try:
+        return _load_seller_map_cached(user_email, get_db_path(), get_data_versions().get(_seller_version_key(user_email)))
+    except Exception:
+        return {}
+
+
+def upsert_sellers(user_email, records):
+    """儲存/導入後更新賣方主檔。records 為含 seller_ubn, seller_name, subject, category 的 dict 序列（後者覆蓋前者）。
+    同一統編只驗證一次。回傳 (更新筆數, 錯誤訊息)。"""
+    latest, counts = {}, {}
+    for rec in records:
+        ubn = _seller_key(rec.get("seller_ubn"))
+        if ubn is None:
+            continue
+        prev = latest.get(ubn, {})
+        pick = lambda k: rec.get(k) if _seller_key(rec.get(k)) is not None else prev.get(k)
+        latest[ubn] = {"seller_name": pick("seller_name"), "subject": pick("subject"), "category": pick("category")}
+        counts[ubn] = counts.get(ubn, 0) + 1
+    if not latest:
+        return 0, None
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    if st.session_state.use_memory_mode:
+        store = st.session_state.setdefault("local_sellers", {})
+        for ubn, v in latest.items():
+            old = store.get((user_email, ubn), {})
+            store[(user_email, ubn)] = {"name": v["seller_name"] or old.get("name"), "subject": v["subject"] or old.get("subject"),
+                                        "category": v["category"] or old.get("category"), "ubn_valid": validate_ubn(ubn)[0]}
+        return len(latest), None
+    rows = [(user_email, ubn, v["seller_name"], v["subject"], v["category"], int(validate_ubn(ubn)[0]), counts[ubn], now)
+            for ubn, v in latest.items()]
+    try:
+        path = get_db_path()
+        is_uri = path.startswith("file:") and "mode=memory" in path
+        conn = sqlite3.connect(path, timeout=30, uri=is_uri, check_same_thread=False)
+        try:
+            with conn:
+                conn.executemany(
+                    """INSERT INTO sellers (user_email, seller_ubn, canonical_name, last_subject, last_category, ubn_valid, use_count, updated_at)
+                       VALUES (?,?,?,?,?,?,?,?)
+                       ON CONFLICT(user_email, seller_ubn) DO UPDATE SET
+                         canonical_name = COALESCE(excluded.canonical_name, canonical_name),
+                         last_subject = COALESCE(excluded.last_subject, last_subject),
+                         last_category = COALESCE(excluded.last_category, last_category),
+                         ubn_valid = excluded.ubn_valid,
+                         use_count = use_count + excluded.use_count,
+                         updated_at = excluded.updated_at""",
+                    rows,
+                )
+        finally:
+            conn.close()
+        get_data_versions().bump(_seller_version_key(user_email))
+        return len(rows), None
+    except Exception as e:
+        return 0, str(e)
+
+
+def apply_seller_defaults(records, seller_map, defaults=None):
+    """以賣方主檔補齊導入資料（invoices 欄位的 DataFrame）：賣方名稱缺漏時用正式名稱，
+    科目/類型仍為預設值時用上次設定。defaults 為 {欄位: 預設值}，預設 subject=雜項、category=其他。"""
+    if records.empty or not seller_map:
+        return records
+    defaults = defaults or {"subject": "雜項", "category": "其他"}
+    ubn = records["seller_ubn"].astype(str).str.strip()
+    known = ubn.isin(list(seller_map))
+    if not known.any():
+        return records
+    records = records.copy()
+    for col, field, unset in (("seller_name", "name", list(SELLER_UNSET)),
+                              ("subject", "subject", [defaults.get("subject")]),
+                              ("category", "category", [defaults.get("category")])):
+        fill = ubn.map(lambda u: (seller_map.get(u) or {}).get(field))
+        mask = known & records[col].isin(unset) & fill.notna()
+        records.loc[mask, col] = fill[mask]
+    return records
+
+
+# --- 批次導入（CSV / Excel / 電子發票平台匯出）---
+# 標準欄位 → 可能的欄名（含財政部電子發票整合服務平台 CSV 欄名）；依序取第一個存在的欄位
+IMPORT_COLUMN_ALIASES = {
+    "檔案名稱": ["檔案名稱", "file_name", "檔名", "文件名"],
+    "日期": ["日期", "date", "Date", "發票日期"],
+    "發票號碼": ["發票號碼", "invoice_number", "invoice_no", "發票號"],
+    "賣方名稱": ["賣方名稱", "seller_name", "賣方", "商家名稱", "商店店名", "商店名稱"],
+    "賣方統編": ["賣方統編", "seller_ubn", "統編", "統一編號", "商店統編", "賣方統一編號"],
+    "銷售額": ["銷售額", "subtotal", "未稅金額"],
+    "稅額": ["稅額", "tax", "Tax"],
+    "總計": ["總計", "total", "Total", "金額", "總金額", "消費金額", "發票金額"],
+    "類型": ["類型", "category", "Category"],
+    "會計科目": ["會計科目", "subject", "Subject", "科目"],
+    "備註": ["備註", "note", "Note", "备注", "備注"],
+    "發票狀態": ["發票狀態"],
+}
+IMPORT_REQUIRED_FIELDS = ["日期", "發票號碼", "總計"]
+IMPORT_CHUNK_SIZE = 2000
+
+
+def _sniff_text_encoding(raw):
+    """判斷上傳文字檔編碼：UTF-8（含 BOM）優先，否則視為 Big5（cp950，政府平台常見）。"""
+    sample = raw[:1 << 20]
+    try:
+        sample.decode("utf-8")
+        return "utf-8-sig"
+    except UnicodeDecodeError as e:
+        # 取樣截斷在多位元組字元中間不算錯
+        if e.start >= len(sample) - 3 and len(raw) > len(sample):
+            return "utf-8-sig"
+        return "cp950"
+
+
+# 財政部電子發票整合服務平台「載具發票」匯出：以 | 分隔，M 行為發票表頭、D 行為消費明細
+MOF_EINVOICE_M_FIELDS = ["載具名稱", "載具號碼", "發票日期", "商店統編", "商店店名", "發票號碼", "總金額", "發票狀態"]
+MOF_EINVOICE_D_FIELDS = ["發票號碼", "小計", "品項名稱"]
+
+
+def is_mof_einvoice_file(raw):
+    """判斷是否為財政部平台 M/D 明細檔（首個非空行為「表頭=M|」或「M|」開頭）。"""
+    head = raw[:4096].decode(_sniff_text_encoding(raw[:4096]), errors="ignore").lstrip("\ufeff")
+    for line in head.splitlines():
+        line = line.strip()
+        if line:
+            return line.startswith(("表頭=", "M|"))
+    return False
+
+
+def _mof_layout(lines, prefix, default_fields):
+    """依檔頭「表頭=M|…」/「明細=D|…」取得欄位順序；沒有檔頭時使用預設順序。"""
+    for line in lines:
+        if line.startswith(prefix):
+            fields = [f.strip() for f in line.split("=", 1)[1].split("|")[1:] if f.strip()]
+            if all(f in fields for f in default_fields):
+                return fields
+    return default_fields
+
+
+def parse_mof_einvoice(raw, file_name="電子發票平台匯出"):
+    """解析財政部平台 M/D 明細檔為 DataFrame（欄名對應 IMPORT_COLUMN_ALIASES）。
+    同一張發票的 D 行彙整到備註；總金額含稅，稅額以 5% 內含回推。"""
+    text = raw.decode(_sniff_text_encoding(raw), errors="replace").lstrip("\ufeff")
+    lines = [ln.strip() for ln in text.splitlines() if ln.strip()]
+    m_fields = _mof_layout(lines[:5], "表頭=", MOF_EINVOICE_M_FIELDS)
+    d_fields = _mof_layout(lines[:5], "明細=", MOF_EINVOICE_D_FIELDS)
+    m_rows = [ln.split("|")[1:len(m_fields) + 1] for ln in lines if ln.startswith("M|")]
+    d_rows = [ln.split("|")[1:len(d_fields) + 1] for ln in lines if ln.startswith("D|")]
+    if not m_rows:
+        return pd.DataFrame(columns=["檔案名稱"] + MOF_EINVOICE_M_FIELDS)
+
+    head = pd.DataFrame(m_rows, columns=m_fields).fillna("")
+    head = head.apply(lambda s: s.str.strip())
+    head["發票號碼"] = head["發票號碼"].str.upper()
+    total = pd.to_numeric(head["總金額"].str.replace(",", "", regex=False), errors="coerce").fillna(0.0)
+    tax = (total - total / 1.05).round()
+    head["總金額"] = total
+    head["稅額"] = tax
+    head["銷售額"] = total - tax
+    head["發票日期"] = normalize_date_series(head["發票日期"])
+    head["檔案名稱"] = file_name
+
+    if d_rows:
+        detail = pd.DataFrame(d_rows, columns=d_fields).fillna("")
+        detail = detail.apply(lambda s: s.str.strip())
+        detail["發票號碼"] = detail["發票號碼"].str.upper()
+        detail["品項"] = detail["品項名稱"] + " " + detail["小計"]
+        items = detail.groupby("發票號碼", sort=False)["品項"].agg("、".join)
+        head["備註"] = head["發票號碼"].map(items).fillna("")
+    else:
+        head["備註"] = ""
+    carrier = head["載具名稱"] + " " + head["載具號碼"]
+    head["備註"] = ("載具：" + carrier.str.strip()).where(carrier.str.strip() != "", "") \
+        .str.cat(head["備註"], sep="；").str.strip("；")
+    return head
+
+
+def iter_import_chunks(uploaded_file, chunksize=IMPORT_CHUNK_SIZE):
+    """依副檔名逐塊讀取 CSV / Excel / 財政部平台明細檔（所有欄位以字串讀入，不做型別推斷）。"""
+    name = (getattr(uploaded_file, "name", "") or "").lower()
+    if name.endswith((".xlsx", ".xlsm")):
+        # openpyxl 不支援分段讀取：讀入後再切塊交給後續流程
+        df = pd.read_excel(uploaded_file, dtype=str)
+        for start in range(0, len(df), chunksize):
+            yield df.iloc[start:start + chunksize]
+        return
+    raw = uploaded_file.getvalue() if hasattr(uploaded_file, "getvalue") else uploaded_file.read()
+    if is_mof_einvoice_file(raw):
+        # M/D 需跨行彙整，整檔解析後再切塊
+        df = parse_mof_einvoice(raw, getattr(uploaded_file, "name", None) or "電子發票平台匯出")
+        for start in range(0, len(df), chunksize):
+            yield df.iloc[start:start + chunksize]
+        return
+    yield from pd.read_csv(
+        io.BytesIO(raw),
+        chunksize=chunksize,
+        dtype=str,
+        keep_default_na=False,
+        encoding=_sniff_text_encoding(raw),
+    )
+
+
+def map_import_columns(columns):
+    """依 IMPORT_COLUMN_ALIASES 建立欄名對照（只需對第一個區塊計算一次）。回傳 rename dict。"""
+    cols = [str(c).strip() for c in columns]
+    rename = {}
+    for standard_name, possible_names in IMPORT_COLUMN_ALIASES.items():
+        for possible_name in possible_names:
+            if possible_name in cols:
+                rename[columns[cols.index(possible_name)]] = standard_name
+                break
+    return rename
+
+
+# (樣式, 是否民國年)：依序比對，先符合者為準
+_DATE_PATTERNS = (
+    (r"^(\d{4})/(\d{1,2})/(\d{1,2})", False),
+    (r"^(\d{4})(\d{2})(\d{2})$", False),
+    (r"^(\d{2,3})/(\d{1,2})/(\d{1,2})$", True),
+    (r"^(\d{3})(\d{2})(\d{2})$", True),
+)
+
+
+def normalize_date_value(value):
+    """normalize_date_series 的單值版本（SQLite 自訂函式 normalize_date 使用）。"""
+    s = "" if value is None else str(value).strip()
+    t = re.sub(r"[-.年月]", "/", s).replace("日", "")
+    for pattern, roc in _DATE_PATTERNS:
+        m = re.match(pattern, t)
+        if m:
+            return f"{int(m.group(1)) + (1911 if roc else 0)}/{m.group(2).zfill(2)}/{m.group(3).zfill(2)}"
+    return s
+
+
+def normalize_date_series(s, default=None):
+    """向量化日期正規化為 YYYY/MM/DD：支援 YYYY-MM-DD、YYYY/M/D、YYYYMMDD 與民國 YYY/MM/DD、YYYMMDD；無法辨識者保留原字串。"""
+    s = s.fillna("").astype(str).str.strip()
+    t = s.str.replace(r"[-.年月]", "/", regex=True).str.replace("日", "", regex=False)
+    out = pd.Series(pd.NA, index=s.index, dtype="object")
+    for pattern, roc in _DATE_PATTERNS:
+        m = t.str.extract(pattern)
+        ok = m[0].notna() & out.isna()
+        if not ok.any():
+            continue
+        year = pd.to_numeric(m.loc[ok, 0]) + (1911 if roc else 0)
+        out.loc[ok] = (
+            year.astype(int).astype(str) + "/"
+            + m.loc[ok, 1].str.zfill(2) + "/"
+            + m.loc[ok, 2].str.zfill(2)
+        )
+    out = out.where(out.notna(), s)
+    if default is not None:
+        out = out.where(out != "", default)
+    return out
+
+
+def normalize_import_chunk(chunk):
+    """將已對照欄名的區塊向量化整理為 invoices 欄位（字串去空白、金額去千分位與 $、日期正規化）。作廢發票會被排除。"""
+    def _str(col, default):
+        if col not in chunk.columns:
+            return pd.Series(default, index=chunk.index, dtype="object")
+        s = chunk[col].fillna("").astype(str).str.strip()
+        return s.where(s != "", default)
+
+    def _num(col):
+        if col not in chunk.columns:
+            return pd.Series(0.0, index=chunk.index)
+        s = chunk[col].fillna("").astype(str).str.replace(r"[,$\s]", "", regex=True)
+        return pd.to_numeric(s, errors="coerce").fillna(0.0)
+
+    invoice_number = _str("發票號碼", "").str.upper()
+    out = pd.DataFrame({
+        "file_name": _str("檔案名稱", "導入數據"),
+        "date": normalize_date_series(_str("日期", ""), default=datetime.now().strftime("%Y/%m/%d")),
+        "invoice_number": invoice_number.where(~invoice_number.isin(["", "N/A"]), "No"),
+        "seller_name": _str("賣方名稱", "No"),
+        "seller_ubn": _str("賣方統編", "No"),
+        "subtotal": _num("銷售額"),
+        "tax": _num("稅額"),
+        "total": _num("總計"),
+        "category": _str("類型", "其他"),
+        "subject": _str("會計科目", "雜項"),
+        "status": "✅ 正常",
+        "note": _str("備註", ""),
+        "tax_type": "5%",
+    }, index=chunk.index)
+    if "發票狀態" in chunk.columns:
+        out = out[~chunk["發票狀態"].fillna("").astype(str).str.contains("作廢", regex=False)]
+    return out
+
+
+def get_existing_invoice_keys(user_email, invoice_numbers):
+    """批次查詢已存在的 (發票號碼, 日期)，供導入去重。invoice_numbers 為已正規化（大寫）的號碼；
+    資料庫中的舊資料可能是小寫號碼或 YYYY-MM-DD、未補零、民國日期，回傳前一律以大寫號碼與 normalize_date_series 正規化，
+    與 normalize_import_chunk 的輸出一致。"""
+    numbers = sorted({n for n in invoice_numbers if n and n not in ("No", "N/A")})
+    if not numbers:
+        return set()
+    rows = []
+    if st.session_state.use_memory_mode:
+        wanted = set(numbers)
+        for inv in st.session_state.local_invoices:
+            if inv.get('user_email', inv.get('user_id', 'default_user')) == user_email and str(inv.get('invoice_number') or '').strip().upper() in wanted:
+                rows.append((inv.get('invoice_number'), inv.get('date')))
+    else:
+        # 一併查小寫號碼，仍可使用 idx_invoices_user_number
+        candidates = sorted(set(numbers) | {n.lower() for n in numbers})
+        path = get_db_path()
+        is_uri = path.startswith("file:") and "mode=memory" in path
+        conn = sqlite3.connect(path, timeout=30, uri=is_uri, check_same_thread=False)
+        try:
+            cursor = conn.cursor()
+            for start in range(0, len(candidates), 500):
+                part = candidates[start:start + 500]
+                cursor.execute(
+                    f"SELECT invoice_number, date FROM invoices WHERE user_email = ? AND invoice_number IN ({','.join('?' * len(part))})",
+                    [user_email] + part,
+                )
+                rows.extend(cursor.fetchall())
+        finally:
+            conn.close()
+    if not rows:
+        return set()
+    found = pd.DataFrame(rows, columns=["invoice_number", "date"])
+    return set(zip(found["invoice_number"].fillna("").astype(str).str.strip().str.upper(), normalize_date_series(found["date"])))
+
+
+def bulk_insert_invoices(records, user_email, batch_id=None):
+    """整批寫入發票（單一交易，executemany）。records 為 normalize_import_chunk 的輸出。回傳 (inserted_count, error_message)。"""
+    if records.empty:
+        return 0, None
+    cols = ["file_name", "date", "invoice_number", "seller_name", "seller_ubn", "subtotal", "tax", "total",
+            "category", "subject", "status", "note", "tax_type"]
+    if st.session_state.use_memory_mode:
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        next_id = len(st.session_state.local_invoices) + 1
+        for i, rec in enumerate(records[cols].to_dict("records")):
+            rec.update({'id': next_id + i, 'user_email': user_email, 'image_path': None,
+                        'created_at': now, 'batch_id': batch_id})
+            st.session_state.local_invoices.append(rec)
+        return len(records), None
+    try:
+        path = get_db_path()
+        is_uri = path.startswith("file:") and "mode=memory" in path
+        conn = sqlite3.connect(path, timeout=30, uri=is_uri, check_same_thread=False)
+        try:
+            rows = [(user_email, *r, batch_id) for r in records[cols].itertuples(index=False, name=None)]
+            with conn:
+                conn.executemany(
+                    f"INSERT INTO invoices (user_email, {', '.join(cols)}, batch_id) VALUES ({','.join('?' * (len(cols) + 2))})",
+                    rows,
+                )
+        finally:
+            conn.close()
+        bump_data_version(user_email)
+        return len(rows), None
+    except Exception as e:
+        return 0, str(e)
+
+
+def import_invoice_chunks(chunks, user_email, batch_source=None, on_progress=None):
+    """導入管線：欄名對照（一次）→ 向量化整理 → 批次去重（資料庫 + 檔案內）→ 整批寫入。
+    batch_source 有值時，於必填欄位檢查通過後建立 Batch（邏輯架構說明書：上傳前先建立 Batch）。
+    回傳 dict：imported, duplicates, skipped, errors, invalid_ubn, missing_fields, error。"""
+    stats = {"imported": 0, "duplicates": 0, "skipped": 0, "errors": 0, "invalid_ubn": 0,
+             "missing_fields": [], "error": None}
+    rename = None
+    seen = set()
+    processed = 0
+    seller_map = get_seller_map(user_email)
+    for chunk in chunks:
+        if rename is None:
+            rename = map_import_columns(list(chunk.columns))
+            missing = [f for f in IMPORT_REQUIRED_FIELDS if f not in rename.values()]
+            if missing:
+                stats["missing_fields"] = missing
+                return stats
+            batch_id = create_batch(user_email, batch_source) if batch_source else None
+        chunk = chunk.rename(columns=rename)
+        records = apply_seller_defaults(normalize_import_chunk(chunk), seller_map)
+        stats["skipped"] += len(chunk) - len(records)
+        processed += len(chunk)
+
+        # 統編格式檢查：只對不重複的值呼叫 validate_ubn，不符者照常導入但計數提醒
+        ubns = records["seller_ubn"][records["seller_ubn"] != "No"]
+        bad = {u for u in ubns.unique() if not validate_ubn(u)[0]}
+        stats["invalid_ubn"] += int(ubns.isin(bad).sum())
+
+        # 去重：無號碼（No / N/A）不參與比對
+        keyed = ~records["invoice_number"].isin(["No", "N/A"])
+        keys = pd.Series(list(zip(records["invoice_number"], records["date"])), index=records.index)
+        existing = get_existing_invoice_keys(user_email, records.loc[keyed, "invoice_number"])
+        dup_mask = keyed & (keys.isin(existing | seen) | keys.duplicated(keep="first"))
+        stats["duplicates"] += int(dup_mask.sum())
+        records = records[~dup_mask]
+        seen.update(keys[keyed & ~dup_mask])
+
+        inserted, err = bulk_insert_invoices(records, user_email, batch_id)
+        stats["imported"] += inserted
+        if err:
+            stats["errors"] += len(records)
+            stats["error"] = err
+        elif inserted:
+            upsert_sellers(user_email, records[["seller_ubn", "seller_name", "subject", "category"]].to_dict("records"))
+        if on_progress:
+            on_progress(processed, stats)
+    if rename is None:
+        stats["error"] = "文件為空，請檢查文件內容"
+    return stats
+
+
 # 財政部統一發票中獎號碼（新站）：僅兩頁
 # https://invoice.etax.nat.gov.tw/index.html = 最新一期，lastNumber.html = 上一期
 LOTTERY_ETAX_LATEST = "https://invoice.etax.nat.gov.tw/index.html"
@@ -1843,6 +2991,88 @@ def _should_refresh_lottery(cached_draw):
     return datetime.now().date() >= next_draw_date
 
 
+def lottery_period_range(period_label):
+    """民國雙月期別（如「114年 11 ~ 12 月」）→ (起日, 迄日次日)，皆為 date；無法解析回傳 None。"""
+    m = re.search(r"(\d{3})年\s*(\d{1,2})\s*[~～\-]\s*(\d{1,2})\s*月", period_label or "")
+    if not m:
+        return None
+    year_ad = int(m.group(1)) + 1911
+    start_month, end_month = int(m.group(2)), int(m.group(3))
+    if not (1 <= start_month <= end_month <= 12):
+        return None
+    start = datetime(year_ad, start_month, 1).date()
+    end = datetime(year_ad + (end_month == 12), end_month % 12 + 1, 1).date()
+    return start, end
+
+
+def lottery_claim_deadline(draw):
+    """領獎截止日（date）：取 claim_period_text 的最後一個民國日期；缺少時依規則推算（期末月後第 5 個月 5 日）。"""
+    dates = re.findall(r"(\d{3})年\s*(\d{1,2})月\s*(\d{1,2})日", (draw or {}).get("claim_period_text") or "")
+    if dates:
+        y, mth, d = dates[-1]
+        try:
+            return datetime(int(y) + 1911, int(mth), int(d)).date()
+        except ValueError:
+            pass
+    rng = lottery_period_range((draw or {}).get("period_label"))
+    if not rng:
+        return None
+    # 期末月次月 1 日起算：11-12 月期 → 次年 5/5
+    nxt = rng[1]
+    month = nxt.month + 4
+    return datetime(nxt.year + (month - 1) // 12, (month - 1) % 12 + 1, 5).date()
+
+
+def load_invoices_for_period(user_email, start, end):
+    """取得日期落在 [start, end) 的發票（僅對獎所需欄位），日期一律以 normalize_date_series 判斷，兩種模式結果一致。
+    資料庫模式：標準 YYYY/MM/DD 與 YYYY-MM-DD 各查一段範圍（UNION ALL，皆可走 (user_email, date) 索引；
+    字串比較下兩種格式會互相落入對方範圍，故每段再以第 5 字元限定分隔符），
+    未補零、民國等非標準格式另行取出，正規化後再篩選。"""
+    if st.session_state.use_memory_mode:
+        df = run_query("SELECT * FROM invoices")
+    else:
+        params = []
+        for sep in ("/", "-"):
+            params += [user_email, start.strftime(f"%Y{sep}%m{sep}%d"), end.strftime(f"%Y{sep}%m{sep}%d"), sep]
+        part = ("SELECT id, date, invoice_number, seller_name FROM invoices "
+                "WHERE user_email = ? AND date >= ? AND date < ? AND substr(date, 5, 1) = ?")
+        odd = f"SELECT id, date, invoice_number, seller_name FROM invoices WHERE user_email = ? AND NOT {_PADDED_DATE_SQL}"
+        df = run_query(f"{part} UNION ALL {part} UNION ALL {odd} ORDER BY id DESC", tuple(params + [user_email]))
+    if df.empty:
+        return df
+    d = normalize_date_series(df["date"])
+    return df[(d >= start.strftime("%Y/%m/%d")) & (d < end.strftime("%Y/%m/%d"))]
+
+
+def match_lottery_for_periods(draws, user_email, fallback_df=None):
+    """依各期別日期範圍選取發票後對獎。期別無法解析時（手動貼上缺期別）改用 fallback_df。
+    回傳 match_lottery_draws 相同結構的 dict。"""
+    results = {}
+    for d in draws:
+        rng = lottery_period_range(d.get("period_label"))
+        df = load_invoices_for_period(user_email, *rng) if rng else fallback_df
+        results.update(match_lottery_draws(df, [d]))
+    return results
+
+
+def check_claimable_lotteries(user_email, today=None, pasted_draws=()):
+    """一次對獎所有仍在領獎期限內的期別（共用開獎資料庫的官方期別，加上本 session 手動貼上的期別；同期別以官方為準）。
+    回傳 (results_dict, errors)；results_dict 依期別由新到舊。"""
+    today = today or datetime.now().date()
+    store = get_lottery_draw_store()
+    _, err = store.refresh()
+    errors = [err] if err else []
+    by_key = {lottery_period_key(d.get("period_label")): d for d in pasted_draws}
+    by_key.update({lottery_period_key(d.get("period_label")): d for d in store.draws()})
+    draws = []
+    for key in sorted((k for k in by_key if k), key=_lottery_key_order, reverse=True):
+        draw = by_key[key]
+        deadline = lottery_claim_deadline(draw)
+        if deadline is None or deadline >= today:
+            draws.append(draw)
+    return match_lottery_for_periods(draws, user_email), errors
+
+
 def fetch_lottery_draw_from_etax(slot):
     """爬蟲：直接取得財政部開獎頁 HTML，並解析開獎號碼。
     slot: 0 = 最新一期（index.html），1 = 上一期（lastNumber.html）。
@@ -1902,6 +3132,168 @@ def parse_lottery_text(raw_text):
     return draw, None
 
 
+# --- 開獎號碼共用儲存：行程內共用 + .streamlit/lottery_draws.json，每個開獎週期只抓一次 ---
+_LOTTERY_DRAWS_FILE = None
+_LOTTERY_RETRY_SEC = 600  # 抓取失敗或新期尚未公布時，全行程 10 分鐘內不再重抓
+
+
+def _get_lottery_draws_path():
+    global _LOTTERY_DRAWS_FILE
+    if _LOTTERY_DRAWS_FILE is None:
+        base = os.path.dirname(os.path.abspath(__file__))
+        _LOTTERY_DRAWS_FILE = os.path.join(base, ".streamlit", "lottery_draws.json")
+    return _LOTTERY_DRAWS_FILE
+
+
+def lottery_period_key(period_label):
+    """期別標籤正規化為鍵值（如「114年 11 ~ 12 月」、「114年11-12月」→ "114-11"）；無法解析回傳 None。"""
+    m = re.search(r"(\d{3})年\s*(\d{1,2})\s*[~～\-]\s*\d{1,2}\s*月", period_label or "")
+    return f"{int(m.group(1))}-{int(m.group(2)):02d}" if m else None
+
+
+def _lottery_key_order(key):
+    """期別鍵值排序用："114-11" → (114, 11)。"""
+    return tuple(int(x) for x in key.split("-"))
+
+
+class _LotteryDrawStore:
+    """各期開獎號碼（依期別鍵值）。讀取不加鎖（整份 dict 替換）；抓取以 _refresh_lock 保證同時只有一個請求。"""
+
+    def __init__(self, path):
+        self.path = path
+        self._refresh_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._draws = {}
+        self._last_attempt = 0.0
+        try:
+            if os.path.isfile(path):
+                with open(path, "r", encoding="utf-8") as f:
+                    self._draws = json.load(f).get("draws") or {}
+        except Exception:
+            self._draws = {}
+
+    def draws(self):
+        """所有期別，由新到舊。"""
+        return [self._draws[k] for k in sorted(self._draws, key=_lottery_key_order, reverse=True)]
+
+    def latest(self, offset=0):
+        """offset=0 最新一期、1 上一期；無資料回傳 None。"""
+        draws = self.draws()
+        return draws[offset] if len(draws) > offset else None
+
+    def get(self, period_label):
+        return self._draws.get(lottery_period_key(period_label))
+
+    def put(self, *draws):
+        """存入開獎資料（期別無法解析者略過）並寫檔。回傳實際存入筆數。"""
+        with self._write_lock:
+            updated = dict(self._draws)
+            count = 0
+            for draw in draws:
+                key = lottery_period_key((draw or {}).get("period_label"))
+                if key:
+                    updated[key] = draw
+                    count += 1
+            if not count:
+                return 0
+            self._draws = updated
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                tmp = f"{self.path}.{os.getpid()}.tmp"
+                with open(tmp, "w", encoding="utf-8") as f:
+                    json.dump({"draws": updated}, f, ensure_ascii=False)
+                os.replace(tmp, self.path)
+            except Exception:
+                pass
+            return count
+
+    def refresh(self, force=False):
+        """依單月 25 日開獎規則判斷是否有新期，必要時抓取最新與上一期。回傳 (latest_draw, error_message)。"""
+        latest = self.latest()
+        if not force and latest and not _should_refresh_lottery(latest):
+            return latest, None
+        if not force and time.time() - self._last_attempt < _LOTTERY_RETRY_SEC:
+            return latest, None
+        with self._refresh_lock:
+            # 等鎖期間他人可能已更新
+            if self.latest() is not latest:
+                return self.latest(), None
+            self._last_attempt = time.time()
+            err = None
+            for slot in (0, 1):
+                if slot == 1 and len(self._draws) >= 2:
+                    break
+                draw, e = fetch_lottery_draw_from_etax(slot)
+                if e:
+                    err = err or e
+                else:
+                    self.put(draw)
+            return self.latest(), (err if not self.latest() or self.latest() is latest else None)
+
+    def backfill(self):
+        """重新抓取網站提供的最新與上一期（僅財政部來源寫入共用儲存）。回傳 (stored_count, errors)。"""
+        stored, errors = 0, []
+        with self._refresh_lock:
+            self._last_attempt = time.time()
+            for slot in (0, 1):
+                draw, err = fetch_lottery_draw_from_etax(slot)
+                if err:
+                    errors.append(err)
+                else:
+                    stored += self.put(draw)
+        return stored, errors
+
+
+@st.cache_resource(show_spinner=False)
+def get_lottery_draw_store():
+    """取得行程共用的開獎號碼儲存（跨 session 共用）。"""
+    return _LotteryDrawStore(_get_lottery_draws_path())
+
+
+def get_lottery_draw(slot):
+    """由共用儲存取得開獎號碼：slot 0 = 最新一期，1 = 上一期。需要時才向財政部抓取。回傳 (draw_dict, error_message)。"""
+    store = get_lottery_draw_store()
+    latest, err = store.refresh()
+    draw = store.latest(slot)
+    if draw:
+        return draw, None
+    if slot == 1 and latest:
+        # 儲存中只有一期：補抓上一期
+        draw, err = fetch_lottery_draw_from_etax(1)
+        if not err:
+            store.put(draw)
+        return draw, err
+    return None, err or "無法取得開獎號碼。"
+
+
+LOTTERY_PRIZES = {
+    "特別獎": 10_000_000,
+    "特獎": 2_000_000,
+    "頭獎": 200_000,
+    "二獎": 40_000,
+    "三獎": 10_000,
+    "四獎": 4_000,
+    "五獎": 1_000,
+    "六獎": 200,
+}
+
+
+def _lottery_suffix_tables(draw):
+    """將一期開獎號碼展開為「末 N 碼 → 獎別」查表，依 8→3 碼排列（越長獎金越高，先命中者即最佳獎別）。"""
+    first_list = [f for f in (draw.get("first_prizes") or []) if f and len(f) == 8]
+    exact = {}
+    for num, prize in [(draw.get("special_prize"), "特別獎"), (draw.get("top_prize"), "特獎")] + [(f, "頭獎") for f in first_list]:
+        if num:
+            exact.setdefault(num, prize)
+    tables = [(8, exact)]
+    for n, prize in ((7, "二獎"), (6, "三獎"), (5, "四獎"), (4, "五獎")):
+        tables.append((n, {f[-n:]: prize for f in first_list}))
+    six = {f[-3:]: "六獎" for f in first_list}
+    six.update({str(x)[-3:]: "六獎" for x in (draw.get("extra_six") or [])})
+    tables.append((3, six))
+    return tables
+
+
 def match_lottery_prize(inv_num8, draw):
     """依台灣統一發票規則回傳中獎結果。
     inv_num8: 8 位數字字串（已正規化）
@@ -1910,44 +3302,61 @@ def match_lottery_prize(inv_num8, draw):
     """
     if not inv_num8 or not draw:
         return "未中獎", 0
-    # 特別獎
-    if inv_num8 == draw.get("special_prize"):
-        return "特別獎", 10_000_000
-    # 特獎
-    if inv_num8 == draw.get("top_prize"):
-        return "特獎", 2_000_000
-    first_list = draw.get("first_prizes") or []
-    # 頭獎
-    for f in first_list:
-        if inv_num8 == f:
-            return "頭獎", 200_000
-    # 二～五獎（末 7/6/5/4 碼比對任一頭獎）
-    for f in first_list:
-        if len(f) != 8:
-            continue
-        if inv_num8[-7:] == f[-7:]:
-            return "二獎", 40_000
-        if inv_num8[-6:] == f[-6:]:
-            return "三獎", 10_000
-        if inv_num8[-5:] == f[-5:]:
-            return "四獎", 4_000
-        if inv_num8[-4:] == f[-4:]:
-            return "五獎", 1_000
-    # 六獎：末 3 碼比對任一頭獎或增開六獎
-    for f in first_list:
-        if len(f) == 8 and inv_num8[-3:] == f[-3:]:
-            return "六獎", 200
-    extra_six = draw.get("extra_six") or []
-    if inv_num8[-3:] in extra_six:
-        return "六獎", 200
+    for n, table in _lottery_suffix_tables(draw):
+        prize = table.get(inv_num8[-n:])
+        if prize:
+            return prize, LOTTERY_PRIZES[prize]
     return "未中獎", 0
 
 
+def match_lottery_draws(df, draws):
+    """向量化對獎：一次對多期開獎號碼比對所有發票。
+    df 需含 invoice_number（另取 date、seller_name 供明細）；號碼去除非數字後取末 8 碼，同 normalize_invoice_number。
+    回傳 {period_label: {"draw", "winners", "checked_count", "total_prize"}}，與 lottery_last_checked 結構相同。"""
+    results = {}
+    if df is None or df.empty or "invoice_number" not in df.columns:
+        for d in draws:
+            results[d.get("period_label", "")] = {"draw": d, "winners": [], "checked_count": 0, "total_prize": 0}
+        return results
+    digits = df["invoice_number"].fillna("").astype(str).str.replace(r"\D", "", regex=True)
+    num8 = digits.str[-8:][digits.str.len() >= 8]
+    last3 = num8.str[-3:]
+    for d in draws:
+        tables = _lottery_suffix_tables(d)
+        # 除特別獎／特獎外，任何獎別末 3 碼必落在六獎表：先以兩次 isin 篩出候選，再逐級比對
+        cand = num8[num8.isin(tables[0][1].keys()) | last3.isin(tables[-1][1].keys())]
+        prize = pd.Series(pd.NA, index=cand.index, dtype="object")
+        for n, table in tables:
+            pending = prize.isna()
+            if table and pending.any():
+                prize[pending] = cand[pending].str[-n:].map(table)
+        won = prize.dropna()
+        hits = df.loc[won.index]
+        amounts = won.map(LOTTERY_PRIZES).astype(int)
+        winners = pd.DataFrame({
+            "日期": hits.get("date"),
+            "發票號碼": hits["invoice_number"],
+            "賣方名稱": hits.get("seller_name"),
+            "獎別": won,
+            "獎金": amounts,
+        }).to_dict("records")
+        results[d.get("period_label", "")] = {
+            "draw": d,
+            "winners": winners,
+            "checked_count": int(len(num8)),
+            "total_prize": int(amounts.sum()),
+        }
+    return results
+
+
 def save_edited_data(ed_df, original_df, user_email=None):
     """自動保存編輯後的數據；含 modified_at 更新與統編驗證提示。回傳 (saved_count, errors, warnings)。"""
     saved_count = 0
     errors = []
     warnings = []
+    saved_sellers = []
+    user_email = user_email or st.session_state.get('user_email', 'default_user')
+    seller_map = get_seller_map(user_email)
     
     # 將列名映射回數據庫字段名（含稅率類型，供 0%/免稅 編輯）
     reverse_mapping = {"檔案名稱":"file_name","日期":"date","發票號碼":"invoice_number",
@@ -1987,9 +3396,10 @@ def save_edited_data(ed_df, original_df, user_email=None):
         # 稅率類型為空時預設 5%
         if "tax_type" in update_data and (update_data["tax_type"] is None or str(update_data.get("tax_type", "")).strip() == ""):
             update_data["tax_type"] = "5%"
-        # 統編驗證（僅提示，不阻擋儲存）
+        # 統編驗證（僅提示，不阻擋儲存）；主檔已驗證為有效的統編不再重驗
         if "seller_ubn" in update_data and update_data["seller_ubn"]:
-            ok_ubn, msg_ubn = validate_ubn(update_data["seller_ubn"])
+            known = seller_map.get(_seller_key(update_data["seller_ubn"]))
+            ok_ubn, msg_ubn = (True, "") if known and known.get("ubn_valid") else validate_ubn(update_data["seller_ubn"])
             if not ok_ubn:
                 warnings.append(f"記錄 ID {record_id} 賣方統編：{msg_ubn}（已儲存，僅供參考）")
         
@@ -2014,24 +3424,236 @@ def save_edited_data(ed_df, original_df, user_email=None):
                         for key, val in update_data.items():
                             st.session_state.local_invoices[i][key] = val
                         saved_count += 1
+                        saved_sellers.append(update_data)
                         break
             else:
                 # 更新數據庫（多用戶版本：使用 user_email）
                 set_clause = ", ".join([f"{k} = ?" for k in update_data.keys()])
-                user_email = st.session_state.get('user_email', 'default_user')
                 query = f"UPDATE invoices SET {set_clause} WHERE id = ? AND user_email = ?"
                 params = list(update_data.values()) + [record_id, user_email]
                 result = run_query(query, tuple(params), is_select=False)
                 if result:
                     saved_count += 1
+                    saved_sellers.append(update_data)
                 else:
                     errors.append(f"記錄 ID {record_id} 更新失敗")
         except Exception as e:
             errors.append(f"記錄 ID {record_id} 更新錯誤: {str(e)}")
     
+    # 更新賣方主檔（記住此賣方最新的名稱與科目/類型）
+    upsert_sellers(user_email, saved_sellers)
     return saved_count, errors, warnings
 
-def process_ocr(image_obj, file_name, model_name, api_key_val):
+# --- Gemini 呼叫節流：同一 API 金鑰全行程共用額度，依用戶輪流放行，遇 429 自動降低併發 ---
+# 多人同時上傳時各 session 不再各自狂打 API、一起吃 429 再一起重試；GEMINI_RPM 設為金鑰的每分鐘額度
+def _env_int(name, default):
+    """讀取整數環境變數；未設定或空白回傳 default，格式錯誤（如 "60/min"）記錄警告後回傳 default，不讓設定錯誤拖垮整個 app。"""
+    raw = (os.getenv(name) or "").strip()
+    if not raw:
+        return default
+    try:
+        return int(raw)
+    except ValueError:
+        logging.getLogger(__name__).warning("環境變數 %s=%r 不是整數，改用預設值 %s", name, raw, default)
+        return default
+
+
+GEMINI_RPM = max(1, _env_int("GEMINI_RPM", 60))
+GEMINI_MAX_CONCURRENCY = max(1, _env_int("GEMINI_MAX_CONCURRENCY", 8))
+GEMINI_QUEUE_TIMEOUT_SEC = 180
+GEMINI_429_RETRIES = 4
+
+
+class _GeminiLimiter:
+    """單一 API 金鑰的節流器：token bucket 控制每分鐘請求數，併發上限採 AIMD
+    （成功 +1/上限，429 減半並依 Retry-After 暫停放行），排隊中的請求依用戶輪流取得名額。"""
+
+    def __init__(self, rpm, max_concurrency):
+        self._cond = threading.Condition()
+        self._rate = rpm / 60.0
+        self._capacity = float(min(rpm, max_concurrency))
+        self._tokens = self._capacity
+        self._stamp = time.monotonic()
+        self._max_limit = float(max_concurrency)
+        self._limit = float(max_concurrency)
+        self._in_flight = 0
+        self._paused_until = 0.0
+        self._queues = {}  # user -> deque[ticket]
+        self._order = deque()  # 有排隊請求的用戶，輪流放行
+        self._waits = deque(maxlen=500)
+        self._granted = 0
+        self._throttled = 0
+        self._timeouts = 0
+
+    def _dispatch(self):
+        """補充 token 並依序放行；回傳下次可放行前需等待的秒數（受併發限制時回傳 None，等 release 喚醒）。"""
+        now = time.monotonic()
+        self._tokens = min(self._capacity, self._tokens + (now - self._stamp) * self._rate)
+        self._stamp = now
+        granted = False
+        delay = None
+        while self._order and self._in_flight < int(self._limit):
+            if now < self._paused_until:
+                delay = self._paused_until - now
+                break
+            if self._tokens < 1:
+                delay = (1 - self._tokens) / self._rate
+                break
+            user = self._order.popleft()
+            queue = self._queues[user]
+            queue.popleft()["granted"] = True
+            if queue:
+                self._order.append(user)
+            else:
+                del self._queues[user]
+            self._tokens -= 1
+            self._in_flight += 1
+            self._granted += 1
+            granted = True
+        if granted:
+            self._cond.notify_all()
+        return delay
+
+    def acquire(self, user, timeout=GEMINI_QUEUE_TIMEOUT_SEC):
+        """排入 user 的佇列等候放行；回傳等待秒數，逾時回傳 None。取得名額後務必呼叫 release。"""
+        ticket = {"granted": False}
+        start = time.monotonic()
+        deadline = start + timeout
+        with self._cond:
+            if user not in self._queues:
+                self._queues[user] = deque()
+                self._order.append(user)
+            self._queues[user].append(ticket)
+            while True:
+                delay = self._dispatch()
+                if ticket["granted"]:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    queue = self._queues[user]
+                    queue.remove(ticket)
+                    if not queue:
+                        del self._queues[user]
+                        self._order.remove(user)
+                    self._timeouts += 1
+                    return None
+                self._cond.wait(remaining if delay is None else min(remaining, delay))
+            waited = time.monotonic() - start
+            self._waits.append(waited)
+        return waited
+
+    def release(self, status_code=None, retry_after=None):
+        """回報請求結果：429 時減半併發上限、清空 token 並暫停放行；其他成功回應緩慢調升上限。"""
+        with self._cond:
+            self._in_flight -= 1
+            now = time.monotonic()
+            if status_code == 429:
+                self._throttled += 1
+                # 同一波 429（暫停期間陸續回來的請求）只減半一次
+                if now >= self._paused_until:
+                    self._limit = max(1.0, self._limit / 2)
+                self._tokens = 0.0
+                self._paused_until = max(self._paused_until, now + (retry_after or max(1.0, 1 / self._rate)))
+            elif status_code is not None and status_code < 500:
+                self._limit = min(self._max_limit, self._limit + 1 / self._limit)
+            self._dispatch()
+            self._cond.notify_all()
+
+    def stats(self):
+        """排隊深度、進行中請求數、目前併發上限與最近等待時間（平均 / p95，秒）。"""
+        with self._cond:
+            waits = sorted(self._waits)
+            return {
+                "queued": sum(len(q) for q in self._queues.values()),
+                "queued_users": len(self._queues),
+                "in_flight": self._in_flight,
+                "limit": int(self._limit),
+                "paused": max(0.0, self._paused_until - time.monotonic()),
+                "wait_avg": sum(waits) / len(waits) if waits else 0.0,
+                "wait_p95": waits[min(len(waits) - 1, int(len(waits) * 0.95))] if waits else 0.0,
+                "granted": self._granted,
+                "throttled": self._throttled,
+                "timeouts": self._timeouts,
+            }
+
+
+def _gemini_key_id(api_key_val):
+    return hashlib.sha256((api_key_val or "").strip().encode("utf-8")).hexdigest()[:16]
+
+
+@st.cache_resource(show_spinner=False)
+def get_gemini_limiter(key_id):
+    """依 API 金鑰（雜湊）取得全行程共用的節流器，所有 session 與背景工作共用同一份額度。"""
+    return _GeminiLimiter(GEMINI_RPM, GEMINI_MAX_CONCURRENCY)
+
+
+def _gemini_retry_after(resp):
+    """429 回應建議的等待秒數：Retry-After 標頭或錯誤內容的 retryDelay，上限 60 秒。"""
+    try:
+        value = resp.headers.get("Retry-After")
+        if not value:
+            m = re.search(r'"retryDelay"\s*:\s*"(\d+(?:\.\d+)?)s"', resp.text or "")
+            value = m.group(1) if m else None
+        return min(60.0, float(value)) if value else None
+    except (TypeError, ValueError):
+        return None
+
+
+def gemini_post(session, url, payload, timeout, api_key_val, user_email=None):
+    """經節流器送出 Gemini 請求，回傳 requests.Response。429 由節流器降速後重新排隊（最多 GEMINI_429_RETRIES 次）；
+    排隊逾時拋出 requests.exceptions.Timeout。"""
+    limiter = get_gemini_limiter(_gemini_key_id(api_key_val))
+    user = user_email or "default_user"
+    resp = None
+    for _ in range(GEMINI_429_RETRIES + 1):
+        if limiter.acquire(user) is None:
+            raise requests.exceptions.Timeout("Gemini 請求排隊逾時，請稍後再試")
+        resp = None
+        try:
+            resp = session.post(url, json=payload, timeout=timeout)
+        finally:
+            status = resp.status_code if resp is not None else None
+            limiter.release(status, _gemini_retry_after(resp) if status == 429 else None)
+        if resp.status_code != 429:
+            break
+    return resp
+
+
+def gemini_poster(api_key_val, user_email=None):
+    """pdf_converter AI 轉換用的送出函式 post(url, payload, timeout)，經 gemini_post 與其他 Gemini 請求共用節流。"""
+    def post(url, payload, timeout):
+        session = requests.Session()
+        session.trust_env = False
+        with session:
+            return gemini_post(session, url, payload, timeout, api_key_val, user_email)
+    return post
+
+
+def build_ocr_prompt(skip_category=False):
+    """發票辨識 prompt。skip_category=True 時（賣方主檔已知）不列 category_suggest 欄位與其規則。"""
+    # 明確要求純 JSON，不要 Markdown；欄位逐行組成
+    fields = [
+        "date (Format: YYYY/MM/DD, convert ROC year to AD if needed)",
+        "invoice_no (Invoice number)",
+        "seller_name (Store name)",
+        "seller_ubn (Unified Business Number / Tax ID)",
+        "subtotal (Amount before tax, number only)",
+        "tax (Tax amount, number only)",
+        "total (Total amount, number only)",
+        'type (發票類型，必填，只能填其一: "三聯發票", "二聯發票", "電子發票", "收銀機發票", "收據", "其它")',
+    ]
+    rules = "If a field is missing, use null or 0. type must be one of: 三聯發票, 二聯發票, 電子發票, 收銀機發票, 收據, 其它."
+    if not skip_category:
+        fields.append('category_suggest (支出類別/會計科目，必填，例如 "餐飲","交通","辦公用品","差旅","其他")')
+        rules += " category_suggest must be one of: 餐飲, 交通, 辦公用品, 差旅, 其他."
+    return ("You are a receipt OCR assistant. Extract data from this image.\n"
+            "Output ONLY a valid JSON object. Do NOT use Markdown code blocks.\n"
+            "Fields required:\n" + "\n".join(f"- {f}" for f in fields) + "\n\n" + rules)
+
+
+def process_ocr(image_obj, file_name, model_name, api_key_val, skip_category=False, user_email=None):
+    """Gemini 辨識發票圖片，回傳 (data, error)。skip_category=True 時（賣方主檔已知）不要求模型推論 category_suggest。
+    user_email 用於節流器的用戶輪流排隊。"""
     try:
         if image_obj.mode != "RGB": image_obj = image_obj.convert("RGB")
         # 稍微降低解析度以加快速度並減少 Token，但保持足夠清晰度
@@ -2039,22 +3661,7 @@ def process_ocr(image_obj, file_name, model_name, api_key_val):
         img_byte = io.BytesIO(); image_obj.save(img_byte, format="JPEG", quality=85)
         img_base64 = base64.b64encode(img_byte.getvalue()).decode()
         
-        # 優化 Prompt：明確要求純 JSON，不要 Markdown
-        prompt = """You are a receipt OCR assistant. Extract data from this image.
-        Output ONLY a valid JSON object. Do NOT use Markdown code blocks.
-        Fields required:
-        - date (Format: YYYY/MM/DD, convert ROC year to AD if needed)
-        - invoice_no (Invoice number)
-        - seller_name (Store name)
-        - seller_ubn (Unified Business Number / Tax ID)
-        - subtotal (Amount before tax, number only)
-        - tax (Tax amount, number only)
-        - total (Total amount, number only)
-        - type (發票類型，必填，只能填其一: "三聯發票", "二聯發票", "電子發票", "收銀機發票", "收據", "其它")
-        - category_suggest (支出類別/會計科目，必填，例如 "餐飲","交通","辦公用品","差旅","其他")
-        
-        If a field is missing, use null or 0. type must be one of: 三聯發票, 二聯發票, 電子發票, 收銀機發票, 收據, 其它. category_suggest must be one of: 餐飲, 交通, 辦公用品, 差旅, 其他.
-        """
+        prompt = build_ocr_prompt(skip_category)
         
         payload = {
             "contents": [{"parts": [{"text": prompt}, {"inline_data": {"mime_type": "image/jpeg", "data": img_base64}}]}], 
@@ -2077,11 +3684,11 @@ def process_ocr(image_obj, file_name, model_name, api_key_val):
             from requests.adapters import HTTPAdapter
             from urllib3.util.retry import Retry
             
-            # 配置重試策略
+            # 配置重試策略（429 交給 gemini_post 的節流器處理，不在此各自退避重試）
             retry_strategy = Retry(
                 total=3,
                 backoff_factor=1,
-                status_forcelist=[429, 500, 502, 503, 504],
+                status_forcelist=[500, 502, 503, 504],
                 allowed_methods=["POST"]
             )
             adapter = HTTPAdapter(max_retries=retry_strategy)
@@ -2110,7 +3717,10 @@ def process_ocr(image_obj, file_name, model_name, api_key_val):
             
             try:
                 # 修復 Bug #5: 使用帶重試的請求
-                resp = session.post(url, json=payload, timeout=25)
+                resp = gemini_post(session, url, payload, 25, api_key_val, user_email)
+                if resp.status_code == 429:
+                    # 額度已滿：換模型路徑仍是同一把金鑰，不再嘗試其他組合
+                    return None, f"API 額度已滿，請稍後再試 (HTTP 429: {resp.text[:100]})"
                 if resp.status_code == 200:
                     try:
                         resp_json = resp.json()
@@ -2156,6 +3766,374 @@ def process_ocr(image_obj, file_name, model_name, api_key_val):
     except Exception as e: return None, f"系統錯誤: {str(e)}"
 
 
+# --- 背景工作：jobs 表為佇列，工作執行緒認領執行，輸入與結果存於 job_data/<id>/ ---
+# 工作執行緒由 cache_resource 建立，跨 rerun、跨 session 存活；關閉視窗或斷線重連不會中斷辨識/轉換
+# CPU 密集的 PDF 轉換交給子行程（job_worker），Gemini 辨識為網路等待且須共用每把金鑰的限速器，留在行程內
+# 認領的工作記錄 worker（主機:pid:序號）與心跳；只有心跳逾時（擁有者已不在）的 running 工作會被放回佇列
+JOB_WORKERS = max(1, _env_int("JOB_WORKERS", 0) or min(4, os.cpu_count() or 1))
+JOB_POLL_SEC = 1.0
+JOB_HEARTBEAT_SEC = 10
+JOB_STALE_SEC = 60
+JOB_RETENTION_SEC = 7 * 24 * 3600
+JOB_PURGE_INTERVAL_SEC = 3600
+JOB_ACTIVE_STATUSES = ("queued", "running")
+
+
+def _get_job_dir(job_id=None):
+    """背景工作資料目錄（app 目錄下 job_data/）；給 job_id 時回傳該工作的子目錄。"""
+    base = os.path.join(os.path.dirname(os.path.abspath(__file__)), "job_data")
+    return base if job_id is None else os.path.join(base, str(int(job_id)))
+
+
+def _job_connect(db_path):
+    is_uri = (db_path.startswith("file:") and "mode=memory" in db_path) or db_path.startswith("file:invoice_mem")
+    return sqlite3.connect(db_path, timeout=30, check_same_thread=False, uri=is_uri)
+
+
+def _job_row(cursor, row):
+    return dict(zip([d[0] for d in cursor.description], row)) if row else None
+
+
+def submit_job(kind, user_email, files, params=None):
+    """建立背景工作：輸入檔寫入 job_data/<id>/in/，狀態設為 queued 並喚醒工作執行緒。
+    files 為 [(檔名, bytes)]；params 須可 JSON 序列化（勿放 API 金鑰）。回傳 (job_id, error)。"""
+    if kind not in _JOB_HANDLERS:
+        return None, f"不支援的工作類型：{kind}"
+    if st.session_state.use_memory_mode:
+        return None, "內存模式不支援背景工作"
+    db_path = get_db_path()
+    try:
+        conn = _job_connect(db_path)
+        try:
+            with conn:
+                cur = conn.execute(
+                    "INSERT INTO jobs (user_email, kind, status, params, created_at) VALUES (?, ?, 'staging', ?, ?)",
+                    (user_email, kind, json.dumps(params or {}, ensure_ascii=False), datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+                job_id = cur.lastrowid
+            job_dir = _get_job_dir(job_id)
+            os.makedirs(os.path.join(job_dir, "in"), exist_ok=True)
+            for i, (_name, data) in enumerate(files):
+                _write_atomic(os.path.join(job_dir, "in", f"{i:04d}"), data)
+            _write_atomic(os.path.join(job_dir, "inputs.json"), json.dumps([n for n, _ in files], ensure_ascii=False).encode("utf-8"))
+            with conn:
+                conn.execute("UPDATE jobs SET status = 'queued' WHERE id = ?", (job_id,))
+        finally:
+            conn.close()
+    except Exception as e:
+        return None, f"建立背景工作失敗: {str(e)}"
+    get_job_worker_pool(db_path).wake()
+    return job_id, None
+
+
+def get_job(job_id, user_email):
+    """取得工作狀態 dict（id, kind, status, progress, error, result_path…）；不存在或非本人回傳 None。"""
+    if job_id is None or st.session_state.use_memory_mode:
+        return None
+    try:
+        conn = _job_connect(get_db_path())
+        try:
+            cur = conn.execute("SELECT * FROM jobs WHERE id = ? AND user_email = ?", (int(job_id), user_email))
+            return _job_row(cur, cur.fetchone())
+        finally:
+            conn.close()
+    except Exception:
+        return None
+
+
+def find_open_job(user_email, kind):
+    """該用戶最近一筆尚未取用結果的工作（執行中或已完成未確認），用於斷線重連後接續顯示。"""
+    if st.session_state.use_memory_mode:
+        return None
+    try:
+        conn = _job_connect(get_db_path())
+        try:
+            cur = conn.execute(
+                "SELECT * FROM jobs WHERE user_email = ? AND kind = ? AND acknowledged = 0 AND status != 'staging' ORDER BY id DESC LIMIT 1",
+                (user_email, kind))
+            return _job_row(cur, cur.fetchone())
+        finally:
+            conn.close()
+    except Exception:
+        return None
+
+
+def load_job_result(job):
+    """讀取已完成工作的結果 dict；handler 另存的檔案以 result['files'] 列出檔名（位於同目錄）。"""
+    if not job or job.get("status") != "done" or not job.get("result_path"):
+        return None
+    try:
+        with open(job["result_path"], "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception:
+        return None
+
+
+def acknowledge_job(job_id, user_email):
+    """標記結果已取用（之後不再自動接續顯示，並可由清理回收）。"""
+    try:
+        conn = _job_connect(get_db_path())
+        try:
+            with conn:
+                conn.execute("UPDATE jobs SET acknowledged = 1 WHERE id = ? AND user_email = ?", (int(job_id), user_email))
+        finally:
+            conn.close()
+    except Exception:
+        pass
+
+
+def _job_progress_view(job_id, user_email, running_text):
+    job = get_job(job_id, user_email)
+    if not job or job["status"] not in JOB_ACTIVE_STATUSES:
+        st.rerun()  # 已結束：整頁重跑，由呼叫端顯示結果
+    progress = float(job.get("progress") or 0)
+    st.progress(progress, text="排隊中…" if job["status"] == "queued" else running_text.format(progress))
+
+
+# Streamlit 1.37+ 以 fragment 每 JOB_POLL_SEC 只重跑進度列，不阻塞腳本執行緒；舊版無 fragment 則改為手動重新整理
+_job_progress_fragment = st.fragment(run_every=JOB_POLL_SEC)(_job_progress_view) if hasattr(st, "fragment") else None
+
+
+def show_job_progress(job_id, user_email, running_text):
+    """顯示進行中工作的進度列；running_text 為含 {:.0%} 的格式字串。工作結束時自動整頁重跑。"""
+    if _job_progress_fragment is not None:
+        _job_progress_fragment(job_id, user_email, running_text)
+        return
+    _job_progress_view(job_id, user_email, running_text)
+    st.button("🔄 重新整理進度", key=f"job_refresh_{job_id}")
+
+
+def requeue_stale_jobs(db_path, now=None):
+    """把心跳逾時 JOB_STALE_SEC 的 running 工作放回佇列（擁有的行程已結束或卡死）；回傳放回筆數。"""
+    now = time.time() if now is None else now
+    conn = _job_connect(db_path)
+    try:
+        with conn:
+            return conn.execute(
+                "UPDATE jobs SET status = 'queued', worker = NULL, heartbeat = NULL, progress = 0 "
+                "WHERE status = 'running' AND (heartbeat IS NULL OR heartbeat < ?)",
+                (now - JOB_STALE_SEC,)).rowcount
+    finally:
+        conn.close()
+
+
+class _JobWorkerPool:
+    """jobs 佇列的工作執行緒：以 BEGIN IMMEDIATE 原子認領 queued 工作，依 kind 呼叫 _JOB_HANDLERS。
+    另有一條心跳執行緒定期更新本池執行中工作的 heartbeat，並把其他行程遺留（心跳逾時）的工作放回佇列；
+    執行期間每 JOB_PURGE_INTERVAL_SEC 清除過期工作。"""
+
+    def __init__(self, db_path, size):
+        self.db_path = db_path
+        self._wake = threading.Event()
+        self._purge_lock = threading.Lock()
+        self._last_purge = 0.0
+        self._active = {}  # job_id -> worker
+        self._active_lock = threading.Lock()
+        prefix = f"{socket.gethostname()}:{os.getpid()}"
+        requeue_stale_jobs(self.db_path)
+        self._maybe_purge()
+        self._threads = [threading.Thread(target=self._run, args=(f"{prefix}:{i}",), daemon=True, name=f"job-worker-{i}")
+                         for i in range(size)]
+        self._threads.append(threading.Thread(target=self._heartbeat, daemon=True, name="job-heartbeat"))
+        for t in self._threads:
+            t.start()
+
+    def wake(self):
+        self._wake.set()
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(JOB_HEARTBEAT_SEC)
+            try:
+                with self._active_lock:
+                    active = list(self._active.items())
+                conn = _job_connect(self.db_path)
+                try:
+                    with conn:
+                        conn.executemany("UPDATE jobs SET heartbeat = ? WHERE id = ? AND worker = ?",
+                                         [(time.time(), job_id, worker) for job_id, worker in active])
+                finally:
+                    conn.close()
+                if requeue_stale_jobs(self.db_path):
+                    self.wake()
+            except Exception:
+                pass
+
+    def _maybe_purge(self):
+        """刪除超過保存期限的工作與其 job_data 目錄（上傳的發票影像、結果 ZIP）；同一時間只有一個執行緒執行。"""
+        if time.time() - self._last_purge < JOB_PURGE_INTERVAL_SEC or not self._purge_lock.acquire(blocking=False):
+            return
+        try:
+            self._last_purge = time.time()
+            conn = _job_connect(self.db_path)
+            try:
+                with conn:
+                    expired = [r[0] for r in conn.execute(
+                        "SELECT id FROM jobs WHERE (acknowledged = 1 OR status IN ('done', 'failed', 'staging')) AND created_at < ?",
+                        ((datetime.now() - timedelta(seconds=JOB_RETENTION_SEC)).strftime("%Y-%m-%d %H:%M:%S"),))]
+                    conn.executemany("DELETE FROM jobs WHERE id = ?", [(i,) for i in expired])
+            finally:
+                conn.close()
+            for job_id in expired:
+                shutil.rmtree(_get_job_dir(job_id), ignore_errors=True)
+        except Exception:
+            pass
+        finally:
+            self._purge_lock.release()
+
+    def _claim(self, conn, worker):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            cur = conn.execute("SELECT * FROM jobs WHERE status = 'queued' ORDER BY id LIMIT 1")
+            job = _job_row(cur, cur.fetchone())
+            if job:
+                conn.execute("UPDATE jobs SET status = 'running', worker = ?, heartbeat = ?, started_at = ?, progress = 0 WHERE id = ?",
+                             (worker, time.time(), datetime.now().strftime("%Y-%m-%d %H:%M:%S"), job["id"]))
+            conn.execute("COMMIT")
+            return job
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _run(self, worker):
+        conn = _job_connect(self.db_path)
+        conn.isolation_level = None  # 交易由 _claim 自行控制
+        while True:
+            self._maybe_purge()
+            try:
+                job = self._claim(conn, worker)
+            except Exception:
+                job = None
+            if not job:
+                self._wake.wait(timeout=5)
+                self._wake.clear()
+                continue
+            with self._active_lock:
+                self._active[job["id"]] = worker
+            try:
+                self._execute(conn, job, worker)
+            finally:
+                with self._active_lock:
+                    self._active.pop(job["id"], None)
+
+    def _execute(self, conn, job, worker):
+        job_dir = _get_job_dir(job["id"])
+        last = [0.0]
+
+        def _progress(p):
+            # 節流：最多每 0.5 秒寫一次進度
+            now = time.time()
+            if now - last[0] >= 0.5:
+                last[0] = now
+                try:
+                    conn.execute("UPDATE jobs SET progress = ? WHERE id = ? AND worker = ?",
+                                 (min(max(float(p), 0.0), 1.0), job["id"], worker))
+                except Exception:
+                    pass
+
+        try:
+            handler = _JOB_HANDLERS[job["kind"]]
+            result, err = handler(job_dir, json.loads(job.get("params") or "{}"), _progress)
+        except Exception as e:
+            result, err = None, f"{type(e).__name__}: {e}"
+        result_path = None
+        if result is not None:
+            result_path = os.path.join(job_dir, "result.json")
+            _write_atomic(result_path, json.dumps(result, ensure_ascii=False, default=str).encode("utf-8"))
+        status = "done" if result is not None else "failed"
+        # 只更新仍屬於本執行緒的工作：若心跳逾時已被放回佇列並由他人認領，結果交由新的擁有者寫入
+        conn.execute("UPDATE jobs SET status = ?, progress = 1, result_path = ?, error = ?, finished_at = ? WHERE id = ? AND worker = ?",
+                     (status, result_path, err, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), job["id"], worker))
+
+
+@st.cache_resource(show_spinner=False)
+def get_job_worker_pool(db_path):
+    """取得該資料庫的背景工作執行緒池（行程內唯一，首次取得時啟動並重新排入心跳逾時的工作）。"""
+    return _JobWorkerPool(db_path, JOB_WORKERS)
+
+
+def decode_barcode_info(image_obj):
+    """
+    嘗試從發票條碼 / QR Code 中解出發票號碼等資訊。
+    依賴 pyzbar（可選）；若未安裝或解析失敗則返回空 dict。
+    目前僅做簡單規則：尋找 2 碼英文 + 8 碼數字的統一發票號碼；
+    電子發票左側 QR Code（以發票號碼開頭）第 45~52 碼為賣方統編。
+    """
+    try:
+        from pyzbar.pyzbar import decode as _barcode_decode
+    except Exception:
+        return {}
+    try:
+        barcodes = _barcode_decode(image_obj)
+    except Exception:
+        return {}
+    info = {}
+    for bc in barcodes:
+        try:
+            txt = (bc.data or b"").decode(errors="ignore").strip().upper()
+        except Exception:
+            continue
+        if not txt:
+            continue
+        # 統一發票號碼格式：2 碼英文字母 + 8 碼數字（例如 AB12345678）
+        m = re.search(r"[A-Z]{2}[0-9]{8}", txt)
+        if m and "invoice_no" not in info:
+            info["invoice_no"] = m.group(0)
+        if m and m.start() == 0 and len(txt) >= 53 and txt[45:53].isdigit() and "seller_ubn" not in info:
+            info["seller_ubn"] = txt[45:53]
+    return info
+
+
+def ocr_extract(fname, fbytes, model_name, api_key_val, known_ubns=(), user_email=None):
+    """單張發票的辨識部分（條碼 + Gemini），不碰 session_state，可在背景執行緒執行。
+    known_ubns：賣方主檔中已有科目的統編，QR Code 命中時不請模型推論科目。回傳 {file, data, error, barcode}。"""
+    try:
+        image_obj = Image.open(io.BytesIO(fbytes))
+    except Exception as img_err:
+        return {"file": fname, "data": None, "error": f"無法讀取圖片 {img_err}", "barcode": {}}
+    barcode_info = decode_barcode_info(image_obj)
+    data, err = process_ocr(image_obj, fname, model_name, api_key_val,
+                            skip_category=barcode_info.get("seller_ubn") in set(known_ubns), user_email=user_email)
+    return {"file": fname, "data": data, "error": err, "barcode": barcode_info}
+
+
+def _job_ocr_batch(job_dir, params, progress):
+    """ocr_batch：逐張辨識，結果（未去重、未存檔）交回 UI 執行緒完成後續步驟。"""
+    files = read_job_inputs(job_dir)
+    api_key_val = _safe_secrets_get("GEMINI_API_KEY") or os.getenv("GEMINI_API_KEY") or ""
+    if not api_key_val:
+        return None, "未設定 GEMINI_API_KEY"
+    items = []
+    for i, (fname, fbytes) in enumerate(files):
+        items.append(ocr_extract(fname, fbytes, params.get("model_name") or "gemini-2.0-flash", api_key_val,
+                                 params.get("known_ubns") or (), params.get("user_email")))
+        progress((i + 1) / len(files))
+    return {"items": items}, None
+
+
+def _job_pdf_convert(job_dir, params, progress):
+    """pdf_convert：批次轉換結果存為 result.zip，逐檔報告放入結果。
+    AI 轉換（Gemini）在行程內執行以共用限速器；其餘 CPU 密集的轉換在子行程執行（job_worker.run_pdf_convert）。"""
+    options = dict(params.get("options") or {})
+    if params.get("target") not in ("word_ai", "word_ai_layout"):
+        return run_in_subprocess(run_pdf_convert, (job_dir, params.get("target"), options), progress)
+    options["api_key"] = _safe_secrets_get("GEMINI_API_KEY") or os.getenv("GEMINI_API_KEY") or ""
+    options["post"] = gemini_poster(options["api_key"], params.get("user_email"))
+    return pdf_convert_to_result(job_dir, params.get("target"), options, progress)
+
+
+_JOB_HANDLERS = {
+    "ocr_batch": _job_ocr_batch,
+    "pdf_convert": _job_pdf_convert,
+}
+
+# 啟動（或行程重啟後第一次執行）即建立工作執行緒，接手上次未完成的工作
+if not st.session_state.use_memory_mode:
+    try:
+        get_job_worker_pool(get_db_path())
+    except Exception:
+        pass
+
+
 # --- AI 報帳小助理：對話與自然語言記帳 ---
 ASSISTANT_SYSTEM_PROMPT = """你是「發票報帳小秘笈」的 AI 報帳小助理，使用繁體中文回答。
 你會回答關於發票報帳、會計科目、本系統操作的簡單問題。
@@ -2163,7 +4141,7 @@ ASSISTANT_SYSTEM_PROMPT = """你是「發票報帳小秘笈」的 AI 報帳小
 若用戶用一句話描述一筆支出（例如「今天午餐 120 元 全家」「昨天計程車 200」），請先簡短回覆確認，然後在回覆「最後一行」單獨寫 [EXPENSE] 並換行，下一行只放一個 JSON 物件，欄位：date(YYYY/MM/DD), seller_name, total(數字), category(類型), subject(會計科目)。若明顯只是問問題而非記帳則不要加 [EXPENSE]。"""
 
 
-def call_gemini_chat(messages, api_key_val, model_name, system_instruction=None):
+def call_gemini_chat(messages, api_key_val, model_name, system_instruction=None, user_email=None):
     """呼叫 Gemini 多輪對話 API（純文字），回傳 (reply_text, error)。"""
     if not api_key_val or not messages:
         return None, "缺少 API Key 或訊息"
@@ -2191,7 +4169,7 @@ def call_gemini_chat(messages, api_key_val, model_name, system_instruction=None)
         url = f"https://generativelanguage.googleapis.com/v1beta/{model_id}:generateContent?key={api_key_val}"
         session = requests.Session()
         session.trust_env = False
-        resp = session.post(url, json=payload, timeout=30)
+        resp = gemini_post(session, url, payload, 30, api_key_val, user_email)
         if resp.status_code != 200:
             return None, f"API 錯誤: {resp.status_code} {resp.text[:200]}"
         data = resp.json()
@@ -2213,7 +4191,7 @@ AUDIO_MIME_TO_GEMINI = {
     "audio/flac": "audio/flac", "audio/ogg": "audio/ogg",
 }
 
-def _transcribe_audio_gemini(audio_bytes, mime_type, api_key_val, model_name):
+def _transcribe_audio_gemini(audio_bytes, mime_type, api_key_val, model_name, user_email=None):
     """使用 Gemini API 將錄音轉成逐字稿。回傳 (transcript_text, error)。"""
     if not api_key_val or not audio_bytes:
         return None, "缺少 API Key 或音訊"
@@ -2235,7 +4213,7 @@ def _transcribe_audio_gemini(audio_bytes, mime_type, api_key_val, model_name):
         }
         session = requests.Session()
         session.trust_env = False
-        resp = session.post(url, json=payload, timeout=120)
+        resp = gemini_post(session, url, payload, 120, api_key_val, user_email)
         if resp.status_code != 200:
             return None, f"Gemini API 錯誤: {resp.status_code} {resp.text[:300]}"
         data = resp.json()
@@ -2286,12 +4264,12 @@ def _transcribe_audio_cloud_stt(audio_bytes, mime_type):
         return None, f"Cloud STT 轉錄錯誤: {str(e)}"
 
 
-def transcribe_audio(audio_bytes, mime_type, api_key_val, model_name, source="auto"):
+def transcribe_audio(audio_bytes, mime_type, api_key_val, model_name, source="auto", user_email=None):
     """轉錄錄音為逐字稿。source: 'gemini'|'cloud_stt'|'auto'（auto 時 Gemini 失敗則用 Cloud STT 備援）。"""
     if source == "cloud_stt":
         txt, err = _transcribe_audio_cloud_stt(audio_bytes, mime_type)
         return txt, err, "cloud_stt"
-    txt, err = _transcribe_audio_gemini(audio_bytes, mime_type, api_key_val, model_name)
+    txt, err = _transcribe_audio_gemini(audio_bytes, mime_type, api_key_val, model_name, user_email)
     if err and source == "auto":
         txt2, err2 = _transcribe_audio_cloud_stt(audio_bytes, mime_type)
         if not err2 and txt2:
@@ -2299,7 +4277,7 @@ def transcribe_audio(audio_bytes, mime_type, api_key_val, model_name, source="au
     return txt, err, "gemini"
 
 
-def generate_meeting_highlights(transcript, api_key_val, model_name):
+def generate_meeting_highlights(transcript, api_key_val, model_name, user_email=None):
     """根據逐字稿產出會議結論與待辦。回傳 (reply_text, error)。逐字稿由介面另行顯示。"""
     sys_inst = """你是會議紀錄助手。根據使用者提供的會議逐字稿，用繁體中文產出以下結構（Markdown 格式）：
 ## 會議結論
@@ -2311,7 +4289,7 @@ def generate_meeting_highlights(transcript, api_key_val, model_name):
 僅輸出上述兩區塊，不要輸出逐字稿。"""
     return call_gemini_chat(
         [{"role": "user", "content": transcript.strip()[:20000]}],
-        api_key_val, model_name, system_instruction=sys_inst,
+        api_key_val, model_name, system_instruction=sys_inst, user_email=user_email,
     )
 
 
@@ -2380,7 +4358,7 @@ def _get_contract_content(uploaded_file):
     return None, None, f"不支援的格式: {name}"
 
 
-def call_gemini_contract_compare(content_a, content_b, api_key_val, model_name, type_a="text", type_b="text"):
+def call_gemini_contract_compare(content_a, content_b, api_key_val, model_name, type_a="text", type_b="text", user_email=None):
     """合約比對。content_a/content_b: 文字或 bytes；type_a/type_b: 'text'|'pdf'。回傳 (reply_text, error)。"""
     if not api_key_val:
         return None, "缺少 API Key"
@@ -2415,7 +4393,7 @@ def call_gemini_contract_compare(content_a, content_b, api_key_val, model_name,
     try:
         session = requests.Session()
         session.trust_env = False
-        resp = session.post(url, json=payload, timeout=90)
+        resp = gemini_post(session, url, payload, 90, api_key_val, user_email)
         if resp.status_code != 200:
             return None, f"API 錯誤: {resp.status_code} {resp.text[:300]}"
         data = resp.json()
@@ -2495,6 +4473,160 @@ def insert_assistant_draft(draft, user_email):
         return False, str(e)
 
 
+# --- 報表導出：向量化金額計算與 PDF 報表 ---
+_ZERO_TAX_TYPES = ['0%', 'exempt', '零稅率', '免稅']
+
+
+def compute_invoice_amounts(df):
+    """向量化計算導出金額：銷售額或稅額缺漏且總計 > 0 時，依稅率類型由總計回推。回傳 (subtotal, tax, total) 三個 Series。"""
+    def _num(*cols):
+        for c in cols:
+            if c in df.columns:
+                return pd.to_numeric(df[c], errors='coerce').fillna(0)
+        return pd.Series(0.0, index=df.index)
+    total = _num('總計', 'total')
+    subtotal = _num('銷售額', 'subtotal')
+    tax = _num('稅額', 'tax')
+    tax_type_col = df['稅率類型'] if '稅率類型' in df.columns else df.get('tax_type')
+    if tax_type_col is None:
+        tax_type_col = pd.Series('5%', index=df.index)
+    tax_type_str = tax_type_col.fillna('5%').astype(str).str.strip().str.lower()
+    is_zero_or_exempt = tax_type_str.isin(_ZERO_TAX_TYPES)
+    need_recalc = ((subtotal == 0) | (tax == 0)) & (total > 0)
+    if need_recalc.any():
+        calc_tax = pd.Series(0.0, index=df.index).where(is_zero_or_exempt, (total - (total / 1.05)).round(0))
+        calc_subtotal = (total - calc_tax).round(0)
+        tax = tax.where(~need_recalc, calc_tax)
+        subtotal = subtotal.where(~need_recalc, calc_subtotal)
+    return subtotal, tax, total
+
+
+def register_pdf_font(pdf, family, path):
+    """以 fpdf2 公開 API 將字型加入 pdf（一般與粗體樣式共用同一字型檔）。字型檔不存在或無法載入時回傳 False。"""
+    if not os.path.exists(path):
+        return False
+    try:
+        pdf.add_font(family, '', path)
+        pdf.add_font(family, 'B', path)
+    except Exception:
+        return False
+    return True
+
+
+# PDF 報表欄位：(中文表頭, 英文表頭, 欄寬 mm, 截斷字數, 對齊)
+_REPORT_PDF_COLUMNS = [
+    ("日期", "Date", 14, 10, "L"),
+    ("發票號碼", "Invoice No", 18, 12, "L"),
+    ("賣方名稱", "Seller", 26, 18, "L"),
+    ("賣方統編", "UBN", 14, 10, "L"),
+    ("銷售額(未稅)", "Net", 18, None, "R"),
+    ("稅額", "Tax", 14, None, "R"),
+    ("總計", "Total", 16, None, "R"),
+    ("狀態", "Status", 10, 8, "L"),
+    ("備註", "Note", 20, 18, "L"),
+    ("檔案名稱", "File", 28, 22, "L"),
+]
+
+
+def build_invoice_report_pdf(rows_df, stats_df=None, company_name="", company_ubn="", font_path="NotoSansTC-Regular.ttf"):
+    """產生發票明細 PDF 報表（bytes）。所有欄位先以 pandas 向量化整理成字串，繪製時只逐列輸出儲存格；換頁前重繪表頭。
+    中文字型載入失敗時改用 Helvetica 與英文標籤。"""
+    stats_df = rows_df if stats_df is None or getattr(stats_df, 'empty', True) else stats_df
+    pdf = FPDF(orientation="L")
+    pdf.set_auto_page_break(auto=True, margin=15)
+    font_name = "NotoSansTC"
+    font_loaded = register_pdf_font(pdf, font_name, font_path)
+    if not font_loaded:
+        font_name = 'Helvetica'
+
+    def _text_col(series, limit):
+        s = series.fillna('').astype(str).str.strip()
+        s = s.where(~s.isin(['', 'N/A']), '-')
+        if limit:
+            s = s.str[:limit]
+        if not font_loaded:
+            # 內建字型僅支援 latin-1
+            s = s.str.encode('latin-1', 'replace').str.decode('latin-1')
+        return s
+
+    def _col(name):
+        return rows_df[name] if name in rows_df.columns else pd.Series('', index=rows_df.index)
+
+    subtotal, tax, total = compute_invoice_amounts(rows_df)
+    note = _col('備註').fillna('').astype(str).str.strip()
+    for fallback in ('會計科目', '類型'):
+        fb = _col(fallback).fillna('').astype(str).str.strip()
+        note = note.where(note != '', fb)
+    fmt_money = "${:,.0f}".format
+    cells = {
+        "日期": _text_col(_col('日期'), 10),
+        "發票號碼": _text_col(_col('發票號碼'), 12),
+        "賣方名稱": _text_col(_col('賣方名稱'), 18),
+        "賣方統編": _text_col(_col('賣方統編'), 10),
+        "銷售額(未稅)": subtotal.map(fmt_money),
+        "稅額": tax.map(fmt_money),
+        "總計": total.map(fmt_money),
+        "狀態": _text_col(_col('狀態'), 8),
+        "備註": _text_col(note, 18),
+        "檔案名稱": _text_col(_col('檔案名稱'), 22),
+    }
+    rows = list(zip(*(cells[c[0]].tolist() for c in _REPORT_PDF_COLUMNS)))
+    widths = [c[2] for c in _REPORT_PDF_COLUMNS]
+    aligns = [c[4] for c in _REPORT_PDF_COLUMNS]
+    headers = [c[0] if font_loaded else c[1] for c in _REPORT_PDF_COLUMNS]
+
+    def _label(zh, en):
+        return zh if font_loaded else en
+
+    pdf.add_page()
+    pdf.set_font(font_name, 'B', 16)
+    pdf.cell(0, 10, _label('發票報帳統計報表', 'Invoice Report'), ln=1, align='C')
+    pdf.ln(5)
+    pdf.set_font(font_name, '', 10)
+    now = datetime.now()
+    pdf.cell(0, 5, _label(f'生成時間: {now.strftime("%Y年%m月%d日 %H:%M:%S")}', f'Generated: {now.strftime("%Y-%m-%d %H:%M:%S")}'), ln=1, align='R')
+    pdf.ln(5)
+    if font_loaded:
+        if company_name:
+            pdf.cell(200, 10, f"報支公司：{company_name}", ln=1)
+        if company_ubn:
+            pdf.cell(200, 10, f"公司統編：{company_ubn}", ln=1)
+    elif company_ubn:
+        pdf.cell(200, 10, f"UBN: {company_ubn}", ln=1)
+    pdf.ln(5)
+    pdf.set_font(font_name, 'B', 12)
+    pdf.cell(0, 8, _label('統計摘要', 'Summary'), ln=1)
+    pdf.set_font(font_name, '', 10)
+    total_sum = pd.to_numeric(stats_df['總計'], errors='coerce').fillna(0).sum() if '總計' in stats_df.columns else 0
+    tax_sum = pd.to_numeric(stats_df['稅額'], errors='coerce').fillna(0).sum() if '稅額' in stats_df.columns else 0
+    for label, value in (
+        (_label('累計金額:', 'Total:'), f"${total_sum:,.0f}"),
+        (_label('累計稅額:', 'Tax:'), f"${tax_sum:,.0f}"),
+        (_label('發票總數:', 'Invoices:'), _label(f"{len(stats_df)} 筆", str(len(stats_df)))),
+    ):
+        pdf.cell(90, 6, label, 1)
+        pdf.cell(90, 6, value, 1, ln=1)
+    pdf.ln(5)
+
+    def _draw_header():
+        pdf.set_font(font_name, 'B', 9)
+        for w, h in zip(widths, headers):
+            pdf.cell(w, 7, h, 1, align='C')
+        pdf.ln()
+        pdf.set_font(font_name, '', 8)
+
+    _draw_header()
+    row_h = 6
+    last = len(widths) - 1
+    for row in rows:
+        if pdf.will_page_break(row_h):
+            pdf.add_page()
+            _draw_header()
+        for i, (w, txt, al) in enumerate(zip(widths, row, aligns)):
+            pdf.cell(w, row_h, txt, 1, ln=1 if i == last else 0, align=al)
+    return bytes(pdf.output())
+
+
 # --- 4. 介面渲染 ---
 # 這裡不再硬編碼 Key，防止洩漏。預設為空，強迫使用 Secrets 或手動輸入。
 DEFAULT_KEY = "" 
@@ -2591,6 +4723,27 @@ with st.sidebar:
         )
         st.session_state.gemini_api_key = _safe_secrets_get("GEMINI_API_KEY")
         st.session_state.gemini_model = model
+        # Gemini 節流狀態（僅管理員）：全行程共用，反映所有用戶排隊與 429 降速情形
+        if st.session_state.gemini_api_key and is_admin_user():
+            _lim = get_gemini_limiter(_gemini_key_id(st.session_state.gemini_api_key)).stats()
+            st.caption(
+                f"API 排隊 {_lim['queued']} 筆（{_lim['queued_users']} 位用戶）・進行中 {_lim['in_flight']}/{_lim['limit']}・"
+                f"等待 平均 {_lim['wait_avg']:.1f}s / p95 {_lim['wait_p95']:.1f}s・429 {_lim['throttled']} 次"
+                + (f"・降速暫停 {_lim['paused']:.0f}s" if _lim["paused"] else "")
+            )
+        # 資料庫維護（僅管理員）：舊資料內嵌影像搬至影像儲存（可中斷，重按會從未完成處繼續）；涵蓋全部用戶並可能 VACUUM 鎖住整個資料庫
+        _inline_n = count_inline_images() if is_admin_user() else 0
+        if _inline_n:
+            st.caption(f"資料庫內仍有 {_inline_n} 張內嵌發票影像，搬至影像儲存可縮小資料庫並加快查詢。")
+            if st.button("搬移內嵌影像", use_container_width=True, key="migrate_inline_images_btn"):
+                _mig_bar = st.progress(0.0, text="搬移中…")
+                _mig = migrate_inline_images(
+                    on_progress=lambda done, total: _mig_bar.progress(min(done / max(total, 1), 1.0), text=f"搬移中… {done}/{total}"))
+                _mig_bar.empty()
+                if _mig["migrated"]:
+                    st.success(f"已搬移 {_mig['migrated']} 張（{_mig['bytes'] / 1048576:.1f} MB）" + ("，資料庫已壓縮" if _mig["vacuumed"] else ""))
+                if _mig["errors"]:
+                    st.warning(f"{_mig['failed']} 張未搬移：" + "；".join(_mig["errors"][:3]))
     
     st.session_state.use_memory_mode = False
 
@@ -2647,6 +4800,7 @@ if st.session_state.current_tool != "invoice":
                         txt, err, engine = transcribe_audio(
                             bytes_data, mime, api_key, model,
                             source=st.session_state.get("meeting_stt_source", "auto"),
+                            user_email=st.session_state.get("user_email"),
                         )
                     if err:
                         st.error(f"{f.name} 轉錄失敗：{err}")
@@ -2657,7 +4811,7 @@ if st.session_state.current_tool != "invoice":
                 st.error("請先貼上會議逐字稿或上傳錄音檔。")
             else:
                 with st.spinner("正在產出結論與待辦…"):
-                    reply, err = generate_meeting_highlights(transcript_text, api_key, model)
+                    reply, err = generate_meeting_highlights(transcript_text, api_key, model, st.session_state.get("user_email"))
                 if err:
                     st.error(err)
                 else:
@@ -2722,7 +4876,8 @@ if st.session_state.current_tool != "invoice":
             else:
                 with st.spinner("正在比對…"):
                     reply, err = call_gemini_contract_compare(
-                        content_a, content_b, api_key, model, type_a=type_a, type_b=type_b
+                        content_a, content_b, api_key, model, type_a=type_a, type_b=type_b,
+                        user_email=st.session_state.get("user_email"),
                     )
                 if err:
                     st.error(err)
@@ -2738,11 +4893,85 @@ if st.session_state.current_tool != "invoice":
 
         st.subheader("📄 PDF 萬能轉換")
         st.caption("支援 PDF 與 Office、圖片格式互轉。")
+        def _render_batch_result(zip_file, report, err, file_name):
+            """批次轉換結果：逐檔報告 + 單一 ZIP 下載（zip_file 為檔案型 ZIP，由呼叫端關閉）。"""
+            _ok = sum(1 for r in report if not r["error"])
+            if report:
+                st.dataframe(
+                    pd.DataFrame([
+                        {"檔案": r["name"], "結果": "✅ 成功" if not r["error"] else f"❌ {r['error']}"}
+                        for r in report
+                    ]),
+                    use_container_width=True,
+                    hide_index=True,
+                )
+            if err:
+                st.error(err)
+                return
+            if _ok < len(report):
+                st.warning(f"完成 {_ok} / {len(report)} 個檔案，失敗的檔案請見上表。")
+            else:
+                st.success(f"全部 {_ok} 個檔案轉換完成")
+            st.download_button(
+                "📥 下載 ZIP 壓縮檔",
+                data=zip_file,
+                file_name=file_name,
+                mime="application/zip",
+                key="pdf_dl_batch_zip",
+            )
+
+        def _start_batch_job(files, target, zip_name, **options):
+            """批次轉換交給背景工作 pdf_convert；無法建立工作（內存模式）時當場轉換。"""
+            _uid = st.session_state.get("user_email", "default_user")
+            job_id, _ = submit_job("pdf_convert", _uid, files, {"target": target, "options": options, "zip_name": zip_name, "user_email": _uid})
+            if job_id is not None:
+                st.session_state.pdf_batch_job = {"id": job_id, "zip_name": zip_name}
+                st.rerun()
+            progress = st.progress(0.0)
+            if target in ("word_ai", "word_ai_layout"):
+                options["api_key"] = st.session_state.get("gemini_api_key") or _safe_secrets_get("GEMINI_API_KEY")
+                options["post"] = gemini_poster(options["api_key"], _uid)
+            with st.spinner("批次轉換中，請稍候…"):
+                zip_file, report, err = batch_convert_stream(files, target, progress_callback=lambda p: progress.progress(p), **options)
+            progress.progress(1.0)
+            try:
+                _render_batch_result(zip_file, report, err, zip_name)
+            finally:
+                if zip_file is not None:
+                    zip_file.close()
+
+        def _show_batch_job():
+            """顯示背景批次轉換：進行中輪詢進度，完成後提供報告與 ZIP 下載。斷線重連或新 session 時接續該用戶未取用的工作。"""
+            _info = st.session_state.get("pdf_batch_job")
+            if not _info:
+                _open_job = find_open_job(st.session_state.get("user_email", "default_user"), "pdf_convert")
+                if not _open_job:
+                    return
+                _info = {"id": _open_job["id"], "zip_name": json.loads(_open_job.get("params") or "{}").get("zip_name") or "converted.zip"}
+                st.session_state.pdf_batch_job = _info
+            job = get_job(_info["id"], st.session_state.get("user_email", "default_user"))
+            if not job:
+                st.session_state.pdf_batch_job = None
+                return
+            if job["status"] in JOB_ACTIVE_STATUSES:
+                show_job_progress(job["id"], job["user_email"], "批次轉換中… {:.0%}（可離開此頁，稍後回來下載）")
+                return
+            result = load_job_result(job)
+            if result is None:
+                st.error(job.get("error") or "批次轉換失敗")
+            else:
+                with open(os.path.join(_get_job_dir(job["id"]), "result.zip"), "rb") as f:
+                    _render_batch_result(f, result.get("report") or [], result.get("error"), _info["zip_name"])
+            if st.button("清除結果", key="pdf_batch_job_clear"):
+                acknowledge_job(job["id"], job["user_email"])
+                st.session_state.pdf_batch_job = None
+                st.rerun()
+
         try:
             from pdf_converter import (
                 pdf_to_excel,
                 pdf_to_ppt,
-                pdf_to_images,
+                pdf_to_images_stream,
                 pdf_to_word,
                 pdf_to_word_with_tesseract,
                 pdf_to_word_with_ai_ocr,
@@ -2751,6 +4980,7 @@ if st.session_state.current_tool != "invoice":
                 word_to_pdf,
                 excel_to_pdf,
                 ppt_to_pdf,
+                batch_convert_stream,
             )
         except ImportError:
             st.error("無法載入 pdf_converter 模組，請確認 pdf_converter.py 與依賴庫已正確安裝。")
@@ -2825,15 +5055,23 @@ if st.session_state.current_tool != "invoice":
             else:
                 _type = {"word": ["docx"], "excel": ["xlsx"], "ppt": ["pptx"]}[_src]
                 st.caption(f"上傳 {_src.upper()} 檔案（.{_type[0]}）")
-                office_upload = st.file_uploader(
-                    f"上傳 {_src.upper()}",
+                office_uploads = st.file_uploader(
+                    f"上傳 {_src.upper()}（可多選）",
                     type=_type,
+                    accept_multiple_files=True,
                     key=f"pdf_office_to_pdf_{_src}",
                     label_visibility="collapsed",
                 )
-                if not office_upload:
+                if not office_uploads:
                     st.info(f"👆 請上傳 .{_type[0]} 檔案")
                     st.stop()
+                office_upload = office_uploads[0]
+                if len(office_uploads) > 1:
+                    st.caption(f"已選擇 {len(office_uploads)} 個檔案，將批次轉換並打包為 ZIP。")
+                    if st.button("開始批次轉換", type="primary", key=f"pdf_office2pdf_batch_btn_{_src}"):
+                        _start_batch_job([(f.name, f.getvalue()) for f in office_uploads], "pdf", f"{_src}_to_pdf.zip")
+                    _show_batch_job()
+                    st.stop()
                 if st.button("開始轉換", type="primary", key=f"pdf_office2pdf_btn_{_src}"):
                     progress = st.progress(0.0)
                     office_bytes = office_upload.read()
@@ -2863,14 +5101,15 @@ if st.session_state.current_tool != "invoice":
 
         # 從 PDF 轉換：卡片式選項 + 拖放上傳
         st.caption("拖放文件或點擊上傳 PDF")
-        uploaded = st.file_uploader("上傳 PDF 檔案", type=["pdf"], key="pdf_conv_upload", label_visibility="collapsed")
+        uploads = st.file_uploader("上傳 PDF 檔案（可多選）", type=["pdf"], accept_multiple_files=True, key="pdf_conv_upload", label_visibility="collapsed")
 
-        if not uploaded:
+        if not uploads:
             st.info("👆 請先上傳 PDF 檔案")
             st.stop()
 
-        pdf_bytes = uploaded.read()
-        if len(pdf_bytes) > 50 * 1024 * 1024:
+        uploaded = uploads[0]
+        pdf_bytes = uploaded.getvalue()
+        if sum(f.size for f in uploads) > 50 * 1024 * 1024:
             st.warning("⚠️ 檔案超過 50MB，為避免記憶體負擔，建議縮小檔案後再試。")
 
         # 卡片式轉換選項
@@ -2922,6 +5161,30 @@ if st.session_state.current_tool != "invoice":
             st.caption("💡 要得到「樣式、字體、圖片都可編輯」的 Word：**一般模式**（文字型 PDF）或 **AI 高品質排版**（掃描/文字型皆可，需 API 金鑰）。")
 
         st.markdown("---")
+        if len(uploads) > 1:
+            st.caption(f"已選擇 {len(uploads)} 個 PDF，將批次轉換並打包為 ZIP。")
+            if st.button("開始批次轉換", type="primary", key="pdf_conv_batch_btn", use_container_width=True):
+                _batch_opts = {}
+                _batch_target = _current
+                if _current == "image":
+                    _batch_opts = {"fmt": img_fmt, "dpi": 200}
+                elif _current == "word":
+                    _batch_target = {
+                        "ocr": "word_ocr",
+                        "normal": "word",
+                        "ai": "word_ai",
+                        "ai_layout": "word_ai_layout",
+                    }[st.session_state.get("pdf_word_mode", "ocr")]
+                    if _batch_target in ("word_ai", "word_ai_layout"):
+                        # API 金鑰不寫入工作參數，由背景工作自行讀取
+                        _batch_opts = {"model_name": st.session_state.get("gemini_model") or "gemini-2.0-flash"}
+                        if not (st.session_state.get("gemini_api_key") or _safe_secrets_get("GEMINI_API_KEY")):
+                            st.error("AI 模式需設定 Gemini API 金鑰，請在進階設定中設定。")
+                            st.stop()
+                _start_batch_job([(f.name, f.getvalue()) for f in uploads], _batch_target, f"pdf_to_{_current}.zip", **_batch_opts)
+            _show_batch_job()
+            st.stop()
+
         if st.button("開始轉換", type="primary", key="pdf_conv_btn", use_container_width=True):
             base_name = os.path.splitext(uploaded.name or "document")[0]
             progress = st.progress(0.0)
@@ -2960,7 +5223,7 @@ if st.session_state.current_tool != "invoice":
                             )
                     elif conv_target == "image":
                         progress.progress(0.3)
-                        zip_data, first_img, err = pdf_to_images(pdf_bytes, fmt=img_fmt, dpi=200, progress_callback=lambda p: progress.progress(0.3 + 0.7 * p))
+                        zip_file, first_img, err = pdf_to_images_stream(pdf_bytes, fmt=img_fmt, dpi=200, progress_callback=lambda p: progress.progress(0.3 + 0.7 * p))
                         progress.progress(1.0)
                         if err:
                             st.error(err)
@@ -2969,13 +5232,14 @@ if st.session_state.current_tool != "invoice":
                             if first_img:
                                 st.markdown("**第一頁預覽**")
                                 st.image(first_img, use_container_width=True)
-                            st.download_button(
-                                "📥 下載 ZIP 壓縮檔",
-                                data=zip_data,
-                                file_name=f"{base_name}_images.zip",
-                                mime="application/zip",
-                                key="pdf_dl_zip",
-                            )
+                            with zip_file:
+                                st.download_button(
+                                    "📥 下載 ZIP 壓縮檔",
+                                    data=zip_file,
+                                    file_name=f"{base_name}_images.zip",
+                                    mime="application/zip",
+                                    key="pdf_dl_zip",
+                                )
                     elif conv_target == "word":
                         progress.progress(0.3)
                         word_mode = st.session_state.get("pdf_word_mode", "ocr")
@@ -2998,6 +5262,7 @@ if st.session_state.current_tool != "invoice":
                                     api_key=_api_key,
                                     model_name=_model,
                                     progress_callback=lambda p: progress.progress(0.3 + 0.7 * p),
+                                    post=gemini_poster(_api_key, st.session_state.get("user_email")),
                                 )
                         elif word_mode == "ai_layout":
                             _api_key = st.session_state.get("gemini_api_key") or _safe_secrets_get("GEMINI_API_KEY")
@@ -3011,6 +5276,7 @@ if st.session_state.current_tool != "invoice":
                                     api_key=_api_key,
                                     model_name=_model,
                                     progress_callback=lambda p: progress.progress(0.3 + 0.7 * p),
+                                    post=gemini_poster(_api_key, st.session_state.get("user_email")),
                                 )
                         else:
                             result, err = pdf_to_word(pdf_bytes, progress_callback=lambda p: progress.progress(0.3 + 0.7 * p))
@@ -3067,7 +5333,7 @@ with st.container():
                 st.session_state.upload_mode = "camera"
 # 查詢當前用戶的數據（多用戶版本：使用 user_email）
 user_email = st.session_state.get('user_email', 'default_user')
-df_raw = run_query("SELECT * FROM invoices WHERE user_email = ? ORDER BY id DESC", (user_email,))
+df_raw = load_user_invoices(user_email)
 
 st.markdown("---")
 # ========== 1. 統計指標區（報表標題 + KPI）==========
@@ -3169,34 +5435,11 @@ with st.container():
 # ========== 發票對獎（簡化版）==========
 def _run_lottery_and_match(slot):
     """取得開獎號碼並對所有發票對獎，結果寫入 session_state.lottery_last_checked。回傳 (error_message or None)。"""
-    draw, err = fetch_lottery_draw_from_etax(slot)
+    draw, err = get_lottery_draw(slot)
     if err:
         return err
     st.session_state["lottery_draw"] = draw
-    winners = []
-    total_prize = 0
-    checked_count = 0
-    for _, row in df_raw.iterrows():
-        inv_num8 = normalize_invoice_number(row.get("invoice_number"))
-        if not inv_num8:
-            continue
-        prize, amount = match_lottery_prize(inv_num8, draw)
-        checked_count += 1
-        if amount > 0:
-            winners.append({
-                "日期": row.get("date"),
-                "發票號碼": row.get("invoice_number"),
-                "賣方名稱": row.get("seller_name"),
-                "獎別": prize,
-                "獎金": amount,
-            })
-            total_prize += amount
-    st.session_state["lottery_last_checked"] = {
-        "draw": draw,
-        "winners": winners,
-        "checked_count": checked_count,
-        "total_prize": total_prize,
-    }
+    st.session_state["lottery_last_checked"] = match_lottery_for_periods([draw], user_email, df_raw)[draw.get("period_label", "")]
     return None
 
 # ========== 發票對獎（明顯位置，吸引用戶）==========
@@ -3207,25 +5450,17 @@ with st.container():
     else:
         _auto_err = None
         last = st.session_state.get("lottery_last_checked")
-        cached_draw = (last or {}).get("draw") or st.session_state.get("lottery_draw")
-        # 無快取時自動對獎；有快取但期別已過期（有新開獎）時自動更新
-        need_refresh = _should_refresh_lottery(cached_draw) if cached_draw else True
-        # 若上次自動更新失敗，冷卻 10 分鐘再試，避免重複請求
-        _refresh_cooldown = st.session_state.get("lottery_refresh_cooldown")
-        if _refresh_cooldown and (datetime.now() - _refresh_cooldown).total_seconds() < 600:
-            need_refresh = False
-        if not last:
-            with st.spinner("正在自動對獎最新一期…"):
-                _auto_err = _run_lottery_and_match(0)
-                if _auto_err:
-                    st.session_state["lottery_refresh_cooldown"] = datetime.now()
-        elif need_refresh:
-            with st.spinner("偵測到新開獎期，正在更新…"):
-                _auto_err = _run_lottery_and_match(0)
-                if _auto_err:
-                    st.session_state["lottery_refresh_cooldown"] = datetime.now()
-                else:
-                    st.session_state.pop("lottery_refresh_cooldown", None)
+        # 開獎號碼由共用儲存提供：每期只抓一次，失敗冷卻亦由儲存處理（全行程共用）
+        _store = get_lottery_draw_store()
+        _latest = _store.latest()
+        if not _latest or _should_refresh_lottery(_latest):
+            with st.spinner("正在取得最新開獎號碼…"):
+                _latest, _auto_err = _store.refresh()
+        # 本 session 尚未對獎，或儲存已有比上次對獎更新的期別時重新比對（比對不需網路；手動對舊期不會被覆蓋）
+        _last_key = lottery_period_key(((last or {}).get("draw") or {}).get("period_label"))
+        _latest_key = lottery_period_key((_latest or {}).get("period_label"))
+        if not last or (_latest_key and (not _last_key or _lottery_key_order(_latest_key) > _lottery_key_order(_last_key))):
+            _auto_err = _run_lottery_and_match(0)
         last = st.session_state.get("lottery_last_checked")
         draw = st.session_state.get("lottery_draw")
         label = (last.get("draw") or draw or {}).get("period_label") if (last or draw) else "本期"
@@ -3274,6 +5509,33 @@ with st.container():
                         st.error(err)
                     else:
                         st.rerun()
+            if st.button("對獎（所有可領獎期別）", use_container_width=True, key="lottery_btn_claimable"):
+                with st.spinner("對獎中…"):
+                    _all_results, _all_errs = check_claimable_lotteries(
+                        user_email, pasted_draws=(st.session_state.get("lottery_pasted_draws") or {}).values())
+                if _all_results:
+                    st.session_state["lottery_all_checked"] = _all_results
+                    # 最新一期同時作為主要對獎結果
+                    _latest = next(iter(_all_results.values()))
+                    st.session_state["lottery_draw"] = _latest["draw"]
+                    st.session_state["lottery_last_checked"] = _latest
+                    st.rerun()
+                else:
+                    st.error("；".join(_all_errs) or "目前沒有仍在領獎期限內的期別。")
+            _all_checked = st.session_state.get("lottery_all_checked")
+            if _all_checked:
+                with st.expander("各期對獎結果", expanded=False):
+                    _summary = [{
+                        "期別": _p or "—",
+                        "對獎張數": _r["checked_count"],
+                        "中獎張數": len(_r["winners"]),
+                        "獎金": _r["total_prize"],
+                        "領獎期限": _r["draw"].get("claim_period_text") or "—",
+                    } for _p, _r in _all_checked.items()]
+                    st.dataframe(pd.DataFrame(_summary), use_container_width=True, hide_index=True)
+                    _all_winners = [dict(w, 期別=_p) for _p, _r in _all_checked.items() for w in _r["winners"]]
+                    if _all_winners:
+                        st.dataframe(pd.DataFrame(_all_winners), use_container_width=True, hide_index=True)
             with st.expander("手動貼上開獎號碼（備用）", expanded=False):
                 st.caption("當自動取得失敗或要對更早期別時，可至 [財政部開獎頁](https://invoice.etax.nat.gov.tw/) 複製整頁貼上後解析並對獎。")
                 raw_lottery = st.text_area("貼上財政部「統一發票中獎號碼」頁面文字", value=st.session_state.get("lottery_raw_text", ""), height=100, key="lottery_raw_text")
@@ -3282,21 +5544,20 @@ with st.container():
                     if err:
                         st.error(err)
                     else:
+                        # 貼上內容未經驗證，只留在本 session，不寫入全站共用的開獎儲存
+                        _pkey = lottery_period_key(draw.get("period_label"))
+                        if _pkey:
+                            st.session_state.setdefault("lottery_pasted_draws", {})[_pkey] = draw
                         st.session_state["lottery_draw"] = draw
-                        winners = []
-                        total_prize = 0
-                        checked_count = 0
-                        for _, row in df_raw.iterrows():
-                            inv_num8 = normalize_invoice_number(row.get("invoice_number"))
-                            if not inv_num8:
-                                continue
-                            prize, amount = match_lottery_prize(inv_num8, draw)
-                            checked_count += 1
-                            if amount > 0:
-                                winners.append({"日期": row.get("date"), "發票號碼": row.get("invoice_number"), "賣方名稱": row.get("seller_name"), "獎別": prize, "獎金": amount})
-                                total_prize += amount
-                        st.session_state["lottery_last_checked"] = {"draw": draw, "winners": winners, "checked_count": checked_count, "total_prize": total_prize}
+                        st.session_state["lottery_last_checked"] = match_lottery_for_periods([draw], user_email, df_raw)[draw.get("period_label", "")]
                         st.rerun()
+                if st.button("重新抓取最新與上一期開獎", key="lottery_backfill_btn"):
+                    with st.spinner("抓取中…"):
+                        _stored, _bf_errs = get_lottery_draw_store().backfill()
+                    if _bf_errs:
+                        st.warning("；".join(_bf_errs))
+                    if _stored:
+                        st.success(f"已更新 {_stored} 期開獎號碼")
         with _right:
             st.markdown("**本期開獎號碼**")
             if draw:
@@ -3318,8 +5579,9 @@ if "show_assistant_dialog" not in st.session_state:
 if "assistant_pending_draft" not in st.session_state:
     st.session_state.assistant_pending_draft = None
 
-def _run_ocr_batch(file_data_list, user_email, api_key_val, model_name):
-    """執行 OCR 辨識，回傳 (ocr_pending_records, success_count, fail_count, duplicate_count, ocr_report, duplicate_details)。"""
+def _run_ocr_batch(file_data_list, user_email, api_key_val, model_name, extracted=None):
+    """執行 OCR 辨識，回傳 (ocr_pending_records, success_count, fail_count, duplicate_count, ocr_report, duplicate_details)。
+    extracted 為背景工作 ocr_batch 的辨識結果（與 file_data_list 同順序）；有值時只做去重、主檔帶入與存圖。"""
     ocr_pending_records = []
     success_count = 0
     fail_count = 0
@@ -3340,48 +5602,27 @@ def _run_ocr_batch(file_data_list, user_email, api_key_val, model_name):
                 return False
         return True
 
-    def decode_barcode_info(image_obj):
-        """
-        嘗試從發票條碼 / QR Code 中解出發票號碼等資訊。
-        依賴 pyzbar（可選）；若未安裝或解析失敗則返回空 dict。
-        目前僅做簡單規則：尋找 2 碼英文 + 8 碼數字的統一發票號碼。
-        """
-        try:
-            from pyzbar.pyzbar import decode as _barcode_decode
-        except Exception:
-            return {}
-        try:
-            barcodes = _barcode_decode(image_obj)
-        except Exception:
-            return {}
-        info = {}
-        for bc in barcodes:
-            try:
-                txt = (bc.data or b"").decode(errors="ignore").strip().upper()
-            except Exception:
-                continue
-            if not txt:
-                continue
-            # 統一發票號碼格式：2 碼英文字母 + 8 碼數字（例如 AB12345678）
-            m = re.search(r"[A-Z]{2}[0-9]{8}", txt)
-            if m and "invoice_no" not in info:
-                info["invoice_no"] = m.group(0)
-        return info
+    seller_map = get_seller_map(user_email)
+    # QR Code 帶出主檔內已有科目的賣方時，科目沿用上次設定，不再請模型推論
+    known_ubns = [u for u, v in seller_map.items() if v.get("subject")]
     
-    for fname, fbytes in file_data_list:
-        try:
-            image_obj = Image.open(io.BytesIO(fbytes))
-        except Exception as img_err:
-            ocr_report.append(f"{fname}: 無法讀取圖片 {img_err}")
-            fail_count += 1
-            continue
-        # 先嘗試從條碼解出發票號碼等結構化資訊
-        barcode_info = decode_barcode_info(image_obj)
-        data, err = process_ocr(image_obj, fname, model_name, api_key_val)
+    for i, (fname, fbytes) in enumerate(file_data_list):
+        # 先嘗試從條碼解出發票號碼等結構化資訊，再交給模型辨識
+        item = extracted[i] if extracted is not None else ocr_extract(fname, fbytes, model_name, api_key_val, known_ubns, user_email)
+        data, err, barcode_info = item.get("data"), item.get("error"), item.get("barcode") or {}
         if data:
             # 條碼資訊優先填入（若 OCR 未填或為預設值）
             if barcode_info.get("invoice_no") and not data.get("invoice_no"):
                 data["invoice_no"] = barcode_info["invoice_no"]
+            if barcode_info.get("seller_ubn") and _seller_key(data.get("seller_ubn")) is None:
+                data["seller_ubn"] = barcode_info["seller_ubn"]
+            # 賣方主檔自動帶入：正式名稱、上次科目；類型僅在 OCR 未判斷時補上
+            known_seller = seller_map.get(_seller_key(data.get("seller_ubn")))
+            if known_seller:
+                data["seller_name"] = known_seller.get("name") or data.get("seller_name")
+                data["category_suggest"] = known_seller.get("subject") or data.get("category_suggest")
+                if data.get("type") in (None, "", "其他", "其它"):
+                    data["type"] = known_seller.get("category") or data.get("type")
             invoice_no = safe_value(data.get("invoice_no"), "No")
             invoice_date = safe_value(data.get("date"), datetime.now().strftime("%Y/%m/%d"))
             is_duplicate = False
@@ -3405,7 +5646,7 @@ def _run_ocr_batch(file_data_list, user_email, api_key_val, model_name):
                 duplicate_count += 1
                 duplicate_details.append({"檔名": fname, "發票號碼": invoice_no, "日期": invoice_date})
                 continue
-            image_path = save_invoice_image(image_obj.copy(), fname, user_email)
+            image_sha256, image_path = save_invoice_image(fbytes, fname, user_email)
             ocr_pending_records.append({
                 'file_name': safe_value(data.get("file_name"), "未命名"),
                 'date': safe_value(data.get("date"), datetime.now().strftime("%Y/%m/%d")),
@@ -3415,7 +5656,7 @@ def _run_ocr_batch(file_data_list, user_email, api_key_val, model_name):
                 'subtotal': clean_n(data.get("subtotal", 0)), 'tax': clean_n(data.get("tax", 0)), 'total': clean_n(data.get("total", 0)),
                 'category': safe_value(data.get("type"), "其它"), 'subject': safe_value(data.get("category_suggest"), "雜項"),
                 'note': safe_value(data.get("note") or data.get("備註"), ""),
-                'image_path': image_path, 'tax_type': '5%'
+                'image_path': image_path, 'image_sha256': image_sha256, 'tax_type': '5%'
             })
             success_count += 1
         else:
@@ -3435,21 +5676,50 @@ def upload_dialog():
             st.warning("⚠️ 圖片辨識需要 API 金鑰。請在 **Manage app → Settings → Secrets** 中設定 `GEMINI_API_KEY`，設定後重新載入頁面。")
         st.caption("支援 JPG、PNG；建議單張清晰、光線充足，以利辨識。" if not is_camera else "使用裝置相機拍攝發票，拍完後點「開始辨識」。")
         
-        # 若已在辨識中（剛點開始辨識後 rerun）
+        user_email = st.session_state.get("user_email", "default_user")
+        # 剛點開始辨識：資料庫模式交給背景工作（關閉視窗或斷線不中斷）；內存模式維持同步辨識
         if st.session_state.get("start_ocr") and st.session_state.get("upload_file_data"):
             file_data_list = st.session_state.upload_file_data
             st.session_state.start_ocr = False
             del st.session_state.upload_file_data
-            user_email = st.session_state.get("user_email", "default_user")
+            known_ubns = [u for u, v in get_seller_map(user_email).items() if v.get("subject")]
+            job_id, job_err = submit_job("ocr_batch", user_email, file_data_list, {"model_name": model, "known_ubns": known_ubns, "user_email": user_email})
+            if job_id is not None:
+                st.session_state.ocr_job_id = job_id
+                st.rerun()
             with st.spinner("AI 正在努力辨識發票中..."):
                 prog = st.progress(0)
-                n = len(file_data_list)
                 ocr_recs, ok, fail, dup, report, dup_details = _run_ocr_batch(file_data_list, user_email, api_key, model)
                 prog.progress(1.0)
             st.session_state.ocr_pending_records = ocr_recs
             st.session_state.ocr_show_editor = len(ocr_recs) > 0
             st.session_state.ocr_status = {"ok": ok, "fail": fail, "dup": dup, "report": report, "dup_details": dup_details}
             st.rerun()
+
+        # 背景辨識：新 session（斷線重連）接續該用戶尚未取用的工作；進行中輪詢進度，完成後在此做去重與存圖
+        if st.session_state.get("ocr_job_id") is None and not st.session_state.get("ocr_show_editor"):
+            _open_job = find_open_job(user_email, "ocr_batch")
+            if _open_job:
+                st.session_state.ocr_job_id = _open_job["id"]
+        if st.session_state.get("ocr_job_id") is not None:
+            job = get_job(st.session_state.ocr_job_id, user_email)
+            if job and job["status"] in JOB_ACTIVE_STATUSES:
+                st.info("AI 正在背景辨識發票，可先關閉視窗，稍後回來查看結果。")
+                show_job_progress(job["id"], user_email, "辨識中… {:.0%}")
+            else:
+                st.session_state.ocr_job_id = None
+                if job:
+                    acknowledge_job(job["id"], user_email)
+                    result = load_job_result(job)
+                    if result is None:
+                        st.session_state.ocr_status = {"ok": 0, "fail": 1, "dup": 0, "report": [job.get("error") or "背景辨識失敗"], "dup_details": []}
+                    else:
+                        file_data_list = read_job_inputs(_get_job_dir(job["id"]))
+                        ocr_recs, ok, fail, dup, report, dup_details = _run_ocr_batch(file_data_list, user_email, api_key, model, extracted=result["items"])
+                        st.session_state.ocr_pending_records = ocr_recs
+                        st.session_state.ocr_show_editor = len(ocr_recs) > 0
+                        st.session_state.ocr_status = {"ok": ok, "fail": fail, "dup": dup, "report": report, "dup_details": dup_details}
+                    st.rerun()
         
         # 若辨識完成（有成功結果），顯示狀態摘要與檢視區
         if st.session_state.get("ocr_show_editor") and st.session_state.get("ocr_pending_records"):
@@ -3489,6 +5759,7 @@ def upload_dialog():
                         try: return float(v) if v is not None and not (isinstance(v, float) and pd.isna(v)) else 0.0
                         except: return 0.0
                     saved = 0
+                    saved_sellers = []
                     for i, row in ed_ocr.iterrows():
                         seq = int(row.get("序號", i+1)) - 1
                         if seq < 0 or seq >= len(recs): continue
@@ -3502,18 +5773,17 @@ def upload_dialog():
                         subj = _s(row.get("會計科目"), base.get("subject","雜項")) or "雜項"
                         note_val = _s(row.get("備註"), base.get("note",""))
                         image_path = base.get("image_path")
+                        saved_sellers.append({"seller_ubn": ubn, "seller_name": seller, "subject": subj, "category": cat})
                         if st.session_state.use_memory_mode:
-                            st.session_state.local_invoices.append({"id": len(st.session_state.local_invoices)+1, "user_email": user_email, "file_name": base.get("file_name","未命名"), "date": date_val, "invoice_number": inv_no, "seller_name": seller, "seller_ubn": ubn, "subtotal": sub, "tax": tax, "total": total, "category": cat, "subject": subj, "status": "✅ 正常", "note": note_val, "image_path": image_path, "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "batch_id": batch_id, "tax_type": base.get("tax_type","5%")})
+                            st.session_state.local_invoices.append({"id": len(st.session_state.local_invoices)+1, "user_email": user_email, "file_name": base.get("file_name","未命名"), "date": date_val, "invoice_number": inv_no, "seller_name": seller, "seller_ubn": ubn, "subtotal": sub, "tax": tax, "total": total, "category": cat, "subject": subj, "status": "✅ 正常", "note": note_val, "image_path": image_path, "image_sha256": base.get("image_sha256"), "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "batch_id": batch_id, "tax_type": base.get("tax_type","5%")})
                             saved += 1
                         else:
                             init_db()
-                            img_data = None
-                            if image_path and os.path.exists(image_path):
-                                try:
-                                    with open(image_path, "rb") as f: img_data = f.read()
-                                except: pass
-                            q = "INSERT INTO invoices (user_email, file_name, date, invoice_number, seller_name, seller_ubn, subtotal, tax, total, category, subject, status, note, image_path, image_data, batch_id, tax_type) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)"
-                            if run_query(q, (user_email, base.get("file_name","未命名"), date_val, inv_no, seller, ubn, sub, tax, total, cat, subj, "✅ 正常", note_val, image_path, img_data, batch_id, base.get("tax_type","5%")), is_select=False): saved += 1
+                            # 影像只存於 blob 儲存（image_sha256 引用），不再複製一份到 image_data
+                            q = "INSERT INTO invoices (user_email, file_name, date, invoice_number, seller_name, seller_ubn, subtotal, tax, total, category, subject, status, note, image_path, image_sha256, batch_id, tax_type) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)"
+                            if run_query(q, (user_email, base.get("file_name","未命名"), date_val, inv_no, seller, ubn, sub, tax, total, cat, subj, "✅ 正常", note_val, image_path, base.get("image_sha256"), batch_id, base.get("tax_type","5%")), is_select=False): saved += 1
+                            else: saved_sellers.pop()
+                    upsert_sellers(user_email, saved_sellers)
                     st.session_state.ocr_show_editor = False
                     st.session_state.ocr_pending_records = []
                     st.session_state.ocr_status = None
@@ -3576,7 +5846,7 @@ def upload_dialog():
     else:
         # 數據導入區域
         st.markdown("### 📥 CSV 數據導入")
-        st.info("💡 支援 CSV (.csv)；必填欄位：日期、發票號碼、總計。可先下載模板再填寫。")
+        st.info("💡 支援 CSV (.csv)、Excel (.xlsx) 及電子發票平台匯出 CSV；必填欄位：日期、發票號碼、總計。可先下載模板再填寫。")
         
         # 下載導入模板
         template_data = {
@@ -3596,7 +5866,8 @@ def upload_dialog():
         st.download_button("📥 下載導入模板 (CSV)", template_csv, "invoice_import_template.csv", 
                          mime="text/csv", use_container_width=True)
         
-        uploaded_file = st.file_uploader("選擇要導入的 CSV 文件", type=["csv"], key="import_file_dialog")
+        st.caption("亦可直接上傳財政部電子發票整合服務平台下載的載具發票明細檔（M/D 格式，.csv / .txt）。")
+        uploaded_file = st.file_uploader("選擇要導入的 CSV / Excel 文件", type=["csv", "xlsx", "txt"], key="import_file_dialog")
         
         if uploaded_file and st.button("開始導入", type="primary", use_container_width=True, key="import_btn_dialog"):
             st.session_state.import_file = uploaded_file
@@ -3610,6 +5881,18 @@ def upload_dialog():
 # 顯示上傳對話框（辨識狀態與結果均在視窗內；僅在用戶點 關閉/確認/取消 時才關閉）
 if st.session_state.show_upload_dialog:
     upload_dialog()
+elif not st.session_state.get("ocr_show_editor"):
+    # 視窗已關閉但背景辨識仍在進行或已完成：提示回到上傳視窗查看
+    _bg_ocr_job = find_open_job(st.session_state.get("user_email", "default_user"), "ocr_batch")
+    if _bg_ocr_job:
+        _bg_c1, _bg_c2 = st.columns([4, 1])
+        with _bg_c1:
+            st.info("背景辨識已完成，點右側查看結果。" if _bg_ocr_job["status"] not in JOB_ACTIVE_STATUSES else f"背景辨識進行中（{float(_bg_ocr_job.get('progress') or 0):.0%}）…")
+        with _bg_c2:
+            if st.button("查看辨識", key="bg_ocr_job_open", use_container_width=True):
+                st.session_state.show_upload_dialog = True
+                st.session_state.upload_mode = "ocr"
+                st.rerun()
 
 # 若有待處理的 OCR 或導入，不要停在空狀態，讓下方 OCR/導入區塊執行
 _has_pending_ocr = st.session_state.get("start_ocr") and ("upload_file_data" in st.session_state or "upload_files" in st.session_state)
@@ -3696,7 +5979,7 @@ def assistant_dialog():
     if prompt := st.chat_input("輸入問題或記一筆支出…"):
         history.append({"role": "user", "content": prompt})
         messages = [{"role": m["role"], "content": m["content"]} for m in history]
-        reply, err = call_gemini_chat(messages, api_key, model, ASSISTANT_SYSTEM_PROMPT)
+        reply, err = call_gemini_chat(messages, api_key, model, ASSISTANT_SYSTEM_PROMPT, st.session_state.get("user_email"))
         if err:
             history.append({"role": "model", "content": f"⚠️ 發生錯誤：{err}"})
         else:
@@ -3723,134 +6006,44 @@ if st.session_state.get("start_import", False) and "import_file" in st.session_s
     del st.session_state.import_file
     
     try:
-        # 讀取 CSV 文件
-        import_df = pd.read_csv(uploaded_file)
-        
-        if import_df.empty:
-            st.error("文件為空，請檢查文件內容")
-        else:
-            # 列名映射（支持多種可能的列名）
-            column_mapping = {
-                "檔案名稱": ["檔案名稱", "file_name", "檔名", "文件名"],
-                "日期": ["日期", "date", "Date"],
-                "發票號碼": ["發票號碼", "invoice_number", "invoice_no", "發票號"],
-                "賣方名稱": ["賣方名稱", "seller_name", "賣方", "商家名稱"],
-                "賣方統編": ["賣方統編", "seller_ubn", "統編", "統一編號"],
-                "銷售額": ["銷售額", "subtotal", "未稅金額"],
-                "稅額": ["稅額", "tax", "Tax"],
-                "總計": ["總計", "total", "Total", "金額"],
-                "類型": ["類型", "category", "Category"],
-                "會計科目": ["會計科目", "subject", "Subject", "科目"],
-                "備註": ["備註", "note", "Note", "备注", "備注"]
-            }
-            
-            # 標準化列名
-            for standard_name, possible_names in column_mapping.items():
-                for possible_name in possible_names:
-                    if possible_name in import_df.columns:
-                        import_df.rename(columns={possible_name: standard_name}, inplace=True)
-                        break
-            
-            # 檢查必填字段
-            required_fields = ["日期", "發票號碼", "總計"]
-            missing_fields = [f for f in required_fields if f not in import_df.columns]
-            if missing_fields:
-                st.error(f"缺少必填字段: {', '.join(missing_fields)}")
-            else:
-                # 開始導入（邏輯架構說明書：上傳前先建立 Batch）
-                user_email = st.session_state.get('user_email', 'default_user')
-                batch_id = create_batch(user_email, 'import')
-                imported_count = 0
-                duplicate_count = 0
-                error_count = 0
-                
-                with st.status("正在導入數據...", expanded=False) as status:
-                    for idx, row in import_df.iterrows():
-                        try:
-                            # 檢查重複
-                            invoice_no = str(row.get("發票號碼", "No"))
-                            invoice_date = str(row.get("日期", ""))
-                            is_dup, _ = check_duplicate_invoice(invoice_no, invoice_date, user_email)
-                            
-                            if is_dup:
-                                duplicate_count += 1
-                                continue
-                            
-                            # 處理數值
-                            def safe_float(val):
-                                try:
-                                    return float(str(val).replace(',', '').replace('$', ''))
-                                except:
-                                    return 0.0
-                            
-                            def safe_str(val, default="No"):
-                                val_str = str(val) if not pd.isna(val) else ""
-                                return val_str if val_str.strip() else default
-                            
-                            # 保存數據（含 batch_id、tax_type）
-                            if st.session_state.use_memory_mode:
-                                invoice_record = {
-                                    'id': len(st.session_state.local_invoices) + 1,
-                                    'user_email': user_email,
-                                    'file_name': safe_str(row.get("檔案名稱"), "導入數據"),
-                                    'date': safe_str(row.get("日期"), datetime.now().strftime("%Y/%m/%d")),
-                                    'invoice_number': safe_str(row.get("發票號碼"), "No"),
-                                    'seller_name': safe_str(row.get("賣方名稱"), "No"),
-                                    'seller_ubn': safe_str(row.get("賣方統編"), "No"),
-                                    'subtotal': safe_float(row.get("銷售額", 0)),
-                                    'tax': safe_float(row.get("稅額", 0)),
-                                    'total': safe_float(row.get("總計", 0)),
-                                    'category': safe_str(row.get("類型"), "其他"),
-                                    'subject': safe_str(row.get("會計科目"), "雜項"),
-                                    'status': "✅ 正常",
-                                    'note': safe_str(row.get("備註"), ""),
-                                    'image_path': None,
-                                    'created_at': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                                    'batch_id': batch_id,
-                                    'tax_type': '5%'
-                                }
-                                st.session_state.local_invoices.append(invoice_record)
-                                imported_count += 1
-                            else:
-                                init_db()
-                                q = "INSERT INTO invoices (user_email, file_name, date, invoice_number, seller_name, seller_ubn, subtotal, tax, total, category, subject, status, note, batch_id, tax_type) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)"
-                                params = (
-                                    user_email,
-                                    safe_str(row.get("檔案名稱"), "導入數據"),
-                                    safe_str(row.get("日期"), datetime.now().strftime("%Y/%m/%d")),
-                                    safe_str(row.get("發票號碼"), "No"),
-                                    safe_str(row.get("賣方名稱"), "No"),
-                                    safe_str(row.get("賣方統編"), "No"),
-                                    safe_float(row.get("銷售額", 0)),
-                                    safe_float(row.get("稅額", 0)),
-                                    safe_float(row.get("總計", 0)),
-                                    safe_str(row.get("類型"), "其他"),
-                                    safe_str(row.get("會計科目"), "雜項"),
-                                    "✅ 正常",
-                                    safe_str(row.get("備註"), ""),
-                                    batch_id,
-                                    '5%'
-                                )
-                                if run_query(q, params, is_select=False):
-                                    imported_count += 1
-                                else:
-                                    error_count += 1
-                        
-                        except Exception as e:
-                            error_count += 1
-                
-                # 顯示結果
-                if imported_count > 0:
-                    st.success(f"✅ 成功導入 {imported_count} 筆數據")
-                if duplicate_count > 0:
-                    st.warning(f"⚠️ 跳過 {duplicate_count} 筆重複數據")
-                if error_count > 0:
-                    st.error(f"❌ {error_count} 筆數據導入失敗")
-                
-                if imported_count > 0:
-                    time.sleep(1)
-                    st.rerun()
-                    
+        user_email = st.session_state.get('user_email', 'default_user')
+        init_db()
+        with st.status("正在導入數據...", expanded=False) as status:
+            def _on_progress(processed, stats):
+                status.update(label=f"正在導入數據... 已處理 {processed:,} 筆（新增 {stats['imported']:,}、重複 {stats['duplicates']:,}）")
+
+            import_stats = import_invoice_chunks(
+                iter_import_chunks(uploaded_file),
+                user_email,
+                batch_source='import',
+                on_progress=_on_progress,
+            )
+            status.update(label="導入完成", state="complete")
+
+        imported_count = import_stats["imported"]
+        duplicate_count = import_stats["duplicates"]
+        error_count = import_stats["errors"]
+        if import_stats["missing_fields"]:
+            st.error(f"缺少必填字段: {', '.join(import_stats['missing_fields'])}")
+        elif import_stats["error"] and not imported_count and not error_count:
+            st.error(import_stats["error"])
+
+        # 顯示結果
+        if imported_count > 0:
+            st.success(f"✅ 成功導入 {imported_count} 筆數據")
+        if duplicate_count > 0:
+            st.warning(f"⚠️ 跳過 {duplicate_count} 筆重複數據")
+        if import_stats["skipped"] > 0:
+            st.info(f"ℹ️ 略過 {import_stats['skipped']} 筆作廢發票")
+        if import_stats["invalid_ubn"] > 0:
+            st.warning(f"⚠️ {import_stats['invalid_ubn']} 筆賣方統編格式不符，已照常導入，請於明細中確認")
+        if error_count > 0:
+            st.error(f"❌ {error_count} 筆數據導入失敗：{import_stats['error']}")
+
+        if imported_count > 0:
+            time.sleep(1)
+            st.rerun()
+
     except Exception as e:
         st.error(f"導入失敗: {str(e)}")
 
@@ -3860,7 +6053,7 @@ st.subheader("分析圖表")
 with st.container():
     # 準備數據（如果df_stats已定義，使用它；否則使用df_raw並重命名）
     if 'df_stats' in locals() and not df_stats.empty:
-        df_chart = df_stats.copy()
+        df_chart = df_stats
     else:
         df_chart = df_raw.copy()
         if not df_chart.empty:
@@ -3868,6 +6061,9 @@ with st.container():
             df_chart = df_chart.rename(columns=mapping)
     
     if not df_chart.empty:
+        # 只傳聚合後的小表給 Altair（SQL GROUP BY + 版本快取），避免每次 rerun 送出整份明細
+        chart_data = get_chart_aggregates(user_email, df_chart)
+
         # 三列布局，使图表更紧凑
         chart_col1, chart_col2, chart_col3 = st.columns(3)
         
@@ -3877,156 +6073,101 @@ with st.container():
         with chart_col1:
             # 圓餅圖 - 會計科目分布
             st.markdown("**會計科目分布**")
-            if "會計科目" in df_chart.columns:
-                df_pie = df_chart[df_chart['會計科目'].notna() & (df_chart['會計科目'] != 'No')].copy()
-                if not df_pie.empty:
-                    # 使用参考图片的颜色方案（蓝色系）
-                    chart = alt.Chart(df_pie).mark_arc(innerRadius=25).encode(
-                        theta=alt.Theta("count()", type="quantitative"),
-                        color=alt.Color("會計科目", type="nominal", 
-                                       scale=alt.Scale(scheme='blues')),
-                        tooltip=["會計科目", "count()"]
-                    ).properties(
-                        height=chart_height,
-                        background='#2F2F2F'
-                    ).configure_legend(
-                        labelFontSize=14,
-                        titleFontSize=14,
-                        labelColor='#E0E0E0',
-                        titleColor='#FFFFFF'
-                    ).configure_axis(
-                        labelFontSize=14,
-                        titleFontSize=0,
-                        labelColor='#E0E0E0',
-                        titleColor='#FFFFFF',
-                        gridColor='#3F3F3F',
-                        domainColor='#5F5F5F'
-                    ).configure_text(
-                        fontSize=14
-                    )
-                    st.altair_chart(chart, use_container_width=True, theme='streamlit')
-                else:
-                    st.info("📊 暫無數據", icon="ℹ️")
-            elif "subject" in df_raw.columns:
-                df_pie = df_raw[df_raw['subject'].notna() & (df_raw['subject'] != 'No')].copy()
-                if not df_pie.empty:
-                    chart = alt.Chart(df_pie).mark_arc(innerRadius=30).encode(
-                        theta=alt.Theta("count()", type="quantitative"),
-                        color=alt.Color("subject", type="nominal"),
-                        tooltip=["subject", "count()"]
-                    ).properties(height=chart_height).configure_legend(
-                        labelFontSize=9,
-                        titleFontSize=10
-                    ).configure_axis(
-                        labelFontSize=9,
-                        titleFontSize=10
-                    )
-                    st.altair_chart(chart, use_container_width=True)
-                else:
-                    st.info("📊 暫無數據", icon="ℹ️")
+            df_pie = chart_data["pie"]
+            if not df_pie.empty:
+                # 使用参考图片的颜色方案（蓝色系）
+                chart = alt.Chart(df_pie).mark_arc(innerRadius=25).encode(
+                    theta=alt.Theta("數量", type="quantitative"),
+                    color=alt.Color("會計科目", type="nominal", 
+                                   scale=alt.Scale(scheme='blues')),
+                    tooltip=["會計科目", "數量"]
+                ).properties(
+                    height=chart_height,
+                    background='#2F2F2F'
+                ).configure_legend(
+                    labelFontSize=14,
+                    titleFontSize=14,
+                    labelColor='#E0E0E0',
+                    titleColor='#FFFFFF'
+                ).configure_axis(
+                    labelFontSize=14,
+                    titleFontSize=0,
+                    labelColor='#E0E0E0',
+                    titleColor='#FFFFFF',
+                    gridColor='#3F3F3F',
+                    domainColor='#5F5F5F'
+                ).configure_text(
+                    fontSize=14
+                )
+                st.altair_chart(chart, use_container_width=True, theme='streamlit')
             else:
                 st.info("📊 暫無數據", icon="ℹ️")
         
         with chart_col2:
             # 折線圖 - 每日支出趨勢
             st.markdown("**每日支出趨勢**")
-            if "日期" in df_chart.columns and "總計" in df_chart.columns:
-                df_line = df_chart.copy()
-                df_line['日期'] = pd.to_datetime(df_line['日期'], errors='coerce', format='%Y/%m/%d')
-                df_line = df_line.dropna(subset=['日期'])
-                
-                if not df_line.empty:
-                    df_line_grouped = df_line.groupby('日期')['總計'].sum().reset_index()
-                    df_line_grouped = df_line_grouped.sort_values('日期')
-                    
-                    # 使用参考图片的颜色（绿色线条）
-                    line_chart = alt.Chart(df_line_grouped).mark_line(
-                        point=True, 
-                        strokeWidth=3,
-                        color='#34A853'  # 绿色，参考图片
-                    ).encode(
-                        x=alt.X('日期:T', title='', axis=alt.Axis(format='%Y/%m/%d')),
-                        y=alt.Y('總計:Q', title='', axis=alt.Axis(format='$,.0f')),
-                        tooltip=[alt.Tooltip('日期:T', format='%Y/%m/%d', title='日期'), alt.Tooltip('總計:Q', format='$,.0f', title='金額')]
-                    ).properties(
-                        height=chart_height,
-                        background='#2F2F2F'
-                    ).configure_axis(
-                        labelFontSize=14,
-                        titleFontSize=0,
-                        labelColor='#E0E0E0',
-                        titleColor='#FFFFFF',
-                        gridColor='#3F3F3F',
-                        domainColor='#5F5F5F'
-                    ).configure_text(
-                        fontSize=14
-                    ).configure_legend(
-                        labelFontSize=14,
-                        titleFontSize=14
-                    )
-                    st.altair_chart(line_chart, use_container_width=True, theme='streamlit')
-                else:
-                    st.info("📈 暫無數據", icon="ℹ️")
+            df_line_grouped = chart_data["line"]
+            if not df_line_grouped.empty:
+                # 使用参考图片的颜色（绿色线条）
+                line_chart = alt.Chart(df_line_grouped).mark_line(
+                    point=True, 
+                    strokeWidth=3,
+                    color='#34A853'  # 绿色，参考图片
+                ).encode(
+                    x=alt.X('日期:T', title='', axis=alt.Axis(format='%Y/%m/%d')),
+                    y=alt.Y('總計:Q', title='', axis=alt.Axis(format='$,.0f')),
+                    tooltip=[alt.Tooltip('日期:T', format='%Y/%m/%d', title='日期'), alt.Tooltip('總計:Q', format='$,.0f', title='金額')]
+                ).properties(
+                    height=chart_height,
+                    background='#2F2F2F'
+                ).configure_axis(
+                    labelFontSize=14,
+                    titleFontSize=0,
+                    labelColor='#E0E0E0',
+                    titleColor='#FFFFFF',
+                    gridColor='#3F3F3F',
+                    domainColor='#5F5F5F'
+                ).configure_text(
+                    fontSize=14
+                ).configure_legend(
+                    labelFontSize=14,
+                    titleFontSize=14
+                )
+                st.altair_chart(line_chart, use_container_width=True, theme='streamlit')
             else:
                 st.info("📈 暫無數據", icon="ℹ️")
         
         with chart_col3:
             # 柱狀圖 - 類型分布
             st.markdown("**類型分布**")
-            if "類型" in df_chart.columns:
-                df_bar = df_chart[df_chart['類型'].notna() & (df_chart['類型'] != 'No')].copy()
-                if not df_bar.empty:
-                    df_bar_grouped = df_bar.groupby('類型').size().reset_index(name='數量')
-                    df_bar_grouped = df_bar_grouped.sort_values('數量', ascending=False).head(10)  # 只顯示前10個
-                    
-                    # 使用参考图片的颜色（蓝色/青色柱状图）
-                    bar_chart = alt.Chart(df_bar_grouped).mark_bar(
-                        color='#4285F4',  # 蓝色，参考图片
-                        cornerRadiusTopLeft=2,
-                        cornerRadiusTopRight=2
-                    ).encode(
-                        x=alt.X('類型:N', title='', sort='-y', axis=alt.Axis(labelAngle=0)),
-                        y=alt.Y('數量:Q', title=''),
-                        tooltip=[alt.Tooltip('類型:N', title='類型'), alt.Tooltip('數量:Q', title='數量')]
-                    ).properties(
-                        height=chart_height,
-                        background='#2F2F2F'
-                    ).configure_axis(
-                        labelFontSize=14,
-                        titleFontSize=0,
-                        labelColor='#E0E0E0',
-                        titleColor='#FFFFFF',
-                        gridColor='#3F3F3F',
-                        domainColor='#5F5F5F'
-                    ).configure_text(
-                        fontSize=14
-                    ).configure_legend(
-                        labelFontSize=14,
-                        titleFontSize=14
-                    )
-                    st.altair_chart(bar_chart, use_container_width=True, theme='streamlit')
-                else:
-                    st.info("📊 暫無數據", icon="ℹ️")
-            elif "category" in df_raw.columns:
-                df_bar = df_raw[df_raw['category'].notna() & (df_raw['category'] != 'No')].copy()
-                if not df_bar.empty:
-                    df_bar_grouped = df_bar.groupby('category').size().reset_index(name='數量')
-                    df_bar_grouped = df_bar_grouped.sort_values('數量', ascending=False).head(10)
-                    
-                    bar_chart = alt.Chart(df_bar_grouped).mark_bar().encode(
-                        x=alt.X('category:N', title='類型', sort='-y'),
-                        y=alt.Y('數量:Q', title='數量'),
-                        color=alt.Color('category:N', legend=None),
-                        tooltip=['category', '數量']
-                    ).properties(
-                        height=chart_height
-                    ).configure_axis(
-                        labelFontSize=9,
-                        titleFontSize=10
-                    )
-                    st.altair_chart(bar_chart, use_container_width=True)
-                else:
-                    st.info("📊 暫無數據", icon="ℹ️")
+            df_bar_grouped = chart_data["bar"]  # 只顯示前10個
+            if not df_bar_grouped.empty:
+                # 使用参考图片的颜色（蓝色/青色柱状图）
+                bar_chart = alt.Chart(df_bar_grouped).mark_bar(
+                    color='#4285F4',  # 蓝色，参考图片
+                    cornerRadiusTopLeft=2,
+                    cornerRadiusTopRight=2
+                ).encode(
+                    x=alt.X('類型:N', title='', sort='-y', axis=alt.Axis(labelAngle=0)),
+                    y=alt.Y('數量:Q', title=''),
+                    tooltip=[alt.Tooltip('類型:N', title='類型'), alt.Tooltip('數量:Q', title='數量')]
+                ).properties(
+                    height=chart_height,
+                    background='#2F2F2F'
+                ).configure_axis(
+                    labelFontSize=14,
+                    titleFontSize=0,
+                    labelColor='#E0E0E0',
+                    titleColor='#FFFFFF',
+                    gridColor='#3F3F3F',
+                    domainColor='#5F5F5F'
+                ).configure_text(
+                    fontSize=14
+                ).configure_legend(
+                    labelFontSize=14,
+                    titleFontSize=14
+                )
+                st.altair_chart(bar_chart, use_container_width=True, theme='streamlit')
             else:
                 st.info("📊 暫無數據", icon="ℹ️")
     else:
@@ -4115,8 +6256,8 @@ with st.container():
     filter_row1, filter_row2, filter_row3 = st.columns([2, 1, 1])
     with filter_row1:
         search = st.text_input(
-            "搜尋發票號碼或賣方名稱",
-            placeholder="輸入發票號碼、賣方名稱或檔名...",
+            "搜尋發票號碼、賣方名稱或備註",
+            placeholder="輸入發票號碼、賣方名稱、備註、科目或檔名...",
             label_visibility="visible",
             key="main_search_input"
         )
@@ -4179,69 +6320,75 @@ with st.container():
     view_mode = st.radio("視圖", ["📋 按單張", "📦 按組"], horizontal=True, key="invoice_view_mode", label_visibility="collapsed", index=0)
     is_group_view = view_mode == "📦 按組"
     if not is_group_view and not df_base.empty:
-        df = df_base.copy()
-        df_before_search = len(df)
-        search_term = (search or "").strip().lower()
-        if search_term:
-            def _safe_search_val(val):
-                if val is None: return ""
-                try:
-                    if pd.isna(val): return ""
-                except Exception:
-                    pass
-                return str(val).strip()
-            def match_row(row):
-                parts = [_safe_search_val(row.get(col, "")) for col in ["發票號碼", "賣方名稱", "檔案名稱"]]
-                return search_term in " ".join(parts).lower()
-            df = df[df.apply(match_row, axis=1)]
-            if len(df) == 0 and df_before_search > 0:
-                st.info(f"💡 搜尋「{search}」沒有匹配到任何數據（已過濾 {df_before_search} 筆）")
-        status_filter = st.session_state.get("status_filter_pills", "全部")
-        if status_filter != "全部" and "狀態" in df.columns:
-            if status_filter == "正常":
-                df = df[df["狀態"].astype(str).str.contains("正常", na=False)]
-            elif status_filter == "缺失":
-                df = df[df["狀態"].astype(str).str.contains("缺失|缺漏|❌", na=False, regex=True)]
-        date_start = st.session_state.get("date_range_start")
-        date_end = st.session_state.get("date_range_end")
-        if date_start is not None and date_end is not None and "日期" in df.columns:
-            date_col = "日期"
-            try:
-                df[date_col] = pd.to_datetime(df[date_col], errors='coerce', format='%Y/%m/%d')
-                valid_dates_mask = df[date_col].notna()
-                date_filter_mask = (df[date_col].dt.date >= date_start) & (df[date_col].dt.date <= date_end)
-                df = df[valid_dates_mask & date_filter_mask]
-            except Exception:
-                try:
-                    def date_in_range(date_str):
-                        try:
-                            date_val = datetime.strptime(str(date_str), "%Y/%m/%d").date()
-                            return date_start <= date_val <= date_end
-                        except Exception:
-                            return False
-                    df = df[df[date_col].astype(str).apply(date_in_range)]
-                except Exception:
-                    pass
-        filter_subjects = st.session_state.get("filter_subjects", [])
-        if filter_subjects and "會計科目" in df.columns:
-            df = df[df["會計科目"].astype(str).isin(filter_subjects)]
-        filter_categories = st.session_state.get("filter_categories", [])
-        if filter_categories and "類型" in df.columns:
-            df = df[df["類型"].astype(str).isin(filter_categories)]
-        if "總計" in df.columns:
-            total_num = pd.to_numeric(df["總計"].astype(str).str.replace(",", ""), errors="coerce").fillna(0)
-            amount_min = st.session_state.get("filter_amount_min", 0) or 0
-            amount_max = st.session_state.get("filter_amount_max", 0) or 0
-            mask = pd.Series(True, index=df.index)
-            if amount_min > 0: mask = mask & (total_num >= amount_min)
-            if amount_max > 0: mask = mask & (total_num <= amount_max)
-            df = df[mask]
+        _filters = {
+            "search": search,
+            "status": st.session_state.get("status_filter_pills", "全部"),
+            "date_start": st.session_state.get("date_range_start"),
+            "date_end": st.session_state.get("date_range_end"),
+            "subjects": st.session_state.get("filter_subjects", []),
+            "categories": st.session_state.get("filter_categories", []),
+            "amount_min": st.session_state.get("filter_amount_min", 0) or 0,
+            "amount_max": st.session_state.get("filter_amount_max", 0) or 0,
+        }
+        # 資料庫模式：篩選下推至 SQL（索引欄位）只取符合的 id；內存模式用同語意的 pandas 篩選
+        _matched_ids = filter_invoice_ids(user_email, _filters) if "id" in df_base.columns else None
+        if _matched_ids is not None:
+            df = df_base[df_base["id"].isin(_matched_ids)].copy()
+        else:
+            df = filter_invoices_frame(df_base, _filters).copy()
+        if (search or "").strip() and df.empty:
+            st.info(f"💡 搜尋「{search}」沒有匹配到任何數據（已過濾 {len(df_base)} 筆）")
+
+        # CSV 與 PDF 明細使用完整篩選結果（表格只渲染目前這一頁）；Excel 與 PDF 統計涵蓋全部發票（df_stats）
+        _export_drop = ("image_data", "imageData", "image_path", "image_sha256", "id", "user_id", "user_email", "日期_parsed")
+        df_export = df.drop(columns=[c for c in _export_drop if c in df.columns])
+        df_export_all = df_stats.drop(columns=[c for c in _export_drop if c in df_stats.columns]) if not df_stats.empty else df_export
+        _summary = summarize_filtered_invoices(user_email, _filters, df)
+        # 篩選或每頁筆數改變時回到第一頁（游標堆疊：每頁起點 id，第一頁為 None）
+        _page_size = st.session_state.get("invoice_page_size", INVOICE_PAGE_SIZES[1])
+        _filter_sig = repr(sorted((k, str(v)) for k, v in _filters.items()))
+        if st.session_state.get("invoice_page_sig") != (_filter_sig, _page_size):
+            if (st.session_state.get("invoice_page_sig") or (None,))[0] != _filter_sig:
+                # 篩選改變時清除勾選，避免刪除到目前看不到的記錄
+                st.session_state.selected_invoice_ids = set()
+            st.session_state.invoice_page_sig = (_filter_sig, _page_size)
+            st.session_state.invoice_page_cursors = [None]
+        _cursors = st.session_state.setdefault("invoice_page_cursors", [None])
+        df, _next_cursor = keyset_page(df, _cursors[-1], _page_size)
+        if df.empty and len(_cursors) > 1:
+            # 刪除後本頁已無資料：退回第一頁
+            st.session_state.invoice_page_cursors = _cursors = [None]
+            df, _next_cursor = keyset_page(df_base[df_base["id"].isin(_matched_ids)] if _matched_ids is not None else filter_invoices_frame(df_base, _filters), None, _page_size)
+        _page_no = len(_cursors)
+        _first = (_page_no - 1) * _page_size + 1 if not df.empty else 0
+
+        def _goto_next_page(cursor):
+            st.session_state.invoice_page_cursors.append(cursor)
+
+        def _goto_prev_page():
+            if len(st.session_state.invoice_page_cursors) > 1:
+                st.session_state.invoice_page_cursors.pop()
+
+        pg1, pg2, pg3, pg4 = st.columns([3, 1, 1, 1])
+        with pg1:
+            st.caption(
+                f"共 {_summary['count']:,} 筆 · 合計 ${_summary['total']:,.0f} · 稅額 ${_summary['tax']:,.0f}"
+                f"　｜　第 {_page_no} 頁（第 {_first:,}–{_first + len(df) - 1 if len(df) else 0:,} 筆）"
+            )
+        with pg2:
+            st.selectbox("每頁筆數", INVOICE_PAGE_SIZES, index=INVOICE_PAGE_SIZES.index(_page_size) if _page_size in INVOICE_PAGE_SIZES else 1,
+                         key="invoice_page_size", label_visibility="collapsed")
+        with pg3:
+            st.button("← 上一頁", disabled=_page_no <= 1, use_container_width=True, key="invoice_page_prev", on_click=_goto_prev_page)
+        with pg4:
+            st.button("下一頁 →", disabled=_next_cursor is None, use_container_width=True, key="invoice_page_next",
+                      on_click=_goto_next_page, args=(_next_cursor,))
 
     st.caption("💡 篩選在 **按單張** 視圖生效；**按組** 可導出全部。")
     # 操作按鈕（刪除、CSV、Excel、PDF）已移至「按單張」視圖中「共 N 筆…」說明下方
     # 移除image相關的列
     if not df.empty:
-        columns_to_drop = ['image_data', 'imageData', 'image_path']  # 移除所有圖片相關列
+        columns_to_drop = ['image_data', 'imageData', 'image_path', 'image_sha256']  # 移除所有圖片相關列
         for col in columns_to_drop:
             if col in df.columns:
                 df = df.drop(columns=[col])
@@ -4255,19 +6402,6 @@ with st.container():
             if col in df.columns:
                 df = df.drop(columns=[col])
     
-    # 修復 Bug #3: 在篩選前保存原始索引映射，以便刪除功能正常工作
-    # 將df_with_id保存到session_state，確保刪除功能可以訪問
-    if 'df_with_id' in locals() and df_with_id is not None:
-        # 創建索引到ID的映射，保存到session_state
-        if 'id' in df_with_id.columns:
-            # 創建一個映射：df的索引 -> id
-            index_to_id_map = {}
-            for idx in df_with_id.index:
-                if idx in df.index:
-                    index_to_id_map[idx] = df_with_id.loc[idx, 'id']
-            st.session_state.index_to_id_map = index_to_id_map
-        st.session_state.df_with_id = df_with_id.copy()
-    
     if not df.empty and df_with_id is not None:
         # 保存原始索引到df中（在篩選前），用於刪除功能
         df['_original_index'] = df.index
@@ -4379,6 +6513,13 @@ with st.container():
                     tl += f'<li class="detail-timeline-item"><span class="detail-timeline-dot"></span><span class="detail-timeline-text">{_esc(desc)}</span><span class="detail-timeline-time">{_esc(ts)}</span></li>'
                 tl += "</ul></div>"
                 st.markdown(tl, unsafe_allow_html=True)
+                # 影像：優先顯示預先產生的縮圖，舊資料才讀原圖
+                _thumb = blob_thumbnail_path(_row.get("image_sha256"))
+                _img_path = str(_row.get("image_path") or "")
+                if _thumb:
+                    st.image(_thumb, caption="發票影像", use_container_width=True)
+                elif _img_path and os.path.exists(_img_path):
+                    st.image(_img_path, caption="發票影像", use_container_width=True)
                 if st.button("關閉", key="detail_dialog_close"):
                     st.session_state.detail_invoice_id = None
                     st.rerun()
@@ -4386,38 +6527,44 @@ with st.container():
 
     if is_group_view:
         # ---------- 按組：組摘要表 + 可展開明細 + 刪除確認 dialog ----------
-        batches_list = get_batches_for_user(_user_email)
-        ungrouped_df = get_ungrouped_invoices(_user_email)
-        if not batches_list and ungrouped_df.empty:
+        # 組摘要以單一聚合查詢取得；明細只在展開區塊時載入，且每組最多 GROUP_VIEW_ROWS_PER_BATCH 筆
+        batches_list, ungrouped_summary = get_batch_summaries(_user_email)
+        if not batches_list and not ungrouped_summary['invoice_count']:
             st.info("📊 目前沒有數據，請上傳發票圖片或導入 CSV 數據。")
         else:
             st.caption("💡 切換至「按單張」可顯示並編輯數據表格。")
+            _n_batch_pages = max(1, -(-len(batches_list) // GROUP_VIEW_BATCHES_PER_PAGE))
+            _batch_page = min(st.session_state.get("group_view_page", 0), _n_batch_pages - 1)
+            page_batches = batches_list[_batch_page * GROUP_VIEW_BATCHES_PER_PAGE:(_batch_page + 1) * GROUP_VIEW_BATCHES_PER_PAGE]
             # 組摘要表（一覽：建立時間、來源、張數、合計、稅額）
             summary_rows = []
-            for b in batches_list:
-                inv_df = get_invoices_by_batch(b['id'], _user_email)
-                if inv_df.empty:
-                    continue
+            for b in page_batches:
                 created = (b.get('created_at') or '')[:16].replace('T', ' ')
                 src = 'OCR' if (b.get('source') or '') == 'ocr' else '導入'
-                total_sum = pd.to_numeric(inv_df.get('總計', 0), errors='coerce').fillna(0).sum()
-                tax_sum = pd.to_numeric(inv_df.get('稅額', 0), errors='coerce').fillna(0).sum() if '稅額' in inv_df.columns else 0
-                summary_rows.append({"建立時間": created, "來源": src, "張數": len(inv_df), "合計": f"${total_sum:,.0f}", "稅額": f"${tax_sum:,.0f}"})
-            if not ungrouped_df.empty:
-                total_ug = pd.to_numeric(ungrouped_df.get('總計', 0), errors='coerce').fillna(0).sum()
-                tax_ug = pd.to_numeric(ungrouped_df.get('稅額', 0), errors='coerce').fillna(0).sum() if '稅額' in ungrouped_df.columns else 0
-                summary_rows.append({"建立時間": "未分組", "來源": "-", "張數": len(ungrouped_df), "合計": f"${total_ug:,.0f}", "稅額": f"${tax_ug:,.0f}"})
+                summary_rows.append({"建立時間": created, "來源": src, "張數": b['invoice_count'], "合計": f"${b['total_sum']:,.0f}", "稅額": f"${b['tax_sum']:,.0f}"})
+            if ungrouped_summary['invoice_count']:
+                summary_rows.append({"建立時間": "未分組", "來源": "-", "張數": ungrouped_summary['invoice_count'], "合計": f"${ungrouped_summary['total_sum']:,.0f}", "稅額": f"${ungrouped_summary['tax_sum']:,.0f}"})
             if summary_rows:
                 st.dataframe(pd.DataFrame(summary_rows), use_container_width=True, hide_index=True)
-            for b in batches_list:
-                inv_df = get_invoices_by_batch(b['id'], _user_email)
-                if inv_df.empty:
-                    continue
+            if _n_batch_pages > 1:
+                gp1, gp2, gp3 = st.columns([3, 1, 1])
+                with gp1:
+                    st.caption(f"共 {len(batches_list)} 組 · 第 {_batch_page + 1}/{_n_batch_pages} 頁")
+                with gp2:
+                    if st.button("← 上一頁", disabled=_batch_page <= 0, use_container_width=True, key="group_page_prev"):
+                        st.session_state.group_view_page = _batch_page - 1
+                        st.rerun()
+                with gp3:
+                    if st.button("下一頁 →", disabled=_batch_page >= _n_batch_pages - 1, use_container_width=True, key="group_page_next"):
+                        st.session_state.group_view_page = _batch_page + 1
+                        st.rerun()
+            for b in page_batches:
                 created = (b.get('created_at') or '')[:16].replace('T', ' ')
                 src = 'OCR' if (b.get('source') or '') == 'ocr' else '導入'
-                total_sum = pd.to_numeric(inv_df.get('總計', 0), errors='coerce').fillna(0).sum()
-                tax_sum = pd.to_numeric(inv_df.get('稅額', 0), errors='coerce').fillna(0).sum() if '稅額' in inv_df.columns else 0
-                with st.expander(f"📦 {created} · {src} · {len(inv_df)} 張 · 合計 ${total_sum:,.0f}", expanded=False):
+                total_sum = b['total_sum']
+                tax_sum = b['tax_sum']
+                with st.expander(f"📦 {created} · {src} · {b['invoice_count']} 張 · 合計 ${total_sum:,.0f}", expanded=False):
+                    inv_df = get_invoices_by_batch(b['id'], _user_email, limit=GROUP_VIEW_ROWS_PER_BATCH)
                     # 本組摘要：總計 | 稅額 | 張數（4px/8px 網格）
                     sum_col1, sum_col2, sum_col3 = st.columns(3)
                     with sum_col1:
@@ -4425,7 +6572,7 @@ with st.container():
                     with sum_col2:
                         st.markdown('<div class="batch-summary-item"><span class="batch-summary-label">稅額</span><span class="batch-summary-value">${:,.0f}</span></div>'.format(tax_sum), unsafe_allow_html=True)
                     with sum_col3:
-                        st.markdown('<div class="batch-summary-item"><span class="batch-summary-label">張數</span><span class="batch-summary-value">{}</span></div>'.format(len(inv_df)), unsafe_allow_html=True)
+                        st.markdown('<div class="batch-summary-item"><span class="batch-summary-label">張數</span><span class="batch-summary-value">{}</span></div>'.format(b['invoice_count']), unsafe_allow_html=True)
                     # 組內每條：日期、號碼、廠商、總計、狀態、查看詳情（點擊彈出框）
                     st.markdown('<div class="master-list-table-wrap"><table class="master-list-table"><thead><tr><th class="master-list-th col-date">日期</th><th class="master-list-th col-num">號碼</th><th class="master-list-th col-vendor">廠商</th><th class="master-list-th col-amount">總計</th><th class="master-list-th col-status">狀態</th><th class="master-list-th col-action">操作</th></tr></thead></table></div>', unsafe_allow_html=True)
                     for _, inv_row in inv_df.iterrows():
@@ -4454,20 +6601,23 @@ with st.container():
                             if st.button("查看詳情", key=f"detail_inv_{inv_id}", type="secondary"):
                                 st.session_state.detail_invoice_id = inv_id
                                 st.rerun()
+                    if b['invoice_count'] > len(inv_df):
+                        st.caption(f"僅顯示前 {len(inv_df)} 張，完整明細請至「按單張」視圖篩選。")
                     if st.button("🗑️ 刪除此組", key=f"del_batch_{b['id']}", type="secondary"):
                         st.session_state["pending_delete_batch_id"] = b["id"]
                         st.rerun()
-            if not ungrouped_df.empty:
-                total_ug = pd.to_numeric(ungrouped_df.get('總計', 0), errors='coerce').fillna(0).sum()
-                tax_ug = pd.to_numeric(ungrouped_df.get('稅額', 0), errors='coerce').fillna(0).sum() if '稅額' in ungrouped_df.columns else 0
-                with st.expander(f"📄 未分組 ({len(ungrouped_df)} 張) · 合計 ${total_ug:,.0f}", expanded=False):
+            if ungrouped_summary['invoice_count']:
+                total_ug = ungrouped_summary['total_sum']
+                tax_ug = ungrouped_summary['tax_sum']
+                with st.expander(f"📄 未分組 ({ungrouped_summary['invoice_count']} 張) · 合計 ${total_ug:,.0f}", expanded=False):
+                    ungrouped_df = get_ungrouped_invoices(_user_email, limit=GROUP_VIEW_ROWS_PER_BATCH)
                     sum_col1, sum_col2, sum_col3 = st.columns(3)
                     with sum_col1:
                         st.markdown('<div class="batch-summary-item"><span class="batch-summary-label">總計</span><span class="batch-summary-value">${:,.0f}</span></div>'.format(total_ug), unsafe_allow_html=True)
                     with sum_col2:
                         st.markdown('<div class="batch-summary-item"><span class="batch-summary-label">稅額</span><span class="batch-summary-value">${:,.0f}</span></div>'.format(tax_ug), unsafe_allow_html=True)
                     with sum_col3:
-                        st.markdown('<div class="batch-summary-item"><span class="batch-summary-label">張數</span><span class="batch-summary-value">{}</span></div>'.format(len(ungrouped_df)), unsafe_allow_html=True)
+                        st.markdown('<div class="batch-summary-item"><span class="batch-summary-label">張數</span><span class="batch-summary-value">{}</span></div>'.format(ungrouped_summary['invoice_count']), unsafe_allow_html=True)
                     st.markdown('<div class="master-list-table-wrap"><table class="master-list-table"><thead><tr><th class="master-list-th col-date">日期</th><th class="master-list-th col-num">號碼</th><th class="master-list-th col-vendor">廠商</th><th class="master-list-th col-amount">總計</th><th class="master-list-th col-status">狀態</th><th class="master-list-th col-action">操作</th></tr></thead></table></div>', unsafe_allow_html=True)
                     for _, inv_row in ungrouped_df.iterrows():
                         inv_id = inv_row.get('id')
@@ -4495,6 +6645,8 @@ with st.container():
                             if st.button("查看詳情", key=f"detail_ug_{inv_id}", type="secondary"):
                                 st.session_state.detail_invoice_id = inv_id
                                 st.rerun()
+                    if ungrouped_summary['invoice_count'] > len(ungrouped_df):
+                        st.caption(f"僅顯示前 {len(ungrouped_df)} 張，完整明細請至「按單張」視圖篩選。")
             # 刪除 Batch 確認：使用 dialog，避免置頂混淆
             if st.session_state.get("pending_delete_batch_id") is not None:
                 _bid = st.session_state["pending_delete_batch_id"]
@@ -4603,7 +6755,7 @@ with st.container():
                 df['狀態'] = df.apply(check_status, axis=1)
             
             # 再次確保移除image相關的列
-            columns_to_drop = ['image_data', 'imageData', 'image_path']
+            columns_to_drop = ['image_data', 'imageData', 'image_path', 'image_sha256']
             for col in columns_to_drop:
                 if col in df.columns:
                     df = df.drop(columns=[col])
@@ -4615,10 +6767,7 @@ with st.container():
                 if 'id' not in df.columns:
                     # 通過索引匹配，將id從df_with_id複製到df
                     df = df.copy()
-                    df['id'] = None
-                    for idx in df.index:
-                        if idx in df_with_id.index:
-                            df.loc[idx, 'id'] = df_with_id.loc[idx, 'id']
+                    df['id'] = df_with_id['id'].reindex(df.index)
             
             # 移除其他不需要顯示的列（保留「總計」供前端表格使用）
             columns_to_hide = ['user_id', 'user_email', '檔案名稱']
@@ -4667,7 +6816,9 @@ with st.container():
             
             # 調整列順序：選取 -> 狀態 -> 其他列（id列保留但不顯示）
             if "選取" not in df.columns: 
-                df.insert(0, "選取", False)
+                # 勾選狀態以 id 保存在 selected_invoice_ids，換頁後仍保留
+                _selected_ids = st.session_state.setdefault("selected_invoice_ids", set())
+                df.insert(0, "選取", df["id"].isin(_selected_ids) if "id" in df.columns else False)
             
             # 將狀態列移到選取列之後
             if "狀態" in df.columns:
@@ -4849,6 +7000,9 @@ with st.container():
                                 
                                     conn.commit()
                                     conn.close()
+                                    if deleted_count > 0:
+                                        bump_data_version(user_email)
+                                        gc_image_blobs()
                                 
                                     if deleted_count == 0 and not errors:
                                         errors.append("未找到要刪除的記錄，可能已被刪除或數據不匹配")
@@ -4858,6 +7012,7 @@ with st.container():
                         
                             # 清理狀態
                             st.session_state.show_delete_confirm = False
+                            st.session_state.selected_invoice_ids = set()
                             if "delete_records" in st.session_state:
                                 del st.session_state.delete_records
                             if "delete_count" in st.session_state:
@@ -4985,7 +7140,7 @@ with st.container():
                         delete_button_top = False
             with act_col2:
                 if not df.empty:
-                    csv_data = df.to_csv(index=False).encode('utf-8-sig')
+                    csv_data = df_export.drop(columns=["檔案名稱"], errors="ignore").to_csv(index=False).encode('utf-8-sig')
                     st.download_button(
                         "📥 CSV",
                         csv_data,
@@ -4997,23 +7152,10 @@ with st.container():
             with act_col3:
                 if not df.empty:
                     def _gen_excel():
-                        export_df = df_stats.copy() if ('df_stats' in locals() and not getattr(df_stats, 'empty', True)) else df.copy()
+                        export_df = df_export_all.copy()
                         if export_df.empty:
                             return b""
-                        total_series = pd.to_numeric(export_df.get('總計', 0), errors='coerce').fillna(0)
-                        subtotal_series = pd.to_numeric(export_df.get('銷售額', 0), errors='coerce').fillna(0)
-                        tax_series = pd.to_numeric(export_df.get('稅額', 0), errors='coerce').fillna(0)
-                        tax_type_col = export_df.get('稅率類型')
-                        if tax_type_col is None:
-                            tax_type_col = pd.Series('5%', index=export_df.index)
-                        tax_type_str = tax_type_col.fillna('5%').astype(str).str.strip().str.lower()
-                        is_zero_or_exempt = tax_type_str.isin(['0%', 'exempt', '零稅率', '免稅'])
-                        need_recalc = ((subtotal_series == 0) | (tax_series == 0)) & (total_series > 0)
-                        if need_recalc.any():
-                            calc_tax = pd.Series(0.0, index=export_df.index).where(is_zero_or_exempt, (total_series - (total_series / 1.05)).round(0))
-                            calc_subtotal = (total_series - calc_tax).round(0)
-                            tax_series = tax_series.where(~need_recalc, calc_tax)
-                            subtotal_series = subtotal_series.where(~need_recalc, calc_subtotal)
+                        subtotal_series, tax_series, total_series = compute_invoice_amounts(export_df)
                         if '銷售額' in export_df.columns:
                             export_df = export_df.rename(columns={'銷售額': '銷售額(未稅)'})
                         else:
@@ -5038,30 +7180,15 @@ with st.container():
                             if c not in seen and c not in ['日期_parsed', 'date', 'Date']:
                                 columns.append(c)
                                 seen.add(c)
-                        export_df = export_df[columns].copy()
-                        output = io.BytesIO()
-                        with pd.ExcelWriter(output, engine="openpyxl") as writer:
-                            export_df.to_excel(writer, index=False, sheet_name="發票報表")
-                            ws = writer.sheets["發票報表"]
-                            header_font = Font(bold=True)
-                            col_width_hint = {"賣方名稱": 20, "備註": 18, "發票號碼": 14, "檔案名稱": 24}
-                            for col_cells in ws.iter_cols(min_row=1, max_row=1):
-                                for cell in col_cells:
-                                    cell.font = header_font
-                                    col_letter = cell.column_letter
-                                    hint = col_width_hint.get(str(cell.value), 0)
-                                    ws.column_dimensions[col_letter].width = max(12, hint, len(str(cell.value or "")) + 2)
-                            ws.freeze_panes = "A2"
-                            amount_headers = {"銷售額(未稅)", "稅額", "總計"}
-                            header_map = {cell.value: cell.column for cell in ws[1] if cell.value}
-                            for header in amount_headers:
-                                col_idx = header_map.get(header)
-                                if col_idx is not None:
-                                    for cell in ws.iter_rows(min_row=2, min_col=col_idx, max_col=col_idx):
-                                        c = cell[0]
-                                        c.number_format = '#,##0'
-                                        c.alignment = Alignment(horizontal='right')
-                        return output.getvalue()
+                        export_df = export_df[columns]
+                        from pdf_converter import write_xlsx_streaming
+                        return write_xlsx_streaming(
+                            [("發票報表", export_df)],
+                            column_formats={"銷售額(未稅)": "#,##0", "稅額": "#,##0", "總計": "#,##0"},
+                            column_widths={"賣方名稱": 20, "備註": 18, "發票號碼": 14, "檔案名稱": 24},
+                            default_width=12,
+                            freeze_header=True,
+                        )
                     excel_data = _gen_excel()
                     st.download_button(
                         "📊 導出Excel",
@@ -5069,169 +7196,20 @@ with st.container():
                         f"invoice_report_{datetime.now().strftime('%Y%m%d')}.xlsx",
                         mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
                         use_container_width=True,
-                        help="導出符合國稅局欄位結構的 Excel 報表"
+                        help="導出全部發票（不受篩選影響）為符合國稅局欄位結構的 Excel 報表"
                     )
             with act_col4:
                 if not df.empty:
                     if PDF_AVAILABLE:
                         def _gen_pdf():
-                            pdf = FPDF(orientation="L")
-                            pdf.set_auto_page_break(auto=True, margin=15)
-                            pdf.add_page()
-                            font_path = "NotoSansTC-Regular.ttf"
-                            font_loaded = False
-                            font_name = "NotoSansTC"
-                            if os.path.exists(font_path):
-                                try:
-                                    pdf.add_font(font_name, '', font_path, uni=True)
-                                    pdf.add_font(font_name, 'B', font_path, uni=True)
-                                    font_loaded = True
-                                except Exception:
-                                    font_loaded = False
-                            def safe_cell(pdf, w, h, txt, border=0, ln=0, align='', fill=False, link='', font_name_override=None):
-                                try:
-                                    if font_name_override:
-                                        pdf.set_font(font_name_override[0], font_name_override[1], font_name_override[2])
-                                    pdf.cell(w, h, txt, border, ln, align, fill, link)
-                                except Exception:
-                                    pdf.set_font('Arial', '', 10)
-                                    pdf.cell(w, h, str(txt)[:50], border, ln, align, fill, link)
-                            if font_loaded:
-                                pdf.set_font(font_name, 'B', 16)
-                                safe_cell(pdf, 0, 10, '發票報帳統計報表', ln=1, align='C')
-                            else:
-                                pdf.set_font('Arial', 'B', 16)
-                                safe_cell(pdf, 0, 10, 'Invoice Report', ln=1, align='C')
-                            pdf.ln(5)
-                            if font_loaded:
-                                pdf.set_font(font_name, '', 10)
-                                safe_cell(pdf, 0, 5, f'生成時間: {datetime.now().strftime("%Y年%m月%d日 %H:%M:%S")}', ln=1, align='R')
-                            else:
-                                pdf.set_font('Arial', '', 10)
-                                safe_cell(pdf, 0, 5, f'Generated: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}', ln=1, align='R')
-                            pdf.ln(5)
-                            if font_loaded:
-                                pdf.set_font(font_name, '', 10)
-                                company_name = st.session_state.get('company_name', '')
-                                company_ubn = st.session_state.get('company_ubn', '')
-                                if company_name:
-                                    safe_cell(pdf, 200, 10, txt=f"報支公司：{company_name}", ln=1)
-                                if company_ubn:
-                                    safe_cell(pdf, 200, 10, txt=f"公司統編：{company_ubn}", ln=1)
-                            else:
-                                pdf.set_font('Arial', '', 10)
-                                company_name = st.session_state.get('company_name', '')
-                                company_ubn = st.session_state.get('company_ubn', '')
-                                if company_name:
-                                    safe_cell(pdf, 200, 10, txt=f"Company: {company_name}", ln=1)
-                                if company_ubn:
-                                    safe_cell(pdf, 200, 10, txt=f"UBN: {company_ubn}", ln=1)
-                            pdf.ln(5)
-                            if font_loaded:
-                                pdf.set_font(font_name, 'B', 12)
-                                safe_cell(pdf, 0, 8, '統計摘要', ln=1)
-                                pdf.set_font(font_name, '', 10)
-                            else:
-                                pdf.set_font('Arial', 'B', 12)
-                                safe_cell(pdf, 0, 8, '統計摘要', ln=1)
-                                pdf.set_font('Arial', '', 10)
-                            safe_cell(pdf, 90, 6, '累計金額:', 1)
-                            export_df_for_stats = df_stats.copy() if 'df_stats' in locals() and not getattr(df_stats, 'empty', True) else df.copy()
-                            if "總計" in export_df_for_stats.columns:
-                                total_sum = pd.to_numeric(export_df_for_stats['總計'], errors='coerce').fillna(0).sum()
-                            else:
-                                total_sum = 0
-                            safe_cell(pdf, 90, 6, f"${total_sum:,.0f}", 1, ln=1)
-                            safe_cell(pdf, 90, 6, '累計稅額:', 1)
-                            if "稅額" in export_df_for_stats.columns:
-                                tax_sum = pd.to_numeric(export_df_for_stats['稅額'], errors='coerce').fillna(0).sum()
-                            else:
-                                tax_sum = 0
-                            safe_cell(pdf, 90, 6, f"${tax_sum:,.0f}", 1, ln=1)
-                            safe_cell(pdf, 90, 6, '發票總數:', 1)
-                            safe_cell(pdf, 90, 6, f"{len(export_df_for_stats)} 筆", 1, ln=1)
-                            pdf.ln(5)
-                            export_df = df.copy()
-                            try:
-                                if "檔案名稱" not in export_df.columns and not df_stats.empty and "檔案名稱" in df_stats.columns:
-                                    export_df["檔案名稱"] = df_stats.reindex(export_df.index)["檔案名稱"].fillna("").astype(str)
-                            except (NameError, AttributeError):
-                                pass
-                            if "檔案名稱" not in export_df.columns:
-                                export_df["檔案名稱"] = ""
-                            col_widths = [14, 18, 26, 14, 18, 14, 16, 10, 20, 28]
-                            if font_loaded:
-                                pdf.set_font(font_name, 'B', 9)
-                                headers = ["日期", "發票號碼", "賣方名稱", "賣方統編", "銷售額(未稅)", "稅額", "總計", "狀態", "備註", "檔案名稱"]
-                            else:
-                                pdf.set_font('Arial', 'B', 9)
-                                headers = ["Date", "Invoice No", "Seller", "UBN", "Net", "Tax", "Total", "Status", "Note", "File"]
-                            for i, header in enumerate(headers):
-                                safe_cell(pdf, col_widths[i], 7, header, 1, align='C')
-                            pdf.ln()
-                            if font_loaded:
-                                pdf.set_font(font_name, '', 8)
-                            else:
-                                pdf.set_font('Arial', '', 8)
-                            def pdf_safe_value(val, default='-'):
-                                if pd.isna(val) or val == '' or val == 'N/A' or str(val).strip() == '':
-                                    return default
-                                return str(val)
-                            page_height = 210
-                            y_break = page_height - 35
-                            for _, row in export_df.iterrows():
-                                total_val = pd.to_numeric(row.get('總計', row.get('total', 0)), errors='coerce')
-                                subtotal_val = pd.to_numeric(row.get('銷售額', row.get('subtotal', 0)), errors='coerce')
-                                tax_val = pd.to_numeric(row.get('稅額', row.get('tax', 0)), errors='coerce')
-                                if pd.isna(total_val):
-                                    total_val = 0
-                                if (pd.isna(subtotal_val) or subtotal_val == 0) or (pd.isna(tax_val) or tax_val == 0):
-                                    if total_val > 0:
-                                        tax_type_val = str(row.get('稅率類型', row.get('tax_type', '5%')) or '5%').strip().lower()
-                                        if tax_type_val in ('0%', 'exempt', '零稅率', '免稅'):
-                                            tax_val = 0
-                                            subtotal_val = total_val
-                                        else:
-                                            tax_val = round(total_val - (total_val / 1.05))
-                                            subtotal_val = total_val - tax_val
-                                    else:
-                                        subtotal_val = 0
-                                        tax_val = 0
-                                date_str = pdf_safe_value(row.get('日期', ''), '-')[:10]
-                                invoice_no = pdf_safe_value(row.get('發票號碼', ''), '-')[:12]
-                                seller_name = pdf_safe_value(row.get('賣方名稱', ''), '-')[:18]
-                                seller_ubn = pdf_safe_value(row.get('賣方統編', ''), '-')[:10]
-                                status_str = pdf_safe_value(row.get('狀態', ''), '-')[:8]
-                                note = pdf_safe_value(row.get('備註', '') or row.get('會計科目', '') or row.get('類型', ''), '-')[:18]
-                                file_name = pdf_safe_value(row.get('檔案名稱', ''), '-')[:22]
-                                net_amount_str = f"${subtotal_val:,.0f}"
-                                tax_str = f"${tax_val:,.0f}"
-                                total_str = f"${total_val:,.0f}"
-                                safe_cell(pdf, col_widths[0], 6, date_str, 1)
-                                safe_cell(pdf, col_widths[1], 6, invoice_no, 1)
-                                safe_cell(pdf, col_widths[2], 6, seller_name, 1)
-                                safe_cell(pdf, col_widths[3], 6, seller_ubn, 1)
-                                safe_cell(pdf, col_widths[4], 6, net_amount_str, 1, align='R')
-                                safe_cell(pdf, col_widths[5], 6, tax_str, 1, align='R')
-                                safe_cell(pdf, col_widths[6], 6, total_str, 1, align='R')
-                                safe_cell(pdf, col_widths[7], 6, status_str, 1)
-                                safe_cell(pdf, col_widths[8], 6, note, 1)
-                                safe_cell(pdf, col_widths[9], 6, file_name, 1, ln=1)
-                                if pdf.get_y() > y_break:
-                                    pdf.add_page()
-                                    if font_loaded:
-                                        pdf.set_font(font_name, 'B', 9)
-                                    else:
-                                        pdf.set_font('Arial', 'B', 9)
-                                    for i, header in enumerate(headers):
-                                        safe_cell(pdf, col_widths[i], 7, header, 1, align='C')
-                                    pdf.ln()
-                                    if font_loaded:
-                                        pdf.set_font(font_name, '', 8)
-                                    else:
-                                        pdf.set_font('Arial', '', 8)
-                            pdf_bytes = pdf.output(dest='S')
-                            return bytes(pdf_bytes) if isinstance(pdf_bytes, bytearray) else pdf_bytes
+                            export_df = df_export.copy()
+                            export_df_for_stats = df_export_all
+                            return build_invoice_report_pdf(
+                                export_df,
+                                export_df_for_stats,
+                                company_name=st.session_state.get('company_name', ''),
+                                company_ubn=st.session_state.get('company_ubn', ''),
+                            )
                         pdf_data = _gen_pdf()
                         st.download_button(
                             "📄 導出PDF",
@@ -5239,7 +7217,7 @@ with st.container():
                             f"invoice_report_{datetime.now().strftime('%Y%m%d')}.pdf",
                             mime="application/pdf",
                             use_container_width=True,
-                            help="導出當前數據為PDF報告"
+                            help="導出當前篩選後的明細為PDF報告（統計涵蓋全部發票）"
                         )
                     else:
                         st.info("📄 PDF", help="需要安裝 fpdf2")
@@ -5293,7 +7271,7 @@ with st.container():
                             height=500,
                             column_config=valid_column_config if valid_column_config else None,
                             column_order=visible_columns if visible_columns else None,
-                            key="invoice_data_editor_single"
+                            key=f"invoice_data_editor_single_{st.session_state.get('invoice_page_cursors', [None])[-1]}"
                         )
                     except Exception as e:
                         st.error(f"表格顯示錯誤: {str(e)}")
@@ -5397,8 +7375,17 @@ with st.container():
             elif "選取" not in df.columns:
                 df["選取"] = False
         
-            # 檢查是否有選中的行
-            selected_count = ed_df["選取"].sum() if not ed_df.empty and "選取" in ed_df.columns else 0
+            # 檢查是否有選中的行：本頁勾選併入跨頁的 selected_invoice_ids
+            if not ed_df.empty and "選取" in ed_df.columns and "id" in df.columns:
+                _page_ids = pd.to_numeric(df["id"], errors="coerce").dropna().astype(int)
+                _checked = ed_df["選取"].reindex(_page_ids.index).fillna(False).astype(bool)
+                _prev_sel = st.session_state.get("selected_invoice_ids", set())
+                _new_sel = (_prev_sel - set(_page_ids.tolist())) | set(_page_ids[_checked].tolist())
+                if _new_sel != _prev_sel:
+                    st.session_state.selected_invoice_ids = _new_sel
+                selected_count = len(_new_sel)
+            else:
+                selected_count = ed_df["選取"].sum() if not ed_df.empty and "選取" in ed_df.columns else 0
             current_selected = st.session_state.get("preview_selected_count", 0)
             if current_selected != selected_count:
                 st.session_state.preview_selected_count = int(selected_count)
@@ -5412,6 +7399,18 @@ with st.container():
                 # 收集要刪除的記錄信息（使用發票號碼+日期）
                 records_to_delete = []
                 user_email = st.session_state.get('user_email', 'default_user')
+                # 跨頁選取：直接依 selected_invoice_ids 取完整篩選資料中的記錄
+                _sel_ids = st.session_state.get("selected_invoice_ids") or set()
+                if _sel_ids and "id" in df_base.columns:
+                    _sel_df = df_base[pd.to_numeric(df_base["id"], errors="coerce").isin(_sel_ids)]
+                    for _rec in _sel_df[[c for c in ("id", "發票號碼", "日期") if c in _sel_df.columns]].to_dict("records"):
+                        delete_record = {'id': int(_rec['id'])}
+                        if _rec.get('發票號碼') and str(_rec['發票號碼']).strip() not in ('No', 'N/A'):
+                            delete_record['invoice_number'] = str(_rec['發票號碼']).strip()
+                        if _rec.get('日期') and str(_rec['日期']).strip() not in ('No', 'N/A'):
+                            delete_record['date'] = str(_rec['日期']).strip()
+                        records_to_delete.append(delete_record)
+                    selected_rows = selected_rows.iloc[0:0]
             
                 for idx, row in selected_rows.iterrows():
                     # 優先從df_with_id獲取原始數據（未經過fill_empty處理，避免"No"值）
@@ -36,18 +36,51 @@ CHART_HEIGHT = 280
 CHART_PADDING = 20
 CHART_BACKGROUND = 'transparent'
 
+# 超过此行数的数据一律先在服务端聚合，避免把明细整份写进图表 JSON
+MAX_CHART_ROWS = 5000
+COUNT_COL = '数量'
+
+def prepare_chart_data(data, key_col, value_col=None):
+    """
+    将图表数据整理为每个 key 一行的小表（key_col, value_col）
+
+    参数:
+        data: 已聚合的 Series（索引为分类、值为数值），或 DataFrame（明细或已聚合）
+        key_col: 分类/X轴列名
+        value_col: 数值列名；None 或 'count()' 表示计数
+
+    返回: (DataFrame, value_col)
+    """
+    import pandas as pd
+
+    if isinstance(data, pd.Series):
+        value_col = value_col if value_col not in (None, 'count()') else (data.name or COUNT_COL)
+        return data.rename_axis(key_col).reset_index(name=value_col), value_col
+
+    if value_col in (None, 'count()'):
+        counts = data.groupby(key_col, sort=False).size()
+        return counts.reset_index(name=COUNT_COL), COUNT_COL
+
+    df = data[[key_col, value_col]]
+    # 明细数据（key 重复）或超过阈值时按 key 汇总
+    if len(df) > MAX_CHART_ROWS or df[key_col].duplicated().any():
+        df = df.groupby(key_col, sort=False)[value_col].sum().reset_index()
+    return df, value_col
+
 def create_pie_chart(df, category_col, value_col='count()', title="分布图"):
     """
     创建改进的圆饼图
     
     参数:
-        df: DataFrame
+        df: DataFrame 或已聚合的 Series
         category_col: 分类列名
-        value_col: 数值列名或聚合函数
+        value_col: 数值列名，'count()' 表示计数
         title: 图表标题
     """
     import altair as alt
     
+    df, value_col = prepare_chart_data(df, category_col, value_col)
+    
     # 获取唯一分类数量
     unique_categories = df[category_col].nunique()
     color_range = CHART_COLOR_SCHEME[:unique_categories]
@@ -91,7 +124,7 @@ def create_line_chart(df, x_col, y_col, title="趋势图", color=None):
     创建改进的折线图
     
     参数:
-        df: DataFrame
+        df: DataFrame 或已聚合的 Series
         x_col: X轴列名
         y_col: Y轴列名
         title: 图表标题
@@ -99,6 +132,8 @@ def create_line_chart(df, x_col, y_col, title="趋势图", color=None):
     """
     import altair as alt
     
+    df, y_col = prepare_chart_data(df, x_col, y_col)
+    
     if color is None:
         color = GOOGLE_COLORS['primary']
     
@@ -162,7 +197,7 @@ def create_bar_chart(df, x_col, y_col, title="柱状图", color_scheme='gradient
     创建改进的柱状图
     
     参数:
-        df: DataFrame
+        df: DataFrame 或已聚合的 Series
         x_col: X轴列名
         y_col: Y轴列名
         title: 图表标题
@@ -170,6 +205,8 @@ def create_bar_chart(df, x_col, y_col, title="柱状图", color_scheme='gradient
     """
     import altair as alt
     
+    df, y_col = prepare_chart_data(df, x_col, y_col)
+    
     if color_scheme == 'gradient':
         # 使用渐变配色
         color_encoding = alt.Color(
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+背景工作的子行程執行端（不依賴 Streamlit）
+app 的工作執行緒只負責認領與回報；CPU 密集的 PDF 批次轉換以獨立子行程執行，不佔用網頁伺服器行程。
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import queue
+import shutil
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+
+
+def read_job_inputs(job_dir: str) -> List[Tuple[str, bytes]]:
+    """讀回工作輸入檔：[(原檔名, bytes)]，順序同提交時。"""
+    with open(os.path.join(job_dir, "inputs.json"), "r", encoding="utf-8") as f:
+        names = json.load(f)
+    files = []
+    for i, name in enumerate(names):
+        with open(os.path.join(job_dir, "in", f"{i:04d}"), "rb") as f:
+            files.append((name, f.read()))
+    return files
+
+
+def pdf_convert_to_result(job_dir: str, target: str, options: dict, progress: Optional[Callable] = None) -> Tuple[Optional[dict], Optional[str]]:
+    """pdf_converter.batch_convert_stream 的 ZIP 串流複製為 job_dir/result.zip，回傳 (結果 dict, error)。"""
+    from pdf_converter import batch_convert_stream
+    zip_file, report, err = batch_convert_stream(read_job_inputs(job_dir), target, progress_callback=progress, **options)
+    if zip_file is None:
+        return None, err or "轉換失敗"
+    dest = os.path.join(job_dir, "result.zip")
+    tmp = f"{dest}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with zip_file, open(tmp, "wb") as f:
+        shutil.copyfileobj(zip_file, f, 1 << 20)
+    os.replace(tmp, dest)
+    return {"report": report, "error": err, "files": ["result.zip"]}, None
+
+
+def run_pdf_convert(job_dir: str, target: str, options: dict, out_queue) -> None:
+    """
+    子行程入口：執行 pdf_convert_to_result。
+    進度以 ("progress", p)、結束以 ("done", result, error) 放入 out_queue。
+    """
+    last = [0.0]
+
+    def _progress(p):
+        # 節流：最多每 0.5 秒回報一次
+        now = time.time()
+        if now - last[0] >= 0.5:
+            last[0] = now
+            out_queue.put(("progress", float(p)))
+
+    try:
+        result, err = pdf_convert_to_result(job_dir, target, options, _progress)
+    except Exception as e:
+        result, err = None, f"{type(e).__name__}: {e}"
+    out_queue.put(("done", result, err))
+
+
+def run_in_subprocess(target: Callable, args: tuple, progress: Optional[Callable] = None) -> Tuple[Optional[dict], Optional[str]]:
+    """
+    以子行程執行 target(*args, out_queue) 並等待結束，回傳 (result, error)。
+    以 forkserver（無則 spawn）啟動，不從多執行緒的伺服器行程直接 fork；子行程非 daemon，可再使用 pdf_converter 的行程池。
+    子行程未回報結果即結束（崩潰、被 OOM 終止）時回傳含結束代碼的錯誤。
+    """
+    import multiprocessing
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    ctx = multiprocessing.get_context(method)
+    out_queue = ctx.Queue()
+    proc = ctx.Process(target=target, args=tuple(args) + (out_queue,), name="job-subprocess")
+    proc.start()
+    try:
+        exited = False
+        while True:
+            try:
+                msg = out_queue.get(timeout=1.0)
+            except queue.Empty:
+                if exited:
+                    return None, f"轉換子行程異常結束（結束代碼 {proc.exitcode}）"
+                # 子行程已結束仍多等一輪，讓最後送出的訊息到達
+                exited = not proc.is_alive()
+                continue
+            if msg[0] == "progress":
+                if progress:
+                    progress(msg[1])
+            else:
+                return msg[1], msg[2]
+    finally:
+        proc.join(timeout=30)
+        if proc.is_alive():
+            proc.kill()
+            proc.join()
+        out_queue.close()
@@ -9,14 +9,20 @@ PDF 萬能轉換工具模組
 from __future__ import annotations
 
 import base64
+import hashlib
 import io
 import json
 import os
+import queue
 import re
+import shutil
 import subprocess
 import tempfile
+import threading
+import time
 import zipfile
-from typing import List, Optional, Tuple, Union
+from pathlib import Path
+from typing import BinaryIO, List, Optional, Tuple, Union
 
 # 可選依賴：按需導入
 _pdfplumber = None
@@ -121,24 +127,287 @@ def _safe_imports():
             _pymupdf = False
 
 
+# LibreOffice：執行檔只探測一次；常駐 worker 池在首次轉換時建立
+_libreoffice_cmd = None  # None=尚未探測, False=未安裝, str=執行檔路徑
+_libreoffice_pool = None
+_libreoffice_pool_lock = threading.Lock()
+
+# 各格式對應的 LibreOffice 匯出濾鏡（UNO 模式使用）
+_LIBREOFFICE_PDF_FILTERS = {
+    "docx": "writer_pdf_Export",
+    "doc": "writer_pdf_Export",
+    "xlsx": "calc_pdf_Export",
+    "xls": "calc_pdf_Export",
+    "pptx": "impress_pdf_Export",
+    "ppt": "impress_pdf_Export",
+}
+
+
+def _libreoffice_timeout() -> float:
+    """單次 Office→PDF 轉換上限秒數（LIBREOFFICE_TIMEOUT，預設 120）；UNO 與命令列模式皆適用。"""
+    try:
+        return max(1.0, float(os.environ.get("LIBREOFFICE_TIMEOUT", "120")))
+    except ValueError:
+        return 120.0
+
+
+def _find_libreoffice() -> Optional[str]:
+    """探測 LibreOffice 執行檔（libreoffice / soffice），結果快取於模組層級。"""
+    global _libreoffice_cmd
+    if _libreoffice_cmd is None:
+        _libreoffice_cmd = False
+        for cmd in ("libreoffice", "soffice"):
+            path = shutil.which(cmd)
+            if path:
+                _libreoffice_cmd = path
+                break
+    return _libreoffice_cmd or None
+
+
+class _LibreOfficeWorker:
+    """
+    單一 LibreOffice worker，擁有獨立的 user profile 目錄（避免多個轉換互搶同一份 profile）。
+    系統有 python3-uno 時維持一個常駐 headless soffice（UNO socket），轉換不必重新冷啟動；
+    否則退回命令列 --convert-to，但仍使用該 worker 專屬 profile。
+    常駐 soffice 啟動失敗後依 30 秒起倍增（上限 10 分鐘）的間隔才再試，期間直接走命令列，不必每次等待啟動逾時。
+    """
+
+    START_BACKOFF = 30.0
+    START_BACKOFF_MAX = 600.0
+
+    def __init__(self, cmd: str, index: int, port: int):
+        self.cmd = cmd
+        self.index = index
+        self.port = port
+        self.profile_dir = os.path.join(tempfile.gettempdir(), f"lo_profile_{os.getpid()}_{index}")
+        self.proc = None
+        self.desktop = None
+        self._start_failures = 0
+        self._next_start_at = 0.0
+
+    @property
+    def profile_url(self) -> str:
+        return Path(self.profile_dir).as_uri()
+
+    def start(self, timeout: float = 30.0) -> bool:
+        """啟動常駐 soffice 並以 UNO 連線；無 uno 模組或啟動失敗時回傳 False。"""
+        try:
+            import uno
+        except ImportError:
+            self._next_start_at = float("inf")  # 無 uno 模組：之後一律走命令列
+            return False
+        self.stop()
+        os.makedirs(self.profile_dir, exist_ok=True)
+        accept = f"socket,host=127.0.0.1,port={self.port};urp;StarOffice.ComponentContext"
+        self.proc = subprocess.Popen(
+            [
+                self.cmd, "--headless", "--invisible", "--nologo", "--norestore",
+                "--nodefault", "--nolockcheck",
+                f"-env:UserInstallation={self.profile_url}",
+                f"--accept={accept}",
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        local_ctx = uno.getComponentContext()
+        resolver = local_ctx.ServiceManager.createInstanceWithContext(
+            "com.sun.star.bridge.UnoUrlResolver", local_ctx
+        )
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.proc.poll() is not None:
+                break
+            try:
+                ctx = resolver.resolve(f"uno:{accept}")
+                self.desktop = ctx.ServiceManager.createInstanceWithContext("com.sun.star.frame.Desktop", ctx)
+                return True
+            except Exception:
+                time.sleep(0.3)
+        self.stop()
+        return False
+
+    def _try_start(self) -> bool:
+        """在退避期間外才嘗試啟動常駐 soffice，並依結果更新退避間隔。"""
+        if time.time() < self._next_start_at:
+            return False
+        if self.start():
+            self._start_failures = 0
+            self._next_start_at = 0.0
+            return True
+        if self._next_start_at != float("inf"):
+            self._start_failures += 1
+            self._next_start_at = time.time() + min(
+                self.START_BACKOFF_MAX, self.START_BACKOFF * 2 ** (self._start_failures - 1)
+            )
+        return False
+
+    def _kill(self):
+        """強制結束常駐 soffice（轉換逾時用）；進行中的 UNO 呼叫會因連線中斷而拋出例外。"""
+        proc = self.proc
+        if proc is not None and proc.poll() is None:
+            try:
+                proc.kill()
+            except Exception:
+                pass
+
+    def healthy(self) -> bool:
+        """健康檢查：行程仍存活且 UNO 連線可回應。"""
+        if self.proc is None or self.proc.poll() is not None or self.desktop is None:
+            return False
+        try:
+            self.desktop.getComponents()
+            return True
+        except Exception:
+            return False
+
+    def stop(self):
+        if self.desktop is not None:
+            try:
+                self.desktop.terminate()
+            except Exception:
+                pass
+        self.desktop = None
+        if self.proc is not None and self.proc.poll() is None:
+            try:
+                self.proc.terminate()
+                self.proc.wait(timeout=10)
+            except Exception:
+                try:
+                    self.proc.kill()
+                except Exception:
+                    pass
+        self.proc = None
+
+    def _convert_uno(self, input_path: str, pdf_path: str, ext: str, timeout: float):
+        """以 UNO 轉換；超過 timeout 秒即強制結束 soffice 並拋出 subprocess.TimeoutExpired。"""
+        expired = threading.Event()
+
+        def _on_timeout():
+            expired.set()
+            self._kill()
+
+        watchdog = threading.Timer(timeout, _on_timeout)
+        watchdog.daemon = True
+        watchdog.start()
+        try:
+            self._convert_uno_blocking(input_path, pdf_path, ext)
+        except Exception:
+            if expired.is_set():
+                raise subprocess.TimeoutExpired("libreoffice", timeout)
+            raise
+        finally:
+            watchdog.cancel()
+        if expired.is_set():
+            raise subprocess.TimeoutExpired("libreoffice", timeout)
+
+    def _convert_uno_blocking(self, input_path: str, pdf_path: str, ext: str):
+        import uno
+        from com.sun.star.beans import PropertyValue
+
+        def _prop(name, value):
+            p = PropertyValue()
+            p.Name = name
+            p.Value = value
+            return p
+
+        doc = self.desktop.loadComponentFromURL(
+            uno.systemPathToFileUrl(input_path), "_blank", 0, (_prop("Hidden", True),)
+        )
+        if doc is None:
+            raise RuntimeError("LibreOffice 無法開啟檔案")
+        try:
+            doc.storeToURL(
+                uno.systemPathToFileUrl(pdf_path),
+                (_prop("FilterName", _LIBREOFFICE_PDF_FILTERS.get(ext, "writer_pdf_Export")),),
+            )
+        finally:
+            doc.close(True)
+
+    def _convert_cli(self, input_path: str, out_dir: str) -> str:
+        proc = subprocess.run(
+            [
+                self.cmd, f"-env:UserInstallation={self.profile_url}",
+                "--headless", "--convert-to", "pdf", "--outdir", out_dir, input_path,
+            ],
+            capture_output=True,
+            text=True,
+            timeout=_libreoffice_timeout(),
+        )
+        if proc.returncode != 0:
+            raise RuntimeError(f"LibreOffice 轉換失敗：{proc.stderr or proc.stdout or '未知錯誤'}")
+        base_name = os.path.splitext(os.path.basename(input_path))[0]
+        return os.path.join(out_dir, f"{base_name}.pdf")
+
+    def convert(self, input_path: str, out_dir: str, ext: str) -> str:
+        """轉換單一檔案，回傳輸出 PDF 路徑。UNO 失敗時重啟 worker 並改以命令列完成本次轉換；
+        逾時（文件卡住）則結束 soffice 並拋出 subprocess.TimeoutExpired，不再以命令列重試同一份文件。"""
+        if self.healthy() or self._try_start():
+            base_name = os.path.splitext(os.path.basename(input_path))[0]
+            pdf_path = os.path.join(out_dir, f"{base_name}.pdf")
+            try:
+                self._convert_uno(input_path, pdf_path, ext, _libreoffice_timeout())
+                return pdf_path
+            except subprocess.TimeoutExpired:
+                self.stop()
+                raise
+            except Exception:
+                self.stop()
+        return self._convert_cli(input_path, out_dir)
+
+
+class _LibreOfficePool:
+    """
+    固定數量的 LibreOffice worker；閒置 worker 放在佇列中，轉換請求依序排隊取得。
+    worker 數由環境變數 LIBREOFFICE_WORKERS 決定（預設 2），UNO 埠號自 LIBREOFFICE_BASE_PORT（預設 2002）起算。
+    """
+
+    def __init__(self, cmd: str, size: int, base_port: int):
+        self._idle = queue.Queue()
+        self.workers = [_LibreOfficeWorker(cmd, i, base_port + i) for i in range(size)]
+        for w in self.workers:
+            self._idle.put(w)
+
+    def convert(self, input_path: str, out_dir: str, ext: str, timeout: float = 300) -> str:
+        try:
+            worker = self._idle.get(timeout=timeout)
+        except queue.Empty:
+            raise subprocess.TimeoutExpired("libreoffice", timeout)
+        try:
+            return worker.convert(input_path, out_dir, ext)
+        finally:
+            self._idle.put(worker)
+
+    def shutdown(self):
+        for w in self.workers:
+            w.stop()
+
+
+def _get_libreoffice_pool(cmd: str) -> _LibreOfficePool:
+    global _libreoffice_pool
+    with _libreoffice_pool_lock:
+        if _libreoffice_pool is None:
+            try:
+                size = max(1, int(os.environ.get("LIBREOFFICE_WORKERS", "2")))
+                base_port = int(os.environ.get("LIBREOFFICE_BASE_PORT", "2002"))
+            except ValueError:
+                size, base_port = 2, 2002
+            _libreoffice_pool = _LibreOfficePool(cmd, size, base_port)
+            import atexit
+            atexit.register(_libreoffice_pool.shutdown)
+        return _libreoffice_pool
+
+
 def _office_to_pdf_via_libreoffice(
     file_bytes: bytes,
     ext: str,
     progress_callback=None,
 ) -> Tuple[Optional[bytes], Optional[str]]:
     """
-    使用 LibreOffice 將 Office 檔轉為 PDF。
-    需系統安裝 LibreOffice：sudo apt install libreoffice
+    使用 LibreOffice 將 Office 檔轉為 PDF（透過常駐 worker 池，見 _LibreOfficePool）。
+    需系統安裝 LibreOffice：sudo apt install libreoffice（常駐模式另需 python3-uno）
     Returns: (pdf_bytes, error_message)
     """
-    _cmd = None
-    for cmd in ("libreoffice", "soffice"):
-        try:
-            subprocess.run([cmd, "--version"], capture_output=True, timeout=5)
-            _cmd = cmd
-            break
-        except (FileNotFoundError, subprocess.TimeoutExpired):
-            continue
+    _cmd = _find_libreoffice()
     if not _cmd:
         return None, "未安裝 LibreOffice，請執行：sudo apt install libreoffice"
 
@@ -148,18 +417,13 @@ def _office_to_pdf_via_libreoffice(
             input_path = f.name
         out_dir = tempfile.mkdtemp()
         try:
-            proc = subprocess.run(
-                [_cmd, "--headless", "--convert-to", "pdf", "--outdir", out_dir, input_path],
-                capture_output=True,
-                text=True,
-                timeout=120,
-            )
-            if proc.returncode != 0:
-                return None, f"LibreOffice 轉換失敗：{proc.stderr or proc.stdout or '未知錯誤'}"
-            base_name = os.path.splitext(os.path.basename(input_path))[0]
-            pdf_path = os.path.join(out_dir, f"{base_name}.pdf")
+            if progress_callback:
+                progress_callback(0.1)
+            pdf_path = _get_libreoffice_pool(_cmd).convert(input_path, out_dir, ext)
             if not os.path.isfile(pdf_path):
                 return None, "轉換後未產生 PDF 檔案"
+            if progress_callback:
+                progress_callback(1.0)
             with open(pdf_path, "rb") as f:
                 return f.read(), None
         finally:
@@ -173,10 +437,13 @@ def _office_to_pdf_via_libreoffice(
                 os.remove(input_path)
             except Exception:
                 pass
-    except subprocess.TimeoutExpired:
-        return None, "轉換逾時（超過 120 秒）"
+    except subprocess.TimeoutExpired as e:
+        return None, f"轉換逾時（超過 {int(e.timeout)} 秒）"
     except Exception as e:
-        return None, f"轉換失敗：{str(e)}"
+        err_msg = str(e)
+        if err_msg.startswith("LibreOffice"):
+            return None, err_msg
+        return None, f"轉換失敗：{err_msg}"
 
 
 def word_to_pdf(docx_bytes: bytes, progress_callback=None) -> Tuple[Optional[bytes], Optional[str]]:
@@ -194,13 +461,27 @@ def ppt_to_pdf(pptx_bytes: bytes, progress_callback=None) -> Tuple[Optional[byte
     return _office_to_pdf_via_libreoffice(pptx_bytes, "pptx", progress_callback)
 
 
+# 頁面尺寸預設（單位 pt，直式）
+_PAGE_SIZE_PRESETS = {
+    "A4": (595.0, 842.0),
+    "LETTER": (612.0, 792.0),
+}
+
+
 def images_to_pdf(
     image_bytes_list: List[bytes],
     progress_callback=None,
+    page_size: str = "image",
+    max_side: Optional[int] = None,
+    jpeg_quality: int = 85,
+    margin: float = 18.0,
 ) -> Tuple[Optional[bytes], Optional[str]]:
     """
     將多張圖片（JPG/PNG）合併為單一 PDF。
     圖片依上傳順序排列，每張一頁。
+    JPEG 原始資料直接嵌入（DCT 不重新編碼）；PIL 只讀取檔頭取得格式與尺寸。
+    page_size："image"（頁面＝圖片原尺寸）或 "A4" / "Letter"（依圖片方向自動橫直，等比例置中）。
+    max_side：圖片最長邊超過此像素時縮小並以 jpeg_quality 重新壓縮（手機原圖可大幅減少體積）。
     Returns: (pdf_bytes, error_message)
     """
     _safe_imports()
@@ -212,29 +493,62 @@ def images_to_pdf(
     if not image_bytes_list:
         return None, "請至少上傳一張圖片"
 
+    preset = _PAGE_SIZE_PRESETS.get((page_size or "image").upper())
+    if page_size and page_size.lower() != "image" and preset is None:
+        return None, f"不支援的頁面尺寸：{page_size}"
+
     try:
         fitz = _pymupdf
         doc = fitz.open()
         total = len(image_bytes_list)
+        xref_by_digest = {}  # 相同圖片只嵌入一次
 
         for i, img_bytes in enumerate(image_bytes_list):
             if progress_callback:
                 progress_callback((i + 1) / total)
 
-            # 用 PIL 偵測格式（pymupdf 需 png/jpeg）
-            img = _pil.open(io.BytesIO(img_bytes))
-            fmt = (img.format or "PNG").upper()
-            ext = "png" if fmt in ("PNG", "PPM", "GIF", "BMP") else "jpeg"
+            # PIL 開檔為延遲解碼，此處僅讀取檔頭
+            with _pil.open(io.BytesIO(img_bytes)) as img:
+                fmt = (img.format or "").upper()
+                img_w, img_h = img.size
+                dpi = img.info.get("dpi") or (96, 96)
+                stream = img_bytes
+                if max_side and max(img_w, img_h) > max_side:
+                    small = img.convert("RGB") if img.mode not in ("RGB", "L") else img.copy()
+                    small.thumbnail((max_side, max_side), _pil_lanczos())
+                    buf = io.BytesIO()
+                    small.save(buf, format="JPEG", quality=jpeg_quality, optimize=True)
+                    stream = buf.getvalue()
+                elif fmt not in ("JPEG", "PNG"):
+                    # GIF / BMP 等轉為 PNG（無損）再嵌入
+                    buf = io.BytesIO()
+                    img.save(buf, format="PNG")
+                    stream = buf.getvalue()
 
-            img_doc = fitz.open(stream=img_bytes, filetype=ext)
-            pdf_bytes = img_doc.convert_to_pdf()
-            img_doc.close()
+            # 頁面尺寸：依原圖像素與解析度換算（72 pt / inch）
+            try:
+                x_dpi = float(dpi[0]) or 96.0
+                y_dpi = float(dpi[1]) or 96.0
+            except (TypeError, ValueError, IndexError):
+                x_dpi = y_dpi = 96.0
+            if preset:
+                page_w, page_h = preset
+                if img_w > img_h:
+                    page_w, page_h = page_h, page_w
+                rect = fitz.Rect(margin, margin, page_w - margin, page_h - margin)
+            else:
+                page_w, page_h = img_w * 72.0 / x_dpi, img_h * 72.0 / y_dpi
+                rect = fitz.Rect(0, 0, page_w, page_h)
 
-            img_pdf = fitz.open(stream=pdf_bytes, filetype="pdf")
-            doc.insert_pdf(img_pdf)
-            img_pdf.close()
+            page = doc.new_page(width=page_w, height=page_h)
+            digest = hashlib.sha1(stream).digest()
+            if digest in xref_by_digest:
+                page.insert_image(rect, xref=xref_by_digest[digest])
+            else:
+                xref_by_digest[digest] = page.insert_image(rect, stream=stream)
 
-        result = doc.tobytes(garbage=4, deflate=True)
+        # 圖片串流已壓縮，只壓縮頁面內容；新建文件無需 garbage 整理
+        result = doc.tobytes(deflate=True)
         doc.close()
         return result, None
     except Exception as e:
@@ -242,49 +556,263 @@ def images_to_pdf(
         return None, f"轉換失敗：{err_msg}"
 
 
-def pdf_to_excel(pdf_bytes: bytes, progress_callback=None) -> Tuple[Optional[bytes], Optional[str]]:
+def _page_may_have_tables(page) -> bool:
+    """
+    表格預篩：extract_tables 預設以線條（lines / rects / curves）偵測表格，
+    沒有任何框線、或沒有文字的頁面不可能產出表格，可略過昂貴的表格分析。
+    """
+    if not page.chars:
+        return False
+    return bool(page.lines or page.rects or page.curves)
+
+
+def _extract_tables_from_pages(pdf_path: str, page_indices: List[int]) -> List[Tuple[int, list]]:
+    """
+    擷取指定頁面的表格（可於子行程執行，各行程自行開啟同一份暫存 PDF）。
+    Returns: [(頁索引, tables)]
+    """
+    import pdfplumber
+    results = []
+    with pdfplumber.open(pdf_path) as pdf:
+        for idx in page_indices:
+            page = pdf.pages[idx]
+            tables = page.extract_tables() if _page_may_have_tables(page) else []
+            results.append((idx, tables))
+            page.close()  # 釋放該頁解析快取，長文件不累積記憶體
+    return results
+
+
+def _stitch_continuation_tables(page_tables: dict, merge: bool = True) -> List[Tuple[str, List[list]]]:
+    """
+    將各頁表格依頁序整理成 Sheet；merge=True 時合併跨頁續表：
+    前一頁的最後一個表格與下一頁的第一個表格欄數相同，即視為同一張表接續，
+    續表開頭若重複原表頭則略去該列。
+    Returns: [(sheet 名稱, rows)]，名稱為 Page{i}_Table{t} 或 Page{i}-{j}_Table{t}
+    """
+    groups = []  # [起始頁, 結束頁, t_idx, 欄數, rows, 是否為該頁最後一個表格]
+    for i in sorted(page_tables):
+        tables = [tbl for tbl in page_tables[i] if tbl and len(tbl) > 0]
+        last_on_page = len(tables) - 1
+        for t_idx, tbl in enumerate(tables):
+            n_cols = len(tbl[0])
+            prev = groups[-1] if groups else None
+            if (
+                merge
+                and prev is not None
+                and t_idx == 0
+                and prev[1] == i - 1
+                and prev[5]
+                and prev[3] == n_cols
+            ):
+                rows = tbl[1:] if tbl[0] == prev[4][0] else tbl
+                prev[4].extend(rows)
+                prev[1] = i
+                prev[5] = t_idx == last_on_page
+                continue
+            groups.append([i, i, t_idx, n_cols, list(tbl), t_idx == last_on_page])
+
+    sheets = []
+    for start, end, t_idx, _n_cols, rows, _last in groups:
+        pages = f"{start+1}" if start == end else f"{start+1}-{end+1}"
+        sheets.append((f"Page{pages}_Table{t_idx+1}", rows))
+    return sheets
+
+
+def _xlsx_cell_value(v):
+    """轉為 Excel 可寫入的原生值：NaN/NaT → None，numpy 純量 → Python 純量。"""
+    if v is None:
+        return None
+    if hasattr(v, "item") and not isinstance(v, (str, bytes)):
+        try:
+            v = v.item()
+        except (ValueError, AttributeError):
+            pass
+    if isinstance(v, float) and v != v:
+        return None
+    if _pandas and v is _pandas.NaT:
+        return None
+    return v
+
+
+def _iter_sheet_rows(data):
+    """DataFrame 或 rows 串列 → 逐列產生（DataFrame 第一列為欄名）。"""
+    if hasattr(data, "itertuples"):
+        yield [str(c) for c in data.columns]
+        for row in data.itertuples(index=False, name=None):
+            yield [_xlsx_cell_value(v) for v in row]
+    else:
+        for row in data:
+            yield [_xlsx_cell_value(v) for v in row]
+
+
+def write_xlsx_streaming(
+    sheets: List[Tuple[str, object]],
+    column_formats: Optional[dict] = None,
+    column_widths: Optional[dict] = None,
+    default_width: Optional[float] = None,
+    freeze_header: bool = False,
+) -> bytes:
+    """
+    串流寫出 .xlsx：有 xlsxwriter 時使用 constant_memory 模式，否則使用 openpyxl write-only 模式，
+    兩者皆逐列寫出、不建立整份活頁簿的儲存格物件，記憶體用量與列數無關。
+    sheets：[(sheet 名稱, DataFrame 或 rows)]，第一列視為表頭（粗體）。
+    column_formats：{表頭: 數字格式}，例如 {"總計": "#,##0"}，整欄事先套用並靠右對齊。
+    column_widths：{表頭: 欄寬}；default_width：未指定欄的最小寬度（None 表示不設定）。
+    """
+    column_formats = column_formats or {}
+    column_widths = column_widths or {}
+
+    def _width(header):
+        if default_width is None and header not in column_widths:
+            return None
+        return max(default_width or 0, column_widths.get(header, 0), len(str(header or "")) + 2)
+
+    used = set()
+
+    def _sheet_title(sheet_name):
+        safe_name = re.sub(r"[\\/*?:\[\]]", "_", str(sheet_name))[:31]  # Excel sheet 名稱限制 31 字元
+        name, n = safe_name, 1
+        while name.lower() in used:
+            n += 1
+            name = f"{safe_name[:28]}_{n}"
+        used.add(name.lower())
+        return name
+
+    buf = io.BytesIO()
+    try:
+        import xlsxwriter
+    except ImportError:
+        xlsxwriter = None
+
+    if xlsxwriter is not None:
+        wb = xlsxwriter.Workbook(buf, {"constant_memory": True, "strings_to_urls": False, "nan_inf_to_errors": True})
+        header_fmt = wb.add_format({"bold": True})
+        num_fmts = {}
+        for sheet_name, data in sheets:
+            ws = wb.add_worksheet(_sheet_title(sheet_name))
+            rows = _iter_sheet_rows(data)
+            header = next(rows, None)
+            if header is None:
+                continue
+            for c, h in enumerate(header):
+                fmt_str = column_formats.get(h)
+                if fmt_str and fmt_str not in num_fmts:
+                    num_fmts[fmt_str] = wb.add_format({"num_format": fmt_str, "align": "right"})
+                ws.set_column(c, c, _width(h), num_fmts.get(fmt_str))
+            if freeze_header:
+                ws.freeze_panes(1, 0)
+            ws.write_row(0, 0, header, header_fmt)
+            for r, row in enumerate(rows, start=1):
+                for c, v in enumerate(row):
+                    if v is not None:
+                        ws.write(r, c, v)
+        wb.close()
+        return buf.getvalue()
+
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+    from openpyxl.styles import Alignment, Font
+    from openpyxl.utils import get_column_letter
+
+    wb = Workbook(write_only=True)
+    header_font = Font(bold=True)
+    right = Alignment(horizontal="right")
+    for sheet_name, data in sheets:
+        ws = wb.create_sheet(title=_sheet_title(sheet_name))
+        rows = _iter_sheet_rows(data)
+        header = next(rows, None)
+        if header is None:
+            continue
+        # write-only 模式下欄寬與凍結窗格須在寫入第一列前設定
+        for c, h in enumerate(header, start=1):
+            w = _width(h)
+            if w:
+                ws.column_dimensions[get_column_letter(c)].width = w
+        if freeze_header:
+            ws.freeze_panes = "A2"
+        header_cells = []
+        for h in header:
+            cell = WriteOnlyCell(ws, value=h)
+            cell.font = header_font
+            header_cells.append(cell)
+        ws.append(header_cells)
+        fmt_cols = {i: column_formats[h] for i, h in enumerate(header) if h in column_formats}
+        for row in rows:
+            out = []
+            for i, v in enumerate(row):
+                if isinstance(v, str):
+                    v = ILLEGAL_CHARACTERS_RE.sub("", v)
+                if i in fmt_cols:
+                    cell = WriteOnlyCell(ws, value=v)
+                    cell.number_format = fmt_cols[i]
+                    cell.alignment = right
+                    v = cell
+                out.append(v)
+            ws.append(out)
+    wb.save(buf)
+    return buf.getvalue()
+
+
+def pdf_to_excel(
+    pdf_bytes: bytes,
+    progress_callback=None,
+    workers: Optional[int] = None,
+    merge_continuations: bool = True,
+) -> Tuple[Optional[bytes], Optional[str]]:
     """
     使用 pdfplumber 提取 PDF 表格，導出為 .xlsx。
-    多個表格分別放在不同 Sheet。
+    多個表格分別放在不同 Sheet；merge_continuations=True 時跨頁續表合併為同一個 Sheet。
+    workers：分塊依據的平行度（預設 PDF_OCR_WORKERS 或 CPU 核心數），各塊送往共用行程池；頁數少或 workers=1 時逐頁處理。
     Returns: (xlsx_bytes, error_message)
     """
     _safe_imports()
     if not _pdfplumber:
         return None, "未安裝 pdfplumber，請執行：pip install pdfplumber"
-    if not _pandas:
-        return None, "未安裝 pandas"
     if not _openpyxl:
         return None, "未安裝 openpyxl"
 
+    pdf_path = None
     try:
-        import pandas as pd
-        with io.BytesIO(pdf_bytes) as f:
-            pdf = _pdfplumber.open(f)
-            tables_by_page = []
+        with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as f:
+            f.write(pdf_bytes)
+            pdf_path = f.name
+        with _pdfplumber.open(pdf_path) as pdf:
             total_pages = len(pdf.pages)
-            for i, page in enumerate(pdf.pages):
+
+        workers = min(workers or _default_workers(), total_pages)
+        page_tables = {}
+        if workers <= 1 or total_pages < 4:
+            for i in range(total_pages):
                 if progress_callback:
                     progress_callback((i + 1) / total_pages)
-                tables = page.extract_tables()
-                if tables:
-                    for t_idx, tbl in enumerate(tables):
-                        if tbl and len(tbl) > 0:
-                            df = pd.DataFrame(tbl[1:], columns=tbl[0] if tbl[0] else None)
-                            if df.empty and tbl:
-                                df = pd.DataFrame(tbl)
-                            tables_by_page.append((f"Page{i+1}_Table{t_idx+1}", df))
-            pdf.close()
-
-        if not tables_by_page:
+                for idx, tables in _extract_tables_from_pages(pdf_path, [i]):
+                    page_tables[idx] = tables
+        else:
+            from concurrent.futures import as_completed
+            from concurrent.futures.process import BrokenProcessPool
+
+            # 連續頁面分塊（每個 worker 約 4 塊），減少重複開檔並保留進度粒度
+            chunk_size = max(1, -(-total_pages // (workers * 4)))
+            chunks = [list(range(s, min(s + chunk_size, total_pages))) for s in range(0, total_pages, chunk_size)]
+            done_pages = 0
+            pool = _get_process_pool()
+            try:
+                futures = [pool.submit(_extract_tables_from_pages, pdf_path, chunk) for chunk in chunks]
+                for fut in as_completed(futures):
+                    for idx, tables in fut.result():
+                        page_tables[idx] = tables
+                        done_pages += 1
+                    if progress_callback:
+                        progress_callback(done_pages / total_pages)
+            except BrokenProcessPool:
+                _discard_process_pool(pool)
+                raise
+
+        sheets = _stitch_continuation_tables(page_tables, merge=merge_continuations)
+        if not sheets:
             return None, "PDF 中未偵測到表格數據"
-
-        buf = io.BytesIO()
-        with pd.ExcelWriter(buf, engine="openpyxl") as writer:
-            for sheet_name, df in tables_by_page:
-                safe_name = sheet_name[:31]  # Excel sheet 名稱限制 31 字元
-                df.to_excel(writer, sheet_name=safe_name, index=False)
-        buf.seek(0)
-        return buf.read(), None
+        return write_xlsx_streaming(sheets), None
     except Exception as e:
         err_msg = str(e)
         if "encrypted" in err_msg.lower() or "password" in err_msg.lower():
@@ -292,6 +820,12 @@ def pdf_to_excel(pdf_bytes: bytes, progress_callback=None) -> Tuple[Optional[byt
         if "corrupt" in err_msg.lower() or "invalid" in err_msg.lower():
             return None, "PDF 格式損毀或無效"
         return None, f"轉換失敗：{err_msg}"
+    finally:
+        if pdf_path:
+            try:
+                os.remove(pdf_path)
+            except Exception:
+                pass
 
 
 def pdf_to_ppt(pdf_bytes: bytes, progress_callback=None) -> Tuple[Optional[bytes], Optional[str]]:
@@ -352,50 +886,90 @@ def pdf_to_ppt(pdf_bytes: bytes, progress_callback=None) -> Tuple[Optional[bytes
         return None, f"轉換失敗：{err_msg}"
 
 
-def pdf_to_images(
+def _iter_pdf_page_images(pdf_bytes: bytes, dpi: int = 200):
+    """
+    逐頁渲染 PDF 為 PIL 圖片，同一時間只保留一頁點陣。
+    優先使用 pymupdf（不需 poppler），否則以 pdf2image 逐頁呼叫 poppler。
+    Returns: (總頁數, 圖片產生器)
+    """
+    if _pymupdf:
+        doc = _pymupdf.open(stream=pdf_bytes, filetype="pdf")
+        if doc.needs_pass:
+            doc.close()
+            raise ValueError("PDF is encrypted")
+
+        def _gen_mupdf():
+            try:
+                for page in doc:
+                    pix = page.get_pixmap(dpi=dpi, alpha=False)
+                    mode = "L" if pix.n == 1 else "RGB"
+                    yield _pil.frombytes(mode, (pix.width, pix.height), pix.samples)
+            finally:
+                doc.close()
+
+        return doc.page_count, _gen_mupdf()
+
+    from pdf2image import pdfinfo_from_bytes
+    total = int(pdfinfo_from_bytes(pdf_bytes).get("Pages", 0))
+
+    def _gen_poppler():
+        for n in range(1, total + 1):
+            for img in _pdf2image(pdf_bytes, dpi=dpi, first_page=n, last_page=n):
+                yield img
+
+    return total, _gen_poppler()
+
+
+def pdf_to_images_stream(
     pdf_bytes: bytes,
     fmt: str = "png",
     dpi: int = 200,
     progress_callback=None
-) -> Tuple[Optional[bytes], Optional[bytes], Optional[str]]:
+) -> Tuple[Optional[BinaryIO], Optional[bytes], Optional[str]]:
     """
-    將 PDF 每頁轉為圖片，壓縮為 ZIP。
-    Returns: (zip_bytes, first_image_bytes_for_preview, error_message)
+    將 PDF 每頁轉為圖片，逐頁渲染、編碼並直接寫入暫存檔上的 ZIP（不在記憶體保留整份壓縮檔）。
+    PNG / JPG 本身已壓縮，ZIP 以 ZIP_STORED 存放。
+    回傳的 zip_file 為檔案型緩衝（已定位至開頭，可直接交給 st.download_button），用完請 close()。
+    Returns: (zip_file, first_image_bytes_for_preview, error_message)
     """
     _safe_imports()
-    if not _pdf2image:
+    if not _pymupdf and not _pdf2image:
         return None, None, "未安裝 pdf2image（需同時安裝 poppler）。請執行：pip install pdf2image"
     if not _pil:
         return None, None, "未安裝 Pillow"
 
+    tmp = None
     try:
-        images = _pdf2image(pdf_bytes, dpi=dpi)
-        total = len(images)
+        total, pages = _iter_pdf_page_images(pdf_bytes, dpi=dpi)
         first_img_bytes = None
-        zip_buf = io.BytesIO()
         ext = "png" if fmt.lower() == "png" else "jpg"
         save_fmt = "PNG" if ext == "png" else "JPEG"
 
-        with zipfile.ZipFile(zip_buf, "w", zipfile.ZIP_DEFLATED) as zf:
-            for i, img in enumerate(images):
-                if progress_callback:
+        # 無名暫存檔：關閉即由系統刪除（Windows 亦同），不需另行清理
+        tmp = tempfile.TemporaryFile(suffix=".zip")
+        with zipfile.ZipFile(tmp, "w", zipfile.ZIP_STORED) as zf:
+            for i, img in enumerate(pages):
+                if progress_callback and total:
                     progress_callback((i + 1) / total)
-                img_buf = io.BytesIO()
-                if ext == "jpg":
-                    if img.mode in ("RGBA", "P"):
-                        img = img.convert("RGB")
-                    img.save(img_buf, format=save_fmt, quality=90)
-                else:
-                    img.save(img_buf, format=save_fmt)
-                img_buf.seek(0)
-                data = img_buf.read()
-                zf.writestr(f"page_{i+1:04d}.{ext}", data)
+                if ext == "jpg" and img.mode in ("RGBA", "P"):
+                    img = img.convert("RGB")
+                save_kwargs = {"quality": 90} if ext == "jpg" else {}
+                name = f"page_{i+1:04d}.{ext}"
                 if i == 0:
-                    first_img_bytes = data
+                    img_buf = io.BytesIO()
+                    img.save(img_buf, format=save_fmt, **save_kwargs)
+                    first_img_bytes = img_buf.getvalue()
+                    zf.writestr(name, first_img_bytes)
+                else:
+                    with zf.open(name, "w") as entry:
+                        img.save(entry, format=save_fmt, **save_kwargs)
+                img.close()
 
-        zip_buf.seek(0)
-        return zip_buf.read(), first_img_bytes, None
+        tmp.seek(0)
+        return tmp, first_img_bytes, None
     except Exception as e:
+        if tmp is not None:
+            tmp.close()
         err_msg = str(e)
         if "encrypted" in err_msg.lower() or "password" in err_msg.lower():
             return None, None, "PDF 已加密或受密碼保護，無法讀取"
@@ -404,6 +978,26 @@ def pdf_to_images(
         return None, None, f"轉換失敗：{err_msg}"
 
 
+def pdf_to_images(
+    pdf_bytes: bytes,
+    fmt: str = "png",
+    dpi: int = 200,
+    progress_callback=None
+) -> Tuple[Optional[bytes], Optional[bytes], Optional[str]]:
+    """
+    將 PDF 每頁轉為圖片，壓縮為 ZIP。
+    大檔請改用 pdf_to_images_stream，避免整份 ZIP 載入記憶體。
+    Returns: (zip_bytes, first_image_bytes_for_preview, error_message)
+    """
+    zip_file, first_img_bytes, err = pdf_to_images_stream(
+        pdf_bytes, fmt=fmt, dpi=dpi, progress_callback=progress_callback
+    )
+    if err:
+        return None, None, err
+    with zip_file:
+        return zip_file.read(), first_img_bytes, None
+
+
 def _docx_text_length(docx_bytes: bytes) -> int:
     """檢查 Word 檔內文字總長度，用於判斷是否為空檔（掃描檔轉換常無內容）。"""
     try:
@@ -416,19 +1010,89 @@ def _docx_text_length(docx_bytes: bytes) -> int:
         return 0
 
 
+def _default_workers() -> int:
+    """預設平行行程數（OCR、表格擷取）：環境變數 PDF_OCR_WORKERS 優先，否則使用 CPU 核心數。"""
+    try:
+        n = int(os.environ.get("PDF_OCR_WORKERS", "0"))
+    except ValueError:
+        n = 0
+    return n if n > 0 else (os.cpu_count() or 1)
+
+
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+
+def _process_pool_worker_init():
+    """子行程初始化：每個 tesseract 只用 1 條執行緒，避免多行程時 OpenMP 互搶核心。"""
+    os.environ["OMP_THREAD_LIMIT"] = "1"
+
+
+def _get_process_pool():
+    """
+    OCR 與表格擷取共用的行程池（_default_workers() 個子行程）。
+    全模組只有一個：批次轉換、背景工作與多個 session 同時轉換時，子行程總數仍不超過此上限。
+    以 forkserver（無則 spawn）啟動子行程，不從多執行緒的伺服器行程直接 fork。
+    """
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            _process_pool = ProcessPoolExecutor(
+                max_workers=_default_workers(),
+                mp_context=multiprocessing.get_context(method),
+                initializer=_process_pool_worker_init,
+            )
+        return _process_pool
+
+
+def _discard_process_pool(pool):
+    """子行程異常結束（BrokenProcessPool）後捨棄該池，下次取用時重建。"""
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is pool:
+            _process_pool = None
+    pool.shutdown(wait=False)
+
+
+def _tesseract_ocr_page(args: Tuple[bytes, str, str, Optional[str]]) -> str:
+    """
+    子行程：對單頁 PNG 執行 OCR，回傳文字。需為模組層級函式以便 pickle。
+    tesseract_cmd 與主行程相同，確保各頁使用同一份執行檔與語言資料。
+    """
+    png_bytes, lang, config, tesseract_cmd = args
+    import pytesseract
+    from PIL import Image
+    if tesseract_cmd:
+        pytesseract.pytesseract.tesseract_cmd = tesseract_cmd
+    try:
+        with Image.open(io.BytesIO(png_bytes)) as img:
+            return pytesseract.image_to_string(img, lang=lang, config=config)
+    except Exception as e:
+        # 部分 pytesseract 例外無法 pickle，傳回主行程時會使整個共用池失效；改以 RuntimeError 帶回訊息
+        raise RuntimeError(f"{type(e).__name__}: {e}") from None
+
+
 def pdf_to_word_with_tesseract(
     pdf_bytes: bytes,
     lang: str = "chi_tra+eng",
     dpi: int = 200,
     progress_callback=None,
+    workers: Optional[int] = None,
+    oem: int = 3,
+    psm: int = 3,
 ) -> Tuple[Optional[bytes], Optional[str]]:
     """
     使用 Tesseract OCR 將掃描檔 PDF 轉為可編輯 Word。
     僅產出純文字（無樣式、無獨立圖片）。若要「樣式／字體／圖片皆可編輯」，請用一般模式（pdf2docx）處理文字型 PDF。
+    workers：本次最多同時送往共用行程池的頁數（預設為 CPU 核心數，1 = 逐頁處理）；頁面逐頁渲染、編碼後才送出，
+    記憶體中只保留在途的頁面。各頁共用同一組 lang / OEM / PSM 設定，結果依頁碼順序寫入 Word。
     Returns: (docx_bytes, error_message)
     """
     _safe_imports()
-    if not _pdf2image:
+    if not _pymupdf and not _pdf2image:
         return None, "未安裝 pdf2image（需 poppler）。請執行：pip install pdf2image"
     if not _pil:
         return None, "未安裝 Pillow"
@@ -441,20 +1105,64 @@ def pdf_to_word_with_tesseract(
         return None, "未安裝 pytesseract。若使用 venv，請先 source venv/bin/activate 再 pip install pytesseract；或執行 venv/bin/pip install pytesseract"
 
     try:
-        images = _pdf2image(pdf_bytes, dpi=dpi)
-        total = len(images)
+        workers = workers or _default_workers()
+        config = f"--oem {int(oem)} --psm {int(psm)}"
+        total, pages = _iter_pdf_page_images(pdf_bytes, dpi=dpi)
         if total == 0:
             return None, "PDF 中無頁面"
 
+        texts: List[str] = [""] * total
+        if workers <= 1 or total == 1:
+            for i, img in enumerate(pages):
+                if progress_callback:
+                    progress_callback((i + 1) / total)
+                if img.mode != "RGB":
+                    img = img.convert("RGB")
+                texts[i] = pytesseract.image_to_string(img, lang=lang, config=config)
+                img.close()
+        else:
+            from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, wait
+            from concurrent.futures.process import BrokenProcessPool
+
+            pool = _get_process_pool()
+            tesseract_cmd = getattr(pytesseract.pytesseract, "tesseract_cmd", None)
+            in_flight = {}
+            done = 0
+
+            def _collect(return_when):
+                nonlocal done
+                finished, _ = wait(in_flight, return_when=return_when)
+                for fut in finished:
+                    texts[in_flight.pop(fut)] = fut.result()
+                    done += 1
+                    if progress_callback:
+                        progress_callback(done / total)
+
+            try:
+                for i, img in enumerate(pages):
+                    if len(in_flight) >= workers:
+                        _collect(FIRST_COMPLETED)
+                    # 頁面編碼為 PNG 再送往子行程（無損，且比 pickle 原始點陣小）
+                    if img.mode != "RGB":
+                        img = img.convert("RGB")
+                    png_buf = io.BytesIO()
+                    img.save(png_buf, format="PNG", compress_level=1)
+                    img.close()
+                    in_flight[pool.submit(_tesseract_ocr_page, (png_buf.getvalue(), lang, config, tesseract_cmd))] = i
+                if in_flight:
+                    _collect(ALL_COMPLETED)
+            except BrokenProcessPool:
+                _discard_process_pool(pool)
+                raise
+            finally:
+                # 失敗時撤回尚未開始的頁面，不佔用共用池
+                for fut in in_flight:
+                    fut.cancel()
+
         Document, Pt = _python_docx
         doc = Document()
 
-        for i, img in enumerate(images):
-            if progress_callback:
-                progress_callback((i + 1) / total)
-            if img.mode != "RGB":
-                img = img.convert("RGB")
-            text = pytesseract.image_to_string(img, lang=lang)
+        for i, text in enumerate(texts):
             for para in (text or "").split("\n\n"):
                 para = para.strip()
                 if para:
@@ -523,10 +1231,12 @@ def pdf_to_word_with_ai_ocr(
     api_key: str,
     model_name: str = "gemini-2.0-flash",
     progress_callback=None,
+    post=None,
 ) -> Tuple[Optional[bytes], Optional[str]]:
     """
     使用 Gemini AI Vision 對 PDF 每頁進行 OCR，產出 Word 檔。
     適用掃描檔、圖片型 PDF。
+    post：選用的送出函式 post(url, payload, timeout) -> Response，供呼叫端套用共用節流；未提供時直接 requests.post。
     Returns: (docx_bytes, error_message)
     """
     _safe_imports()
@@ -586,7 +1296,7 @@ def pdf_to_word_with_ai_ocr(
                 "generationConfig": {"temperature": 0.1, "maxOutputTokens": 8192},
             }
 
-            resp = req.post(url, json=payload, timeout=60)
+            resp = post(url, payload, 60) if post else req.post(url, json=payload, timeout=60)
             if resp.status_code != 200:
                 return None, f"Gemini API 錯誤: {resp.status_code} {resp.text[:200]}"
 
@@ -785,10 +1495,12 @@ def pdf_to_word_with_ai_layout(
     api_key: str,
     model_name: str = "gemini-2.0-flash",
     progress_callback=None,
+    post=None,
 ) -> Tuple[Optional[bytes], Optional[str]]:
     """
     使用 Gemini Vision 解析 PDF 每頁結構（標題、段落、清單、表格、圖片），
     以 python-docx 重建可編輯 Word（樣式、字體、圖片皆可編輯）。適用掃描檔或文字型 PDF。
+    post：同 pdf_to_word_with_ai_ocr。
     Returns: (docx_bytes, error_message)
     """
     _safe_imports()
@@ -848,7 +1560,7 @@ def pdf_to_word_with_ai_layout(
                 }],
                 "generationConfig": {"temperature": 0.1, "maxOutputTokens": 8192, "responseMimeType": "application/json"},
             }
-            resp = req.post(url, json=payload, timeout=120)
+            resp = post(url, payload, 120) if post else req.post(url, json=payload, timeout=120)
             if resp.status_code != 200:
                 return None, "Gemini API 錯誤: %s %s" % (resp.status_code, resp.text[:200])
             data = resp.json()
@@ -870,3 +1582,229 @@ def pdf_to_word_with_ai_layout(
         if "poppler" in err_msg.lower():
             return None, "pdf2image 需要 poppler"
         return None, "AI 高品質排版轉換失敗：%s" % err_msg
+
+
+# ---------- 批次轉換 ----------
+
+# 目標格式 → 輸出副檔名；"pdf" 依來源副檔名決定轉換方式
+_BATCH_OUTPUT_EXT = {
+    "excel": "xlsx",
+    "word": "docx",
+    "word_ocr": "docx",
+    "word_ai": "docx",
+    "word_ai_layout": "docx",
+    "ppt": "pptx",
+    "image": None,  # 每頁一張圖，展開到以檔名命名的資料夾
+    "pdf": "pdf",
+}
+
+_BATCH_STORED_EXT = (".pdf", ".docx", ".xlsx", ".pptx", ".png", ".jpg", ".jpeg", ".zip")
+
+_batch_executor = None
+_batch_executor_size = 1
+_batch_executor_lock = threading.Lock()
+
+
+def _get_batch_executor():
+    """批次轉換共用的執行緒池（PDF_BATCH_WORKERS，預設 min(4, CPU 核心數)）。"""
+    global _batch_executor, _batch_executor_size
+    with _batch_executor_lock:
+        if _batch_executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            try:
+                size = int(os.environ.get("PDF_BATCH_WORKERS", "0"))
+            except ValueError:
+                size = 0
+            if size <= 0:
+                size = min(4, os.cpu_count() or 1)
+            _batch_executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix="pdf-batch")
+            _batch_executor_size = size
+        return _batch_executor
+
+
+def _convert_for_batch(
+    name: str,
+    data: bytes,
+    target: str,
+    options: dict,
+    progress_callback=None,
+) -> Tuple[List[Tuple[str, bytes]], Optional[str]]:
+    """
+    批次中的單一檔案轉換。
+    內容為 bytes；或為已開啟的檔案型 ZIP（zip 內檔名以 / 結尾），由 batch_convert 將其成員逐一串流複製到該目錄下。
+    Returns: ([(zip 內檔名, 內容)], error_message)
+    """
+    base_name, src_ext = os.path.splitext(os.path.basename(name or "document"))
+    src_ext = src_ext.lower().lstrip(".")
+    base_name = base_name or "document"
+    # 批次中各檔同時轉換：每檔只分到共用行程池的一份，避免單一檔案佔滿所有子行程
+    workers = max(1, _default_workers() // _batch_executor_size)
+
+    if target == "pdf":
+        if src_ext in ("jpg", "jpeg", "png"):
+            result, err = images_to_pdf([data], progress_callback=progress_callback)
+        elif src_ext == "docx":
+            result, err = word_to_pdf(data, progress_callback=progress_callback)
+        elif src_ext == "xlsx":
+            result, err = excel_to_pdf(data, progress_callback=progress_callback)
+        elif src_ext == "pptx":
+            result, err = ppt_to_pdf(data, progress_callback=progress_callback)
+        else:
+            return [], f"不支援的檔案格式：.{src_ext or '?'}"
+        return ([(f"{base_name}.pdf", result)] if result else []), err
+
+    if src_ext != "pdf":
+        return [], "請上傳 PDF 檔案"
+
+    if target == "image":
+        zip_file, _first, err = pdf_to_images_stream(
+            data,
+            fmt=options.get("fmt", "png"),
+            dpi=options.get("dpi", 200),
+            progress_callback=progress_callback,
+        )
+        if err:
+            return [], err
+        return [(f"{base_name}/", zip_file)], None
+
+    if target == "excel":
+        result, err = pdf_to_excel(data, progress_callback=progress_callback, workers=workers)
+    elif target == "ppt":
+        result, err = pdf_to_ppt(data, progress_callback=progress_callback)
+    elif target == "word":
+        result, err = pdf_to_word(data, progress_callback=progress_callback)
+    elif target == "word_ocr":
+        result, err = pdf_to_word_with_tesseract(
+            data,
+            lang=options.get("lang", "chi_tra+eng"),
+            dpi=options.get("dpi", 200),
+            progress_callback=progress_callback,
+            workers=workers,
+        )
+    elif target in ("word_ai", "word_ai_layout"):
+        func = pdf_to_word_with_ai_ocr if target == "word_ai" else pdf_to_word_with_ai_layout
+        result, err = func(
+            data,
+            api_key=options.get("api_key", ""),
+            model_name=options.get("model_name", "gemini-2.0-flash"),
+            progress_callback=progress_callback,
+            post=options.get("post"),
+        )
+    else:
+        return [], f"不支援的轉換目標：{target}"
+    return ([(f"{base_name}.{_BATCH_OUTPUT_EXT[target]}", result)] if result else []), err
+
+
+def batch_convert_stream(
+    files: List[Tuple[str, bytes]],
+    target: str,
+    progress_callback=None,
+    **options,
+) -> Tuple[Optional[BinaryIO], List[dict], Optional[str]]:
+    """
+    批次轉換多個檔案，所有輸出直接寫入暫存檔上的單一 ZIP（不在記憶體保留整份壓縮檔）。
+    files：[(檔名, 內容)]；target：excel / word / word_ocr / word_ai / word_ai_layout / ppt / image / pdf
+    options：傳給個別轉換函式的參數（fmt、dpi、lang、api_key、model_name、post）。
+    各檔案於共用執行緒池中並行轉換，完成即寫入 ZIP；單檔失敗只記錄在報告中，不影響其他檔案。
+    progress_callback 於呼叫端執行緒回報整體進度（可直接更新 Streamlit 元件）。
+    回傳的 zip_file 為檔案型緩衝（已定位至開頭），用完請 close()。
+    Returns: (zip_file, report, error_message)
+        report：[{"name": 原檔名, "outputs": [zip 內檔名], "error": 錯誤訊息或 None}]
+    """
+    if target not in _BATCH_OUTPUT_EXT:
+        return None, [], f"不支援的轉換目標：{target}"
+    if not files:
+        return None, [], "請至少上傳一個檔案"
+
+    from concurrent.futures import FIRST_COMPLETED, wait
+
+    total = len(files)
+    fractions = [0.0] * total
+    report = [{"name": name, "outputs": [], "error": None} for name, _ in files]
+
+    def _file_progress(idx):
+        def _cb(p):
+            fractions[idx] = min(max(float(p), 0.0), 1.0)
+        return _cb
+
+    executor = _get_batch_executor()
+    futures = {
+        executor.submit(_convert_for_batch, name, data, target, options, _file_progress(i)): i
+        for i, (name, data) in enumerate(files)
+    }
+
+    used_names = set()
+
+    def _unique(arcname):
+        # 同名檔案加上序號，避免覆蓋
+        stem, ext = os.path.splitext(arcname)
+        unique, n = arcname, 1
+        while unique in used_names:
+            n += 1
+            unique = f"{stem}_{n}{ext}"
+        used_names.add(unique)
+        return unique
+
+    def _compress_type(arcname):
+        # Office（本身即 ZIP）/ PDF / 圖片已壓縮，直接存入；其餘（文字、CSV 等）以 DEFLATE 壓縮
+        return zipfile.ZIP_STORED if os.path.splitext(arcname)[1].lower() in _BATCH_STORED_EXT else zipfile.ZIP_DEFLATED
+
+    # 無名暫存檔：關閉即由系統刪除（Windows 亦同），不需另行清理
+    tmp = tempfile.TemporaryFile(suffix=".zip")
+    try:
+        with zipfile.ZipFile(tmp, "w", zipfile.ZIP_DEFLATED) as zf:
+            pending = set(futures)
+            while pending:
+                done, pending = wait(pending, timeout=0.25, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    idx = futures[fut]
+                    fractions[idx] = 1.0
+                    try:
+                        entries, err = fut.result()
+                    except Exception as e:
+                        entries, err = [], f"轉換失敗：{e}"
+                    report[idx]["error"] = err
+                    for arcname, content in entries:
+                        if isinstance(content, (bytes, bytearray)):
+                            unique = _unique(arcname)
+                            zf.writestr(unique, content, compress_type=_compress_type(unique))
+                            report[idx]["outputs"].append(unique)
+                            continue
+                        # 檔案型 ZIP（如 PDF→圖片）：成員逐一串流複製
+                        with content, zipfile.ZipFile(content) as inner:
+                            for info in inner.infolist():
+                                zinfo = zipfile.ZipInfo(_unique(arcname + info.filename), date_time=info.date_time)
+                                zinfo.compress_type = _compress_type(zinfo.filename)
+                                with inner.open(info) as src, zf.open(zinfo, "w", force_zip64=True) as dst:
+                                    shutil.copyfileobj(src, dst, 1 << 20)
+                                report[idx]["outputs"].append(zinfo.filename)
+                if progress_callback:
+                    progress_callback(sum(fractions) / total)
+
+        if not used_names:
+            tmp.close()
+            first_err = next((r["error"] for r in report if r["error"]), None)
+            return None, report, f"全部檔案轉換失敗：{first_err}" if first_err else "沒有產生任何輸出檔案"
+        tmp.seek(0)
+        return tmp, report, None
+    except Exception as e:
+        tmp.close()
+        return None, report, f"打包失敗：{e}"
+
+
+def batch_convert(
+    files: List[Tuple[str, bytes]],
+    target: str,
+    progress_callback=None,
+    **options,
+) -> Tuple[Optional[bytes], List[dict], Optional[str]]:
+    """
+    批次轉換多個檔案，所有輸出打包為單一 ZIP（參數同 batch_convert_stream）。
+    大量檔案請改用 batch_convert_stream，避免整份 ZIP 載入記憶體。
+    Returns: (zip_bytes, report, error_message)
+    """
+    zip_file, report, err = batch_convert_stream(files, target, progress_callback=progress_callback, **options)
+    if zip_file is None:
+        return None, report, err
+    with zip_file:
+        return zip_file.read(), report, None
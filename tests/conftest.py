@@ -0,0 +1,62 @@
+"""app.py 在匯入時即需要 Streamlit 與各種服務，無法直接 import。
+load_app 以 AST 取出指定的頂層函式、類別與常數，在只有標準模組與 pandas 的命名空間中執行，供純函式測試使用。"""
+import ast
+import copy
+import hashlib
+import io
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app.py")
+
+
+class _FakeStreamlit:
+    """只提供被測函式會碰到的部分：快取裝飾器（不快取）與 session_state。"""
+
+    def __init__(self):
+        self.session_state = {}
+
+    @staticmethod
+    def _passthrough(*args, **kwargs):
+        if args and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+    cache_resource = _passthrough
+    cache_data = _passthrough
+
+
+def _defined_names(node):
+    if isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+        return {node.name}
+    if isinstance(node, ast.Assign):
+        return {t.id for t in node.targets if isinstance(t, ast.Name)}
+    return set()
+
+
+def load_app(*names, **overrides):
+    """回傳命名空間 dict：含 names 指定的 app.py 頂層定義（依原檔順序執行），overrides 可替換其相依函式。"""
+    with open(APP_PATH, encoding="utf-8") as f:
+        tree = ast.parse(f.read(), APP_PATH)
+    wanted = set(names)
+    nodes = [n for n in tree.body if _defined_names(n) & wanted]
+    missing = wanted - set().union(*(_defined_names(n) for n in nodes))
+    if missing:
+        raise LookupError(f"app.py 中找不到：{', '.join(sorted(missing))}")
+    namespace = {
+        "st": _FakeStreamlit(), "pd": pd, "copy": copy, "hashlib": hashlib, "io": io, "json": json,
+        "os": os, "re": re, "sqlite3": sqlite3, "threading": threading, "time": time, "deque": deque,
+        "datetime": datetime, "timedelta": timedelta,
+    }
+    exec(compile(ast.Module(body=nodes, type_ignores=[]), APP_PATH, "exec"), namespace)
+    namespace.update(overrides)
+    return namespace
+
@@ -0,0 +1,73 @@
+"""pdf_converter.batch_convert 的 ZIP 命名與壓縮方式。"""
+import io
+import zipfile
+
+import pytest
+
+import pdf_converter
+
+
+@pytest.fixture
+def fake_convert(monkeypatch):
+    """以固定輸出取代實際轉換：每個輸入檔產生同名的 .pdf 與 .csv。"""
+    def _convert(name, data, target, options, progress_callback=None):
+        base = name.rsplit(".", 1)[0]
+        return [(f"{base}.pdf", data), (f"{base}.csv", b"a,b,c\n" * 200)], None
+    monkeypatch.setattr(pdf_converter, "_convert_for_batch", _convert)
+
+
+def _open(zip_bytes):
+    return zipfile.ZipFile(io.BytesIO(zip_bytes))
+
+
+def test_duplicate_names_get_numbered_suffix(fake_convert):
+    files = [("a.pdf", b"%PDF-1"), ("a.pdf", b"%PDF-2"), ("a.pdf", b"%PDF-3")]
+    zip_bytes, report, err = pdf_converter.batch_convert(files, "pdf")
+    assert err is None
+    names = sorted(_open(zip_bytes).namelist())
+    assert names == ["a.csv", "a.pdf", "a_2.csv", "a_2.pdf", "a_3.csv", "a_3.pdf"]
+    # 報告列出各輸入檔實際寫入的檔名，內容與輸入對應
+    zf = _open(zip_bytes)
+    for item, (_, data) in zip(report, files):
+        pdf_name = next(n for n in item["outputs"] if n.endswith(".pdf"))
+        assert zf.read(pdf_name) == data
+
+
+def test_compressed_formats_stored_and_text_deflated(fake_convert):
+    zip_bytes, _report, err = pdf_converter.batch_convert([("r.pdf", b"%PDF" * 100)], "pdf")
+    assert err is None
+    types = {i.filename: i.compress_type for i in _open(zip_bytes).infolist()}
+    assert types == {"r.pdf": zipfile.ZIP_STORED, "r.csv": zipfile.ZIP_DEFLATED}
+
+
+def test_failed_file_is_reported_without_dropping_others(monkeypatch):
+    def _convert(name, data, target, options, progress_callback=None):
+        if name == "bad.pdf":
+            return [], "轉換失敗：壞檔"
+        return [(name, data)], None
+    monkeypatch.setattr(pdf_converter, "_convert_for_batch", _convert)
+    zip_bytes, report, err = pdf_converter.batch_convert([("ok.pdf", b"1"), ("bad.pdf", b"2")], "pdf")
+    assert err is None
+    assert _open(zip_bytes).namelist() == ["ok.pdf"]
+    assert report[1] == {"name": "bad.pdf", "outputs": [], "error": "轉換失敗：壞檔"}
+
+
+def test_all_failed_returns_error(monkeypatch):
+    monkeypatch.setattr(pdf_converter, "_convert_for_batch", lambda *a, **k: ([], "轉換失敗：壞檔"))
+    zip_bytes, _report, err = pdf_converter.batch_convert([("bad.pdf", b"2")], "pdf")
+    assert zip_bytes is None
+    assert err == "全部檔案轉換失敗：轉換失敗：壞檔"
+
+
+def test_image_pages_nested_under_file_folder():
+    fitz = pytest.importorskip("fitz")
+    doc = fitz.open()
+    for _ in range(2):
+        doc.new_page(width=100, height=100)
+    data = doc.tobytes()
+    zip_bytes, _report, err = pdf_converter.batch_convert([("a.pdf", data), ("a.pdf", data)], "image", dpi=36)
+    assert err is None
+    infos = _open(zip_bytes).infolist()
+    names = sorted(i.filename for i in infos)
+    assert names == ["a/page_0001.png", "a/page_0001_2.png", "a/page_0002.png", "a/page_0002_2.png"]
+    assert {i.compress_type for i in infos} == {zipfile.ZIP_STORED}
@@ -0,0 +1,55 @@
+"""圖表聚合：每日總計先正規化日期再分組，SQL 與 pandas 版本結果一致。"""
+import sqlite3
+
+import pandas as pd
+import pytest
+
+from conftest import load_app
+
+ROWS = [
+    ("a@x", "2024/01/05", 100, "交際費", "餐飲"),
+    ("a@x", "2024/1/5", 50, "交際費", "餐飲"),
+    ("a@x", "2024-01-05", 25, "雜費", "日用"),
+    ("a@x", "113/01/05", 5, "雜費", "日用"),
+    ("a@x", "2024/01/06 09:30", 10, "雜費", "No"),
+    ("a@x", "2024-1-7", 7, None, "日用"),
+    ("a@x", "不明", 999, "雜費", "日用"),
+    ("b@x", "2024/01/05", 1000, "雜費", "日用"),
+]
+EXPECTED_DAILY = {"2024-01-05": 180.0, "2024-01-06": 10.0, "2024-01-07": 7.0}
+
+
+@pytest.fixture(scope="module")
+def app():
+    return load_app("_PADDED_DATE_SQL", "_register_date_functions", "_DATE_PATTERNS", "normalize_date_value",
+                    "normalize_date_series", "CHART_TOP_CATEGORIES", "_chart_frames", "_query_chart_aggregates",
+                    "chart_aggregates_frame")
+
+
+def _daily(frames):
+    line = frames["line"]
+    return dict(zip(line["日期"].dt.strftime("%Y-%m-%d"), line["總計"].astype(float)))
+
+
+def test_sql_daily_totals_group_by_normalised_date(app, tmp_path):
+    db = str(tmp_path / "inv.db")
+    with sqlite3.connect(db) as conn:
+        conn.execute("CREATE TABLE invoices (id INTEGER PRIMARY KEY, user_email, date, total, subject, category)")
+        conn.executemany("INSERT INTO invoices (user_email, date, total, subject, category) VALUES (?, ?, ?, ?, ?)", ROWS)
+    frames = app["_query_chart_aggregates"](db, 1, "a@x")
+    assert _daily(frames) == EXPECTED_DAILY
+    assert frames["line"]["日期"].is_monotonic_increasing
+    assert dict(frames["pie"].values.tolist()) == {"交際費": 2, "雜費": 4}
+    assert dict(frames["bar"].values.tolist()) == {"日用": 4, "餐飲": 2}
+
+
+def test_frame_version_matches_sql(app):
+    df = pd.DataFrame([r[1:] for r in ROWS if r[0] == "a@x"], columns=["日期", "總計", "會計科目", "類型"])
+    frames = app["chart_aggregates_frame"](df)
+    assert _daily(frames) == EXPECTED_DAILY
+    assert dict(frames["pie"].values.tolist()) == {"交際費": 2, "雜費": 4}
+
+
+def test_duplicate_days_merged_after_parsing(app):
+    frames = app["_chart_frames"]([], [("2024/01/05", 1), ("2024/01/05", 2), ("2024/01/04", 4)], [])
+    assert _daily(frames) == {"2024-01-04": 4.0, "2024-01-05": 3.0}
@@ -0,0 +1,167 @@
+"""Gemini 節流：_GeminiLimiter 的用戶輪流放行、429 降速、排隊逾時，gemini_post 的 429 重試，與整數環境變數的容錯讀取。"""
+import threading
+import time
+
+import pytest
+
+from conftest import load_app
+
+
+@pytest.fixture(scope="module")
+def app():
+    requests = pytest.importorskip("requests")
+    return load_app("GEMINI_QUEUE_TIMEOUT_SEC", "GEMINI_429_RETRIES", "_GeminiLimiter", "_gemini_retry_after",
+                    "gemini_post", requests=requests)
+
+
+def _queue_in_background(limiter, user, granted):
+    """在背景執行緒排入 user 的請求，確定已進入佇列才返回。"""
+    before = limiter.stats()["queued"]
+
+    def _run():
+        limiter.acquire(user, timeout=5)
+        granted.append(user)
+
+    t = threading.Thread(target=_run, daemon=True)
+    t.start()
+    deadline = time.monotonic() + 2
+    while limiter.stats()["queued"] == before and t.is_alive():
+        assert time.monotonic() < deadline
+        time.sleep(0.005)
+    return t
+
+
+def test_users_take_turns(app):
+    limiter = app["_GeminiLimiter"](6000, 1)
+    assert limiter.acquire("a") is not None
+    granted = []
+    threads = [_queue_in_background(limiter, user, granted) for user in ("a", "a", "b")]
+    for expected in (["a"], ["a", "b"], ["a", "b", "a"]):
+        limiter.release(200)
+        deadline = time.monotonic() + 2
+        while len(granted) < len(expected):
+            assert time.monotonic() < deadline
+            time.sleep(0.005)
+        # 併發上限 1：每次 release 只放行一筆，b 不必等 a 的所有請求
+        assert granted == expected
+    for t in threads:
+        t.join(1)
+    limiter.release(200)
+    assert limiter.stats()["in_flight"] == 0
+
+
+def test_concurrency_limit_and_queue_timeout(app):
+    limiter = app["_GeminiLimiter"](6000, 2)
+    assert limiter.acquire("a") is not None
+    assert limiter.acquire("b") is not None
+    assert limiter.acquire("c", timeout=0.05) is None
+    stats = limiter.stats()
+    assert (stats["in_flight"], stats["queued"], stats["queued_users"], stats["timeouts"]) == (2, 0, 0, 1)
+
+
+def test_rate_limit_spaces_requests(app):
+    limiter = app["_GeminiLimiter"](120, 2)  # 每 0.5 秒補 1 個 token，初始 2 個
+    for _ in range(2):
+        assert limiter.acquire("a", timeout=1) < 0.05
+        limiter.release(200)
+    waited = limiter.acquire("a", timeout=2)
+    assert waited is not None and waited >= 0.4
+
+
+def test_429_halves_limit_and_pauses(app):
+    limiter = app["_GeminiLimiter"](6000, 8)
+    for _ in range(3):
+        limiter.acquire("a")
+    limiter.release(429, retry_after=0.3)
+    # 同一波 429 只減半一次
+    limiter.release(429, retry_after=0.3)
+    stats = limiter.stats()
+    assert stats["limit"] == 4
+    assert stats["throttled"] == 2
+    assert 0 < stats["paused"] <= 0.3
+    waited = limiter.acquire("a", timeout=2)
+    assert waited is not None and waited >= 0.2
+    limiter.release(200)
+    limiter.release(200)
+
+
+def test_success_raises_limit_gradually(app):
+    limiter = app["_GeminiLimiter"](6000, 4)
+    limiter.acquire("a")
+    limiter.release(429, retry_after=0.01)
+    assert limiter.stats()["limit"] == 2
+    time.sleep(0.02)
+    for _ in range(4):
+        limiter.acquire("a", timeout=1)
+        limiter.release(200)
+    assert limiter.stats()["limit"] == 3
+    # 5xx 與連線失敗不調整上限
+    limiter.acquire("a", timeout=1)
+    limiter.release(503)
+    limiter.acquire("a", timeout=1)
+    limiter.release(None)
+    assert limiter.stats()["limit"] == 3
+
+
+class _Resp:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.text = ""
+
+
+class _Session:
+    def __init__(self, statuses):
+        self.statuses = list(statuses)
+        self.calls = 0
+
+    def post(self, url, json=None, timeout=None):
+        self.calls += 1
+        status = self.statuses.pop(0)
+        return _Resp(status, {"Retry-After": "0.01"} if status == 429 else None)
+
+
+def test_gemini_post_retries_429(app):
+    limiter = app["_GeminiLimiter"](6000, 4)
+    app["get_gemini_limiter"] = lambda key_id: limiter
+    app["_gemini_key_id"] = lambda key: key
+    session = _Session([429, 429, 200])
+    resp = app["gemini_post"](session, "https://example.invalid", {}, 5, "key", "a@x")
+    assert resp.status_code == 200
+    assert session.calls == 3
+    stats = limiter.stats()
+    assert (stats["throttled"], stats["in_flight"]) == (2, 0)
+
+
+def test_gemini_post_gives_up_after_retries(app):
+    limiter = app["_GeminiLimiter"](6000, 4)
+    app["get_gemini_limiter"] = lambda key_id: limiter
+    app["_gemini_key_id"] = lambda key: key
+    session = _Session([429] * 10)
+    resp = app["gemini_post"](session, "https://example.invalid", {}, 5, "key")
+    assert resp.status_code == 429
+    assert session.calls == app["GEMINI_429_RETRIES"] + 1
+    assert limiter.stats()["in_flight"] == 0
+
+
+def test_retry_after_parsing(app):
+    retry_after = app["_gemini_retry_after"]
+    assert retry_after(_Resp(429, {"Retry-After": "7"})) == 7.0
+    assert retry_after(_Resp(429, {"Retry-After": "3600"})) == 60.0
+    body = _Resp(429)
+    body.text = '{"error": {"details": [{"retryDelay": "12.5s"}]}}'
+    assert retry_after(body) == 12.5
+    assert retry_after(_Resp(429, {"Retry-After": "Wed, 21 Oct 2026 07:28:00 GMT"})) is None
+
+
+@pytest.mark.parametrize("raw, expected", [(None, 60), ("", 60), (" 120 ", 120), ("60/min", 60), ("abc", 60)])
+def test_env_int_falls_back_on_bad_values(monkeypatch, caplog, raw, expected):
+    import logging
+    env_int = load_app("_env_int", logging=logging)["_env_int"]
+    if raw is None:
+        monkeypatch.delenv("GEMINI_RPM", raising=False)
+    else:
+        monkeypatch.setenv("GEMINI_RPM", raw)
+    with caplog.at_level(logging.WARNING):
+        assert env_int("GEMINI_RPM", 60) == expected
+    assert bool(caplog.records) == (raw in ("60/min", "abc"))
@@ -0,0 +1,52 @@
+"""app.normalize_date_series：匯入與重複比對共用的日期正規化。"""
+import pandas as pd
+import pytest
+
+from conftest import load_app
+
+
+@pytest.fixture(scope="module")
+def normalize_date_series():
+    return load_app("_DATE_PATTERNS", "normalize_date_series")["normalize_date_series"]
+
+
+@pytest.mark.parametrize("raw, expected", [
+    ("2024/01/05", "2024/01/05"),
+    ("2024-1-5", "2024/01/05"),
+    ("2024.01.05", "2024/01/05"),
+    ("2024年1月5日", "2024/01/05"),
+    ("20240105", "2024/01/05"),
+    ("113/01/05", "2024/01/05"),
+    ("113-1-5", "2024/01/05"),
+    ("1130105", "2024/01/05"),
+    ("99/12/31", "2010/12/31"),
+    (" 2024/01/05 ", "2024/01/05"),
+    ("2024-01-05 10:30:00", "2024/01/05"),
+])
+def test_known_formats(normalize_date_series, raw, expected):
+    assert normalize_date_series(pd.Series([raw])).tolist() == [expected]
+
+
+def test_unrecognised_values_kept(normalize_date_series):
+    out = normalize_date_series(pd.Series(["不明", "2024", "12/31"]))
+    assert out.tolist() == ["不明", "2024", "12/31"]
+
+
+def test_missing_values_use_default(normalize_date_series):
+    out = normalize_date_series(pd.Series([None, "", "113/2/3"]), default="2024/12/31")
+    assert out.tolist() == ["2024/12/31", "2024/12/31", "2024/02/03"]
+    # 未指定預設值時保留空字串
+    assert normalize_date_series(pd.Series([None])).tolist() == [""]
+
+
+def test_index_preserved(normalize_date_series):
+    s = pd.Series(["2024-01-05", "1130105"], index=[10, 3])
+    assert normalize_date_series(s).to_dict() == {10: "2024/01/05", 3: "2024/01/05"}
+
+
+def test_scalar_version_agrees_with_series():
+    ns = load_app("_DATE_PATTERNS", "normalize_date_value", "normalize_date_series")
+    values = ["2024/01/05", "2024-1-5", "2024年1月5日", "20240105", "113/1/5", "1130105", "99/12/31",
+              " 2024/01/05 ", "2024-01-05 10:30:00", "不明", "2024", "", None]
+    expected = ns["normalize_date_series"](pd.Series(values)).tolist()
+    assert [ns["normalize_date_value"](v) for v in values] == expected
@@ -0,0 +1,160 @@
+"""列表篩選：compile_invoice_filters 產生的 SQL 與 pandas 版 filter_invoices_frame 結果一致。"""
+import sqlite3
+from datetime import date
+
+import pandas as pd
+import pytest
+
+from conftest import load_app
+
+COLUMNS = ("id", "user_email", "date", "invoice_number", "seller_name", "note", "subject", "category",
+           "file_name", "status", "total")
+ROWS = [
+    (1, "a@x", "2024/01/05", "AB00000001", "全家便利商店", "", "交際費", "餐飲", "r1.jpg", "✅ 正常", 120),
+    (2, "a@x", "2024-01-31", "AB00000002", "中華電信", "折扣 50%", "通訊費", "帳單", "r2.jpg", "❌ 缺失", 899),
+    (3, "a@x", "2024/02/01", "CD00000003", "全聯福利中心", "office_supply", "雜費", "日用", "r3.pdf", "✅ 正常", 45),
+    (4, "a@x", "2024/02/15", "CD00000004", "Starbucks 星巴克", "meeting", "交際費", "餐飲", "r4.jpg", "缺漏統編", 300),
+    (5, "b@x", "2024/01/10", "EF00000005", "全家便利商店", "", "交際費", "餐飲", "r5.jpg", "✅ 正常", 80),
+    # 舊資料：未補零、民國、含時間與無法辨識的日期
+    (6, "a@x", "2024/1/15", "GH00000006", "萊爾富", "", "雜費", "日用", "r6.jpg", "✅ 正常", 60),
+    (7, "a@x", "113/1/20", "GH00000007", "7-ELEVEN", "", "雜費", "日用", "r7.jpg", "✅ 正常", 35),
+    (8, "a@x", "2024-1-5", "GH00000008", "OK mart", "", "雜費", "日用", "r8.jpg", "✅ 正常", 25),
+    (9, "a@x", "2024/02/01 09:30", "GH00000009", "美廉社", "", "雜費", "日用", "r9.jpg", "✅ 正常", 15),
+    (10, "a@x", "不明", "GH00000010", "小北百貨", "", "雜費", "日用", "r10.jpg", "✅ 正常", 5),
+    (11, "a@x", None, "GH00000011", "屈臣氏", "", "雜費", "日用", "r11.jpg", "✅ 正常", 5),
+]
+# filter_invoices_frame 使用的中文欄名
+FRAME_COLUMNS = {"date": "日期", "invoice_number": "發票號碼", "seller_name": "賣方名稱", "note": "備註",
+                 "subject": "會計科目", "category": "類型", "file_name": "檔案名稱", "status": "狀態", "total": "總計"}
+
+FILTERS = [
+    {},
+    {"search": "全家"},
+    {"search": "starbucks"},
+    {"search": "50%"},
+    {"search": "office_"},
+    {"status": "正常"},
+    {"status": "缺失"},
+    {"date_start": date(2024, 1, 5), "date_end": date(2024, 1, 31)},
+    {"date_start": date(2024, 1, 6), "date_end": date(2024, 1, 20)},
+    {"date_start": date(2024, 2, 1), "date_end": date(2024, 2, 1)},
+    {"subjects": ["交際費"], "categories": ["餐飲"]},
+    {"amount_min": 100, "amount_max": 500},
+    {"search": "r", "status": "正常", "date_start": date(2024, 1, 1), "date_end": date(2024, 2, 29), "amount_min": 50},
+]
+
+
+APP_NAMES = ("INVOICE_FTS_COLUMNS", "INVOICE_STATUS_FILTER_PATTERNS", "_PADDED_DATE_SQL", "_register_date_functions",
+             "_like_escape", "_fts_match_query", "compile_invoice_filters", "_DATE_PATTERNS", "normalize_date_value",
+             "normalize_date_series")
+
+
+@pytest.fixture(scope="module")
+def app():
+    return load_app(*APP_NAMES, "filter_invoices_frame", invoice_fts_tokenizer=lambda: None)
+
+
+@pytest.fixture
+def conn(app):
+    conn = sqlite3.connect(":memory:")
+    app["_register_date_functions"](conn)
+    conn.execute(f"CREATE TABLE invoices ({', '.join(COLUMNS)})")
+    conn.executemany(f"INSERT INTO invoices VALUES ({', '.join('?' * len(COLUMNS))})", ROWS)
+    yield conn
+    conn.close()
+
+
+def _sql_ids(app, conn, user, filters):
+    where, params = app["compile_invoice_filters"](user, filters)
+    return {r[0] for r in conn.execute(f"SELECT id FROM invoices WHERE {where}", params)}
+
+
+def _frame_ids(app, user, filters):
+    df = pd.DataFrame([r for r in ROWS if r[1] == user], columns=COLUMNS).rename(columns=FRAME_COLUMNS)
+    return set(app["filter_invoices_frame"](df, filters)["id"])
+
+
+@pytest.mark.parametrize("filters", FILTERS)
+def test_sql_matches_frame_filter(app, conn, filters):
+    assert _sql_ids(app, conn, "a@x", filters) == _frame_ids(app, "a@x", filters)
+
+
+def test_expected_rows(app, conn):
+    assert _sql_ids(app, conn, "a@x", {"search": "全家"}) == {1}
+    # LIKE 萬用字元須跳脫：50% 與 office_ 皆為字面比對
+    assert _sql_ids(app, conn, "a@x", {"search": "50%"}) == {2}
+    assert _sql_ids(app, conn, "a@x", {"search": "fic_"}) == set()
+    # 迄日當天（含 YYYY-MM-DD 格式）包含在內；未補零與民國日期依實際日期判斷
+    assert _sql_ids(app, conn, "a@x", {"date_start": date(2024, 1, 5), "date_end": date(2024, 1, 31)}) == {1, 2, 6, 7, 8}
+    assert _sql_ids(app, conn, "a@x", {"date_start": date(2024, 1, 6), "date_end": date(2024, 1, 20)}) == {6, 7}
+    assert _sql_ids(app, conn, "a@x", {"date_start": date(2024, 2, 1), "date_end": date(2024, 2, 1)}) == {3, 9}
+    assert _sql_ids(app, conn, "a@x", {"status": "缺失"}) == {2, 4}
+
+
+def test_other_users_rows_excluded(app, conn):
+    assert _sql_ids(app, conn, "b@x", {"search": "全家"}) == {5}
+    assert _sql_ids(app, conn, "c@x", {}) == set()
+
+
+def test_zero_amount_bounds_ignored(app):
+    where, params = app["compile_invoice_filters"]("a@x", {"amount_min": 0, "amount_max": 0, "subjects": []})
+    assert (where, params) == ("user_email = ?", ["a@x"])
+
+
+@pytest.mark.parametrize("search, tokenizer, expected", [
+    ("全家便利", "trigram", '"全家便利"'),
+    ('say "hi"', "trigram", '"say ""hi"""'),
+    ("全家", "trigram", None),
+    ("全家 meeting", "unicode61", '"全家"* "meeting"*'),
+    ("   ", "unicode61", None),
+    ("全家便利", None, None),
+])
+def test_fts_match_query(app, search, tokenizer, expected):
+    assert app["_fts_match_query"](search, tokenizer) == expected
+
+
+@pytest.fixture(params=["trigram", "unicode61"])
+def fts(request, conn):
+    """建立指定 tokenizer 的 invoices_fts（與 _ensure_invoice_fts 相同的同步觸發器）。"""
+    ns = load_app(*APP_NAMES, "_ensure_invoice_fts", invoice_fts_tokenizer=lambda: request.param)
+    cols = ", ".join(ns["INVOICE_FTS_COLUMNS"])
+    try:
+        conn.execute(f"CREATE VIRTUAL TABLE invoices_fts USING fts5({cols}, content='invoices', "
+                     f"content_rowid='id', tokenize='{request.param}')")
+    except sqlite3.OperationalError:
+        pytest.skip(f"SQLite 不支援 FTS5 {request.param}")
+    assert ns["_ensure_invoice_fts"](conn.cursor()) == request.param
+    conn.execute("INSERT INTO invoices_fts(invoices_fts) VALUES ('rebuild')")
+    return ns
+
+
+def test_fts_search_uses_index(fts, conn):
+    where, params = fts["compile_invoice_filters"]("a@x", {"search": "全家便利商店"})
+    assert "invoices_fts MATCH" in where
+    assert {r[0] for r in conn.execute(f"SELECT id FROM invoices WHERE {where}", params)} == {1}
+
+
+def test_trigram_substring_matches_like(app, fts, conn):
+    if fts["invoice_fts_tokenizer"]() != "trigram":
+        pytest.skip("僅 trigram 與 LIKE 同為子字串語意")
+    for search in ("福利中", "AB0000", "arbuck", "ffice_su"):
+        where, params = fts["compile_invoice_filters"]("a@x", {"search": search})
+        assert "MATCH" in where
+        assert _sql_ids(fts, conn, "a@x", {"search": search}) == _sql_ids(app, conn, "a@x", {"search": search})
+
+
+def test_short_search_falls_back_to_like(fts, conn):
+    if fts["invoice_fts_tokenizer"]() != "trigram":
+        pytest.skip("unicode61 無字數下限")
+    where, _params = fts["compile_invoice_filters"]("a@x", {"search": "全家"})
+    assert "MATCH" not in where and "LIKE" in where
+    assert _sql_ids(fts, conn, "a@x", {"search": "全家"}) == {1}
+
+
+def test_triggers_keep_index_in_sync(fts, conn):
+    conn.execute("UPDATE invoices SET seller_name = '萊爾富超商' WHERE id = 1")
+    conn.execute("DELETE FROM invoices WHERE id = 3")
+    conn.execute("INSERT INTO invoices (id, user_email, seller_name, note) VALUES (99, 'a@x', '全聯福利中心', 'new')")
+    assert _sql_ids(fts, conn, "a@x", {"search": "萊爾富超商"}) == {1}
+    assert _sql_ids(fts, conn, "a@x", {"search": "全家便利商店"}) == set()
+    assert _sql_ids(fts, conn, "a@x", {"search": "全聯福利中心"}) == {99}
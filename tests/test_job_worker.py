@@ -0,0 +1,64 @@
+"""背景工作：job_worker.run_in_subprocess 的結果與進度回傳、子行程崩潰，以及心跳逾時才放回佇列。"""
+import os
+import sqlite3
+import time
+
+import pytest
+
+from conftest import load_app
+from job_worker import run_in_subprocess
+
+
+def _report_twice(value, out_queue):
+    out_queue.put(("progress", 0.5))
+    out_queue.put(("done", {"value": value, "pid": os.getpid()}, None))
+
+
+def _crash(out_queue):
+    os._exit(3)
+
+
+def test_subprocess_result_and_progress():
+    seen = []
+    result, err = run_in_subprocess(_report_twice, (7,), seen.append)
+    assert err is None
+    assert result["value"] == 7
+    assert result["pid"] != os.getpid()
+    assert seen == [0.5]
+
+
+def test_subprocess_crash_reports_exit_code():
+    result, err = run_in_subprocess(_crash, ())
+    assert result is None
+    assert "3" in err
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path / "jobs.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE jobs (id INTEGER PRIMARY KEY, status TEXT, worker TEXT, heartbeat REAL, progress REAL)")
+    now = time.time()
+    conn.executemany("INSERT INTO jobs VALUES (?, ?, ?, ?, 0.5)", [
+        (1, "running", "host:1:0", now),          # 擁有者仍在更新心跳
+        (2, "running", "host:2:0", now - 3600),   # 擁有者已不在
+        (3, "running", None, None),               # 升級前遺留、沒有心跳
+        (4, "queued", None, None),
+        (5, "done", "host:2:1", now - 3600),
+    ])
+    conn.commit()
+    conn.close()
+    return path
+
+
+def test_requeue_only_stale_running_jobs(db_path):
+    app = load_app("JOB_STALE_SEC", "_job_connect", "requeue_stale_jobs")
+    assert app["requeue_stale_jobs"](db_path) == 2
+    conn = sqlite3.connect(db_path)
+    rows = dict((r[0], r[1:]) for r in conn.execute("SELECT id, status, worker, heartbeat FROM jobs"))
+    conn.close()
+    assert rows[1][:2] == ("running", "host:1:0")
+    assert rows[2] == ("queued", None, None)
+    assert rows[3] == ("queued", None, None)
+    assert rows[4][0] == "queued"
+    assert rows[5][0] == "done"
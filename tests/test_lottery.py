@@ -0,0 +1,122 @@
+"""統一發票對獎：match_lottery_draws 向量化比對、領獎期限。"""
+from datetime import date
+
+import pandas as pd
+import pytest
+
+from conftest import load_app
+
+DRAW = {
+    "period_label": "114年 11 ~ 12 月",
+    "special_prize": "97023797",
+    "top_prize": "00507588",
+    "first_prizes": ["92377231", "05232592", "78125249"],
+    "extra_six": ["123"],
+    "claim_period_text": "115年2月6日起至115年5月5日止",
+}
+
+
+@pytest.fixture(scope="module")
+def app():
+    return load_app("LOTTERY_PRIZES", "_lottery_suffix_tables", "match_lottery_prize", "match_lottery_draws")
+
+
+def _invoices(numbers):
+    return pd.DataFrame({
+        "invoice_number": numbers,
+        "date": ["2025/11/15"] * len(numbers),
+        "seller_name": [f"店{i}" for i in range(len(numbers))],
+    })
+
+
+def test_each_prize_level(app):
+    df = _invoices([
+        "AB97023797",  # 特別獎
+        "CD00507588",  # 特獎
+        "EF92377231",  # 頭獎
+        "GH12377231",  # 二獎（末 7 碼）
+        "IJ11377231",  # 三獎
+        "KL11177231",  # 四獎
+        "MN11117231",  # 五獎
+        "OP11111231",  # 六獎
+        "QR11111123",  # 增開六獎
+        "ST11111111",  # 未中獎
+    ])
+    result = app["match_lottery_draws"](df, [DRAW])[DRAW["period_label"]]
+    prizes = {w["發票號碼"]: w["獎別"] for w in result["winners"]}
+    assert prizes == {
+        "AB97023797": "特別獎", "CD00507588": "特獎", "EF92377231": "頭獎", "GH12377231": "二獎",
+        "IJ11377231": "三獎", "KL11177231": "四獎", "MN11117231": "五獎", "OP11111231": "六獎",
+        "QR11111123": "六獎",
+    }
+    assert result["checked_count"] == 10
+    assert result["total_prize"] == sum(app["LOTTERY_PRIZES"][p] for p in prizes.values())
+
+
+def test_agrees_with_single_invoice_matcher(app):
+    numbers = [f"{n:08d}" for n in range(77230, 77240)] + ["05232592", "78125249", "00000123", "97023790"]
+    result = app["match_lottery_draws"](_invoices(numbers), [DRAW])[DRAW["period_label"]]
+    vectorised = {w["發票號碼"]: (w["獎別"], w["獎金"]) for w in result["winners"]}
+    expected = {}
+    for n in numbers:
+        prize, amount = app["match_lottery_prize"](n, DRAW)
+        if amount:
+            expected[n] = (prize, amount)
+    assert vectorised == expected
+
+
+def test_number_normalisation_and_short_numbers(app):
+    df = _invoices(["ab-9702-3797", "1234", None])
+    result = app["match_lottery_draws"](df, [DRAW])[DRAW["period_label"]]
+    assert [w["獎別"] for w in result["winners"]] == ["特別獎"]
+    assert result["winners"][0]["賣方名稱"] == "店0"
+    # 不足 8 碼與空值不列入比對張數
+    assert result["checked_count"] == 1
+
+
+def test_several_draws_in_one_pass(app):
+    other = dict(DRAW, period_label="114年 9 ~ 10 月", special_prize="11111111", top_prize=None,
+                 first_prizes=["22222222"], extra_six=[])
+    df = _invoices(["AB97023797", "CD11111111"])
+    results = app["match_lottery_draws"](df, [DRAW, other])
+    assert [w["發票號碼"] for w in results[DRAW["period_label"]]["winners"]] == ["AB97023797"]
+    assert [w["發票號碼"] for w in results[other["period_label"]]["winners"]] == ["CD11111111"]
+
+
+def test_empty_frame_returns_empty_result_per_draw(app):
+    results = app["match_lottery_draws"](pd.DataFrame(), [DRAW])
+    assert results == {DRAW["period_label"]: {"draw": DRAW, "winners": [], "checked_count": 0, "total_prize": 0}}
+
+
+@pytest.fixture(scope="module")
+def deadline():
+    return load_app("lottery_period_range", "lottery_claim_deadline")
+
+
+@pytest.mark.parametrize("label, expected", [
+    ("114年 11 ~ 12 月", date(2026, 5, 5)),
+    ("114年 1 ~ 2 月", date(2025, 7, 5)),
+    ("113年 9～10 月", date(2025, 3, 5)),
+])
+def test_claim_deadline_derived_from_period(deadline, label, expected):
+    assert deadline["lottery_claim_deadline"]({"period_label": label}) == expected
+
+
+def test_claim_deadline_prefers_claim_period_text(deadline):
+    # 遇假日延後等公告日期以原文最後一個日期為準
+    draw = dict(DRAW, claim_period_text="115年2月6日起至115年5月6日止")
+    assert deadline["lottery_claim_deadline"](draw) == date(2026, 5, 6)
+
+
+def test_claim_deadline_invalid_text_falls_back(deadline):
+    draw = {"period_label": "114年 11 ~ 12 月", "claim_period_text": "115年13月40日止"}
+    assert deadline["lottery_claim_deadline"](draw) == date(2026, 5, 5)
+
+
+@pytest.mark.parametrize("draw", [None, {}, {"period_label": "第一期"}, {"period_label": "114年 12 ~ 11 月"}])
+def test_claim_deadline_unknown(deadline, draw):
+    assert deadline["lottery_claim_deadline"](draw) is None
+
+
+def test_period_range_is_half_open(deadline):
+    assert deadline["lottery_period_range"]("114年 11 ~ 12 月") == (date(2025, 11, 1), date(2026, 1, 1))
@@ -0,0 +1,51 @@
+"""pdf_converter._stitch_continuation_tables：跨頁續表合併與 Sheet 命名。"""
+from pdf_converter import _stitch_continuation_tables
+
+HEADER = ["品名", "數量", "金額"]
+
+
+def test_continuation_with_repeated_header_is_merged():
+    pages = {
+        0: [[HEADER, ["A", "1", "10"]]],
+        1: [[HEADER, ["B", "2", "20"]]],
+        2: [[["C", "3", "30"]]],
+    }
+    assert _stitch_continuation_tables(pages) == [
+        ("Page1-3_Table1", [HEADER, ["A", "1", "10"], ["B", "2", "20"], ["C", "3", "30"]]),
+    ]
+
+
+def test_different_column_count_starts_new_sheet():
+    pages = {
+        0: [[HEADER, ["A", "1", "10"]]],
+        1: [[["x", "y"], ["1", "2"]]],
+    }
+    assert [name for name, _ in _stitch_continuation_tables(pages)] == ["Page1_Table1", "Page2_Table1"]
+
+
+def test_only_last_table_continues_into_first_table_of_next_page():
+    pages = {
+        0: [[HEADER, ["A", "1", "10"]], [["k", "v"], ["a", "b"]]],
+        1: [[HEADER, ["B", "2", "20"]], [["k", "v"], ["c", "d"]]],
+    }
+    # 第 1 頁最後一個表格為 2 欄，第 2 頁第一個表格為 3 欄：不合併
+    assert [name for name, _ in _stitch_continuation_tables(pages)] == [
+        "Page1_Table1", "Page1_Table2", "Page2_Table1", "Page2_Table2",
+    ]
+
+
+def test_skipped_page_breaks_continuation():
+    pages = {0: [[HEADER, ["A", "1", "10"]]], 1: [], 2: [[HEADER, ["B", "2", "20"]]]}
+    assert [name for name, _ in _stitch_continuation_tables(pages)] == ["Page1_Table1", "Page3_Table1"]
+
+
+def test_merge_disabled_keeps_one_sheet_per_table():
+    pages = {0: [[HEADER, ["A", "1", "10"]]], 1: [[HEADER, ["B", "2", "20"]]]}
+    sheets = _stitch_continuation_tables(pages, merge=False)
+    assert sheets == [("Page1_Table1", [HEADER, ["A", "1", "10"]]), ("Page2_Table1", [HEADER, ["B", "2", "20"]])]
+
+
+def test_empty_tables_are_ignored():
+    pages = {0: [[], [HEADER, ["A", "1", "10"]]], 1: [None, [HEADER]]}
+    sheets = _stitch_continuation_tables(pages)
+    assert sheets == [("Page1-2_Table1", [HEADER, ["A", "1", "10"]])]
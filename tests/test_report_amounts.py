@@ -0,0 +1,41 @@
+"""app.compute_invoice_amounts：導出報表的金額回推。"""
+import pandas as pd
+import pytest
+
+from conftest import load_app
+
+
+@pytest.fixture(scope="module")
+def compute_invoice_amounts():
+    return load_app("_ZERO_TAX_TYPES", "compute_invoice_amounts")["compute_invoice_amounts"]
+
+
+def test_missing_subtotal_and_tax_derived_from_total(compute_invoice_amounts):
+    df = pd.DataFrame({"總計": [1050, 100], "銷售額": [0, None], "稅額": [0, None]})
+    subtotal, tax, total = compute_invoice_amounts(df)
+    assert subtotal.tolist() == [1000, 95]
+    assert tax.tolist() == [50, 5]
+    assert total.tolist() == [1050, 100]
+
+
+def test_zero_rate_and_exempt_have_no_tax(compute_invoice_amounts):
+    df = pd.DataFrame({"總計": [500, 300, 200], "稅額": [0, 0, 0], "稅率類型": ["0%", "免稅", " Exempt "]})
+    subtotal, tax, _total = compute_invoice_amounts(df)
+    assert tax.tolist() == [0, 0, 0]
+    assert subtotal.tolist() == [500, 300, 200]
+
+
+def test_complete_rows_are_kept(compute_invoice_amounts):
+    df = pd.DataFrame({"總計": ["1000", 210], "銷售額": [952, 200], "稅額": [48, 10]})
+    subtotal, tax, total = compute_invoice_amounts(df)
+    assert total.tolist() == [1000, 210]
+    assert subtotal.tolist() == [952, 200]
+    assert tax.tolist() == [48, 10]
+
+
+def test_english_columns_and_default_tax_type(compute_invoice_amounts):
+    df = pd.DataFrame({"total": [105, 0], "subtotal": [None, None], "tax": [None, None]})
+    subtotal, tax, total = compute_invoice_amounts(df)
+    assert subtotal.tolist() == [100, 0]
+    assert tax.tolist() == [5, 0]
+    assert total.tolist() == [105, 0]
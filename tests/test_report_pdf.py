@@ -0,0 +1,65 @@
+"""app.build_invoice_report_pdf：連續產生多份報表，字型（含粗體）各自正確嵌入。"""
+import glob
+import os
+
+import pandas as pd
+import pytest
+
+from conftest import APP_PATH, load_app
+
+fitz = pytest.importorskip("fitz")
+fpdf = pytest.importorskip("fpdf")
+
+ROWS = pd.DataFrame({
+    "日期": ["2024/01/05", "2024/01/06"],
+    "發票號碼": ["AB00000001", "AB00000002"],
+    "賣方名稱": ["Family Mart", "Chunghwa Telecom"],
+    "總計": [105, 210],
+    "狀態": ["OK", "OK"],
+})
+
+
+def _find_ttf():
+    """優先使用專案附帶的 NotoSansTC，其次 REPORT_TEST_FONT 或系統字型。"""
+    candidates = [os.path.join(os.path.dirname(APP_PATH), "NotoSansTC-Regular.ttf"), os.environ.get("REPORT_TEST_FONT", "")]
+    candidates += sorted(glob.glob("/usr/share/fonts/**/*.ttf", recursive=True))
+    return next((p for p in candidates if p and os.path.isfile(p)), None)
+
+
+@pytest.fixture(scope="module")
+def app():
+    return load_app("_ZERO_TAX_TYPES", "compute_invoice_amounts", "register_pdf_font", "_REPORT_PDF_COLUMNS",
+                    "build_invoice_report_pdf", FPDF=fpdf.FPDF)
+
+
+def test_two_reports_with_ttf_font(app):
+    font = _find_ttf()
+    if font is None:
+        pytest.skip("找不到可用的 TTF 字型")
+    outputs = [app["build_invoice_report_pdf"](ROWS, font_path=font) for _ in range(2)]
+    for pdf_bytes in outputs:
+        with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+            fonts = [f for page in doc for f in page.get_fonts()]
+            text = "".join(page.get_text() for page in doc)
+        # 一般與粗體（標題、表頭）兩個樣式都嵌入為 TrueType 子集
+        assert len({f[0] for f in fonts}) == 2
+        assert all(f[1] == "ttf" and "+" in f[3] for f in fonts)
+        assert "AB00000001" in text and "AB00000002" in text
+
+
+def test_missing_font_falls_back_to_helvetica(app):
+    for _ in range(2):
+        pdf_bytes = app["build_invoice_report_pdf"](ROWS, font_path="/nonexistent/font.ttf")
+        with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+            fonts = {f[3] for page in doc for f in page.get_fonts()}
+            text = "".join(page.get_text() for page in doc)
+        assert fonts == {"Helvetica", "Helvetica-Bold"}
+        assert "Invoice Report" in text and "Family Mart" in text
+
+
+def test_register_pdf_font_rejects_missing_or_invalid_file(app, tmp_path):
+    pdf = fpdf.FPDF()
+    assert app["register_pdf_font"](pdf, "X", str(tmp_path / "missing.ttf")) is False
+    bad = tmp_path / "bad.ttf"
+    bad.write_bytes(b"not a font")
+    assert app["register_pdf_font"](pdf, "X", str(bad)) is False